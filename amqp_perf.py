@@ -0,0 +1,4428 @@
+"""Unified performance test driver that runs the same scenario against every
+supported AMQP client library interface and reports a comparable throughput
+matrix.
+
+Each *_perf.py module contributes client_adapter.ClientAdapter subclasses via
+its ADAPTERS list; libraries that aren't installed are skipped.
+"""
+
+import collections
+import csv
+import importlib
+import itertools
+import json
+import logging
+import multiprocessing
+from optparse import OptionParser
+import os
+import Queue
+import sys
+import threading
+import time
+
+import codec_bench
+import embedded_broker
+import perf_gc
+import perf_memory
+import perf_payload
+import perf_profile
+import perf_stats
+import perf_tasks
+import socket_stats
+
+
+
+g_log = logging.getLogger("amqp_perf")
+
+# Adapter module name -> (elapsed, (cpuUser, cpuSys)) of its import by
+# loadAdapters(), which includes importing the client library
+g_importTimes = {}
+
+
+ROUTING_KEY = "test"
+
+# Default coefficient of variation threshold of the steady-state detector
+DEFAULT_STEADY_CV = 0.1
+
+# Seconds that the latency command waits for the last deliveries
+DEFAULT_DRAIN_TIMEOUT = 5.0
+
+# Ways of spreading published messages over channels; see _scheduleChannels()
+ROUND_ROBIN = "round-robin"
+DEDICATED = "dedicated"
+
+# --thread-mode choices
+OWN_CONNECTION = "own"
+SHARED_CONNECTION = "shared"
+
+THREAD_MODES = [OWN_CONNECTION, SHARED_CONNECTION]
+
+# Maximum number of messages that producer threads of a shared connection
+# hand off to the publishing thread ahead of it
+HANDOFF_QUEUE_SIZE = 1000
+
+# Modes of the recording arg of the scenario functions: save the bytes that
+# the client receives, or feed them back to it instead of a broker
+RECORD = "record"
+REPLAY = "replay"
+
+# Modules providing ADAPTERS lists of client_adapter.ClientAdapter subclasses
+ADAPTER_MODULES = ["pika_perf", "haigha_perf", "puka_perf", "rabbitpy_perf"]
+
+
+def main():
+  logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)-15s %(name)s(%(process)s) - %(levelname)s - %(message)s',
+    disable_existing_loggers=False)
+
+  topHelpString = (
+    "\n"
+    "\t%prog COMMAND OPTIONS\n"
+    "\t%prog --help\n"
+    "\t%prog COMMAND --help\n"
+    "\n"
+    "Supported COMMANDs:\n"
+    "\tpublish - publish messages via each selected client interface\n"
+    "\tconsume - drain a pre-filled queue via each selected client interface\n"
+    "\taltpubcons - alternate publishing/consuming one message at a time via\n"
+    "\t             each selected client interface\n"
+    "\tsweep   - run one of the above over the Cartesian product of parameter\n"
+    "\t          lists, saving the results as JSON lines and CSV\n"
+    "\tlatency - measure publish-to-delivery latency with sequence-numbered,\n"
+    "\t          timestamped messages via each selected client interface\n"
+    "\tconcurrent - many concurrent producer tasks and consumers on one\n"
+    "\t             connection via each selected client interface\n"
+    "\tfindmax - find the highest offered rate that each selected client\n"
+    "\t          interface sustains under a latency SLO\n"
+    "\tcodec   - benchmark each library's frame encoding and decoding\n"
+    "\t          without a broker or socket\n"
+    "\tclients - list client interfaces and their availability")
+
+  topParser = OptionParser(topHelpString)
+
+  if len(sys.argv) < 2:
+    topParser.error("Missing COMMAND")
+
+  command = sys.argv[1]
+
+  if command == "publish":
+    _handlePublishTest(sys.argv[2:])
+  elif command == "consume":
+    _handleConsumeTest(sys.argv[2:])
+  elif command == "altpubcons":
+    _handleAltPubConsTest(sys.argv[2:])
+  elif command == "latency":
+    _handleLatencyTest(sys.argv[2:])
+  elif command == "concurrent":
+    _handleConcurrentTest(sys.argv[2:])
+  elif command == "sweep":
+    _handleSweepCommand(sys.argv[2:])
+  elif command == "findmax":
+    _handleFindMaxCommand(sys.argv[2:])
+  elif command == "codec":
+    _handleCodecCommand(sys.argv[2:])
+  elif command == "clients":
+    _handleClientsCommand(sys.argv[2:])
+  elif not command.startswith("-"):
+    topParser.error("Unexpected action: %s" % (command,))
+  else:
+    try:
+      topParser.parse_args()
+    except:
+      raise
+    else:
+      topParser.error("Unknown command=%s" % command)
+
+
+
+def _handleCodecCommand(args):
+  """ Parse args and run the frame codec micro-benchmarks of each selected
+  client library
+
+  :param args: sequence of commandline args passed after the "codec" keyword
+  """
+  helpString = (
+    "\n"
+    "\t%prog codec OPTIONS\n"
+    "\t%prog codec --help\n"
+    "\t%prog --help\n"
+    "\n"
+    "Times each selected client library's own encoding of basic.publish and\n"
+    "decoding of basic.deliver and basic.ack frames in memory, without a\n"
+    "broker or socket, for each combination of body size and number of\n"
+    "header table fields, and reports the time and the number of objects\n"
+    "built per frame")
+
+  parser = OptionParser(helpString)
+
+  parser.add_option(
+      "--libraries",
+      action="store",
+      type="string",
+      dest="libraries",
+      default="",
+      help=("Comma-separated client libraries to benchmark; e.g., pika,puka "
+            "[default: all installed]"))
+
+  parser.add_option(
+      "--sizes",
+      action="store",
+      type="string",
+      dest="messageSizes",
+      default="0,1K,64K",
+      help=("Comma-separated body sizes in bytes, with optional K/M suffixes "
+            "[default: %default]"))
+
+  parser.add_option(
+      "--headers",
+      action="store",
+      type="string",
+      dest="headerCounts",
+      default="0,10",
+      help=("Comma-separated numbers of header table fields "
+            "[default: %default]"))
+
+  parser.add_option(
+      "--iterations",
+      action="store",
+      type="int",
+      dest="iterations",
+      default=10000,
+      help="Number of calls per timed repeat [default: %default]")
+
+  parser.add_option(
+      "--repeat",
+      action="store",
+      type="int",
+      dest="repeat",
+      default=3,
+      help=("Number of timed repeats, of which the fastest is reported "
+            "[default: %default]"))
+
+  options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  messageSizes = _parseSweepNumbers(parser, "--sizes", options.messageSizes,
+                                    minimum=0)
+  headerCounts = _parseSweepNumbers(parser, "--headers", options.headerCounts,
+                                    minimum=0)
+
+  if options.iterations < 1 or options.repeat < 1:
+    parser.error("--iterations and --repeat must be at least 1")
+
+  codecs = loadCodecs()
+  if options.libraries:
+    selected = []
+    for library in options.libraries.split(","):
+      matches = [c for c in codecs if c.LIBRARY == library.strip()]
+      if not matches:
+        parser.error("Unknown or uninstalled library %r; installed: %s" % (
+          library, ", ".join(c.LIBRARY for c in codecs)))
+      selected.extend(matches)
+    codecs = selected
+  elif not codecs:
+    parser.error("No client libraries are installed")
+
+  results = []
+  for codecClass in codecs:
+    g_log.info("Benchmarking the %s frame codec", codecClass.LIBRARY)
+    results.extend(codec_bench.runCodecBenchmarks(
+      codecClass(), messageSizes, headerCounts, options.iterations,
+      options.repeat))
+
+  printResultsTable(results, CODEC_COLUMNS)
+
+
+
+def _handleClientsCommand(args):
+  """ Parse args and list the known client interfaces
+
+  :param args: sequence of commandline args passed after the "clients" keyword
+  """
+  helpString = (
+    "\n"
+    "\t%prog clients\n"
+    "\t%prog clients --help\n"
+    "\n"
+    "Lists client interfaces that may be passed to --clients")
+
+  parser = OptionParser(helpString)
+
+  _options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  adapters, failedModules = loadAdapters()
+
+  for adapterClass in adapters:
+    print("%-30s %s" % (adapterClass.getName(),
+                        "available" if adapterClass.isAvailable()
+                        else "unsupported by installed library"))
+
+  for moduleName, error in failedModules:
+    print("%-30s not installed (%s)" % (moduleName, error))
+
+
+
+def addClientsOption(parser):
+  """Adds the --clients option to the given OptionParser"""
+  parser.add_option(
+      "--clients",
+      action="store",
+      type="string",
+      dest="clients",
+      default="",
+      help=("Comma-separated client interfaces to test, each either LIBRARY "
+            "or LIBRARY:IMPL (e.g., pika:SelectConnection,haigha); see the "
+            "clients command [default: all available]"))
+
+
+
+def _handlePublishTest(args):
+  """ Parse args and invoke the publish scenario for each selected client
+
+  :param args: sequence of commandline args passed after the "publish" keyword
+  """
+  helpString = (
+    "\n"
+    "\t%%prog publish OPTIONS\n"
+    "\t%%prog publish --help\n"
+    "\t%%prog --help\n"
+    "\n"
+    "Publishes the given number of messages of the\n"
+    "given size to the given exchange and routing_key=%s via each of the\n"
+    "selected client interfaces in turn") % (ROUTING_KEY,)
+
+  parser = OptionParser(helpString)
+
+  addClientsOption(parser)
+
+  parser.add_option(
+      "--exg",
+      action="store",
+      type="string",
+      dest="exchange",
+      help="Destination exchange [REQUIRED]")
+
+  parser.add_option(
+      "--msgs",
+      action="store",
+      type="int",
+      dest="numMessages",
+      default=1000,
+      help="Number of messages to send [default: %default]")
+
+  parser.add_option(
+      "--size",
+      action="store",
+      type="int",
+      dest="messageSize",
+      default=1024,
+      help="Size of each message in bytes [default: %default]")
+
+  parser.add_option(
+      "--pubacks",
+      action="store_true",
+      dest="deliveryConfirmation",
+      default=False,
+      help="Publish in delivery confirmation mode [defaults to OFF]")
+
+  addProcsOption(parser)
+
+  addPhasesOption(parser)
+
+  perf_profile.addProfileOptions(parser)
+
+  addIoStatsOption(parser)
+
+  addRecordingOptions(parser)
+
+  addMemTraceOption(parser)
+
+  perf_gc.addGcOption(parser)
+
+  perf_payload.addPayloadOptions(parser)
+
+  addChannelsOptions(parser)
+
+  addDurationOptions(parser)
+
+  addRateOption(parser)
+
+  addThreadsOptions(parser)
+
+  parser.add_option(
+      "--tx-batch",
+      action="store",
+      type="string",
+      dest="txBatches",
+      default=None,
+      help=("Comma-separated numbers of publishes per transaction, each "
+            "producing an additional result row per client that supports "
+            "transactions: the channels are put in transactional mode "
+            "(tx.select), and every N publishes on a channel are followed by "
+            "a tx.commit. Reports the latency from each publish to the "
+            "commit, for comparison with the --pubacks rows "
+            "[default: no transactions]"))
+
+  parser.add_option(
+      "--confirm-window",
+      action="store",
+      type="string",
+      dest="confirmWindows",
+      default="1",
+      help=("Comma-separated maximum numbers of unconfirmed messages in flight "
+            "in --pubacks mode, each producing a result row per client; 1 "
+            "waits for each message's Basic.Ack before publishing the next "
+            "one. Clients whose publish blocks until the Basic.Ack arrives "
+            "run with 1 only [default: %default]"))
+
+  embedded_broker.addBrokerOption(parser)
+
+  options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  if options.exchange is None:
+    parser.error("--exg must be specified with a valid destination exchange name")
+
+  try:
+    confirmWindows = [int(w) for w in options.confirmWindows.split(",")]
+  except ValueError:
+    confirmWindows = None
+  if not confirmWindows or min(confirmWindows) < 1:
+    parser.error("--confirm-window must be a comma-separated list of positive "
+                 "integers, but got %r" % (options.confirmWindows,))
+
+  if not options.deliveryConfirmation:
+    confirmWindows = [1]
+
+  txBatches = []
+  if options.txBatches is not None:
+    try:
+      txBatches = [int(n) for n in options.txBatches.split(",")]
+    except ValueError:
+      txBatches = None
+    if not txBatches or min(txBatches) < 1:
+      parser.error("--tx-batch must be a comma-separated list of positive "
+                   "integers, but got %r" % (options.txBatches,))
+
+  if options.numConnections < 1 or options.channelsPerConnection < 1:
+    parser.error("--connections and --channels-per-conn must be at least 1")
+
+  checkDurationOptions(parser, options)
+  checkRecordingOptions(parser, options)
+  perf_gc.checkGcOption(parser, options)
+  checkThreadsOptions(parser, options)
+  if txBatches and options.threadMode == SHARED_CONNECTION:
+    parser.error("--tx-batch may not be combined with --thread-mode=%s"
+                 % (SHARED_CONNECTION,))
+  if options.duration is not None and options.distribution == DEDICATED:
+    parser.error("--duration requires --distribution=%s" % (ROUND_ROBIN,))
+
+  # Args of the optional scenario features
+  optionalKwargs = getDurationKwargs(options)
+  optionalKwargs.update(getRateKwargs(parser, options))
+  optionalKwargs.update(perf_payload.getPayloadKwargs(parser, options))
+
+  adapters = selectAdapters(parser, options.clients)
+
+  results = []
+  with embedded_broker.brokerContext(
+      options.broker, exchanges=[options.exchange]) as brokerAddress:
+    for adapterClass in adapters:
+      windows = confirmWindows
+      if adapterClass.STOP_AND_WAIT_CONFIRMS:
+        windows = [1]
+      # (deliveryConfirmation, confirmWindow, txBatch) of each row
+      modes = [(options.deliveryConfirmation, window, None)
+               for window in windows]
+      if adapterClass.SUPPORTS_TRANSACTIONS:
+        modes.extend((False, 1, txBatch) for txBatch in txBatches)
+      elif txBatches:
+        g_log.warning("%s doesn't support transactions; skipping --tx-batch",
+                      adapterClass.getName())
+      for deliveryConfirmation, confirmWindow, txBatch in modes:
+        if options.threadMode == SHARED_CONNECTION:
+          results.append(
+            runHandOffPublishScenario(
+              adapterClass=adapterClass,
+              brokerAddress=brokerAddress,
+              exchange=options.exchange,
+              numThreads=options.numThreads,
+              numMessages=options.numMessages,
+              messageSize=options.messageSize,
+              deliveryConfirmation=deliveryConfirmation,
+              confirmWindow=confirmWindow,
+              **perf_payload.getPayloadKwargs(parser, options)))
+          continue
+
+        kwargs = dict(
+          optionalKwargs,
+          adapterClass=adapterClass,
+          brokerAddress=brokerAddress,
+          exchange=options.exchange,
+          numMessages=options.numMessages,
+          messageSize=options.messageSize,
+          deliveryConfirmation=deliveryConfirmation,
+          confirmWindow=confirmWindow,
+          txBatch=txBatch,
+          numConnections=options.numConnections,
+          channelsPerConnection=options.channelsPerConnection,
+          distribution=options.distribution,
+          ioStats=options.ioStats,
+          memTrace=options.memTrace,
+          gcMode=options.gc,
+          **getRunFileKwargs(options, adapterClass, len(results) + 1))
+        if options.threadMode == OWN_CONNECTION:
+          results.append(
+            runScenarioInThreads(options.numThreads, runPublishScenario,
+                                 **kwargs))
+        else:
+          results.append(
+            runScenarioInProcesses(options.numProcs, runPublishScenario,
+                                   **kwargs))
+
+  columns = list(RESULT_COLUMNS)
+  if options.numProcs > 1:
+    columns.insert(1, PROCS_COLUMN)
+  if options.threadMode is not None:
+    columns[1:1] = THREADS_COLUMNS
+  if options.numConnections > 1 or options.channelsPerConnection > 1:
+    numMessagesIndex = columns.index(RESULT_COLUMNS[1])
+    columns[numMessagesIndex:numMessagesIndex] = CHANNELS_COLUMNS
+  if options.rate is not None:
+    columns.extend(RATE_COLUMNS)
+  if options.deliveryConfirmation:
+    columns.append(CONFIRM_WINDOW_COLUMN)
+    columns.extend(CONFIRM_LATENCY_COLUMNS)
+  if txBatches:
+    columns.append(TX_BATCH_COLUMN)
+    columns.extend(COMMIT_LATENCY_COLUMNS)
+  if options.duration is not None:
+    columns.extend(STEADY_STATE_COLUMNS)
+  if options.ioStats:
+    columns.extend(IO_COLUMNS)
+  if options.memTrace:
+    columns.extend(MEMORY_COLUMNS)
+    if options.deliveryConfirmation:
+      columns.extend(MEMORY_CONFIRM_COLUMNS)
+  if options.gc is not None:
+    columns.extend(GC_COLUMNS)
+  if options.threadMode is not None:
+    columns.extend(THREAD_CPU_COLUMNS)
+  columns.extend(getPayloadColumns(options))
+
+  printResultsTable(results, columns)
+  if options.printPhases:
+    printPhasesTable(results)
+  if options.ioStats:
+    printIoHistograms(results)
+  if options.memTrace:
+    printMemorySites(results)
+
+
+
+def _handleConsumeTest(args):
+  """ Parse args and invoke the consume scenario for each selected client
+
+  :param args: sequence of commandline args passed after the "consume" keyword
+  """
+  helpString = (
+    "\n"
+    "\t%prog consume OPTIONS\n"
+    "\t%prog consume --help\n"
+    "\t%prog --help\n"
+    "\n"
+    "Pre-fills a temporary queue with the given number of messages of the\n"
+    "given size and measures how fast each of the selected client interfaces\n"
+    "in turn drains it")
+
+  parser = OptionParser(helpString)
+
+  addClientsOption(parser)
+
+  parser.add_option(
+      "--msgs",
+      action="store",
+      type="int",
+      dest="numMessages",
+      default=1000,
+      help="Number of messages to pre-fill and consume [default: %default]")
+
+  parser.add_option(
+      "--size",
+      action="store",
+      type="int",
+      dest="messageSize",
+      default=1024,
+      help="Size of each message in bytes [default: %default]")
+
+  parser.add_option(
+      "--prefetch",
+      action="store",
+      type="int",
+      dest="prefetch",
+      default=0,
+      help="basic.qos prefetch count; 0 for unlimited [default: %default]")
+
+  parser.add_option(
+      "--no-ack",
+      action="store_true",
+      dest="noAck",
+      default=False,
+      help="Consume in no-ack mode [defaults to OFF]")
+
+  parser.add_option(
+      "--ack-batch",
+      action="store",
+      type="int",
+      dest="ackBatch",
+      default=1,
+      help=("Without --no-ack, acknowledge every Nth message with "
+            "multiple=True; 1 acknowledges each message individually "
+            "[default: %default]"))
+
+  addProcsOption(parser)
+
+  addPhasesOption(parser)
+
+  perf_profile.addProfileOptions(parser)
+
+  addIoStatsOption(parser)
+
+  addRecordingOptions(parser)
+
+  addMemTraceOption(parser)
+
+  perf_gc.addGcOption(parser)
+
+  perf_payload.addPayloadOptions(parser)
+
+  embedded_broker.addBrokerOption(parser)
+
+  options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  if options.ackBatch < 1:
+    parser.error("--ack-batch must be at least 1")
+
+  if not options.noAck and options.prefetch and (
+      options.ackBatch > options.prefetch):
+    # The broker would stop delivering before the batch is complete
+    parser.error("--ack-batch may not exceed --prefetch")
+
+  checkRecordingOptions(parser, options)
+  perf_gc.checkGcOption(parser, options)
+  payloadKwargs = perf_payload.getPayloadKwargs(parser, options)
+
+  adapters = selectAdapters(parser, options.clients)
+
+  results = []
+  with embedded_broker.brokerContext(options.broker) as brokerAddress:
+    for adapterClass in adapters:
+      results.append(
+        runScenarioInProcesses(
+          options.numProcs,
+          runConsumeScenario,
+          adapterClass=adapterClass,
+          brokerAddress=brokerAddress,
+          numMessages=options.numMessages,
+          messageSize=options.messageSize,
+          prefetch=options.prefetch,
+          noAck=options.noAck,
+          ackBatch=options.ackBatch,
+          ioStats=options.ioStats,
+          memTrace=options.memTrace,
+          gcMode=options.gc,
+          **dict(payloadKwargs,
+                 **getRunFileKwargs(options, adapterClass, len(results) + 1))))
+
+  columns = list(CONSUME_RESULT_COLUMNS)
+  if options.numProcs > 1:
+    columns.insert(1, PROCS_COLUMN)
+  if options.ioStats:
+    columns.extend(IO_COLUMNS)
+  if options.memTrace:
+    columns.extend(MEMORY_COLUMNS)
+  if options.gc is not None:
+    columns.extend(GC_COLUMNS)
+  columns.extend(getPayloadColumns(options))
+
+  printResultsTable(results, columns)
+  if options.printPhases:
+    printPhasesTable(results)
+  if options.ioStats:
+    printIoHistograms(results)
+  if options.memTrace:
+    printMemorySites(results)
+
+
+
+def _handleAltPubConsTest(args):
+  """ Parse args and invoke the alternating publish-consume scenario for each
+  selected client
+
+  :param args: sequence of commandline args passed after the "altpubcons"
+    keyword
+  """
+  helpString = (
+    "\n"
+    "\t%prog altpubcons OPTIONS\n"
+    "\t%prog altpubcons --help\n"
+    "\t%prog --help\n"
+    "\n"
+    "Alternates publishing/consuming the given number of messages of the\n"
+    "given size one message at a time via default exchange using each of the\n"
+    "selected client interfaces in turn, and reports the distribution of\n"
+    "round-trip latencies")
+
+  parser = OptionParser(helpString)
+
+  addClientsOption(parser)
+
+  addAltPubConsOptions(parser)
+
+  addProcsOption(parser)
+
+  addPhasesOption(parser)
+
+  perf_profile.addProfileOptions(parser)
+
+  addIoStatsOption(parser)
+
+  addRecordingOptions(parser)
+
+  addMemTraceOption(parser)
+
+  perf_gc.addGcOption(parser)
+
+  perf_payload.addPayloadOptions(parser)
+
+  addDurationOptions(parser)
+
+  addRateOption(parser)
+
+  embedded_broker.addBrokerOption(parser)
+
+  options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  checkDurationOptions(parser, options)
+  checkRecordingOptions(parser, options)
+  perf_gc.checkGcOption(parser, options)
+
+  # Args of the optional scenario features
+  optionalKwargs = getDurationKwargs(options)
+  optionalKwargs.update(getRateKwargs(parser, options))
+  optionalKwargs.update(perf_payload.getPayloadKwargs(parser, options))
+
+  adapters = selectAdapters(parser, options.clients)
+
+  results = []
+  with embedded_broker.brokerContext(options.broker) as brokerAddress:
+    for adapterClass in adapters:
+      results.append(
+        runScenarioInProcesses(
+          options.numProcs,
+          runAltPubConsScenario,
+          adapterClass=adapterClass,
+          brokerAddress=brokerAddress,
+          numMessages=options.numMessages,
+          messageSize=options.messageSize,
+          useConsumerAcks=options.useConsumerAcks,
+          deliveryConfirmation=options.deliveryConfirmation,
+          ioStats=options.ioStats,
+          memTrace=options.memTrace,
+          gcMode=options.gc,
+          **dict(optionalKwargs,
+                 **getRunFileKwargs(options, adapterClass, len(results) + 1))))
+
+  columns = list(ALTPUBCONS_RESULT_COLUMNS)
+  if options.numProcs > 1:
+    columns.insert(1, PROCS_COLUMN)
+  if options.rate is not None:
+    # Offered next to the achieved trips/s
+    columns.insert(columns.index(ALTPUBCONS_RESULT_COLUMNS[6]), RATE_COLUMNS[0])
+  if options.duration is not None:
+    columns.extend(STEADY_STATE_COLUMNS)
+  if options.ioStats:
+    columns.extend(IO_COLUMNS)
+  if options.memTrace:
+    columns.extend(MEMORY_COLUMNS)
+    if options.deliveryConfirmation:
+      columns.extend(MEMORY_CONFIRM_COLUMNS)
+  if options.gc is not None:
+    columns.extend(GC_COLUMNS)
+  columns.extend(getPayloadColumns(options))
+
+  printResultsTable(results, columns)
+  if options.printPhases:
+    printPhasesTable(results)
+  if options.ioStats:
+    printIoHistograms(results)
+  if options.memTrace:
+    printMemorySites(results)
+
+
+
+def handleImplAltPubConsTest(args, adapters):
+  """ Parse args of a per-library script's altpubcons command and run the
+  alternating publish-consume scenario via the adapter selected by --impl
+
+  :param args: sequence of commandline args passed after the "altpubcons"
+    keyword
+  :param adapters: the library's client_adapter.ClientAdapter subclasses
+  """
+  helpString = (
+    "\n"
+    "\t%%prog altpubcons OPTIONS\n"
+    "\t%%prog altpubcons --help\n"
+    "\t%%prog --help\n"
+    "\n"
+    "Alternates publishing/consuming the given number of messages of the\n"
+    "given size one message at a time via default exchange using the\n"
+    "specified %s interface") % (adapters[0].LIBRARY,)
+
+  parser = OptionParser(helpString)
+
+  implChoices = [adapterClass.IMPL for adapterClass in adapters]
+
+  parser.add_option(
+      "--impl",
+      action="store",
+      type="choice",
+      dest="impl",
+      choices=implChoices,
+      help=("Selection of %s interface [REQUIRED; must be one of: %s]"
+            % (adapters[0].LIBRARY, ", ".join(implChoices))))
+
+  addAltPubConsOptions(parser)
+
+  embedded_broker.addBrokerOption(parser)
+
+  options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  if not options.impl:
+    parser.error("--impl is required")
+
+  adapterClass = adapters[implChoices.index(options.impl)]
+  if not adapterClass.isAvailable():
+    parser.error("%s is not supported by the installed library"
+                 % (adapterClass.getName(),))
+
+  with embedded_broker.brokerContext(options.broker) as brokerAddress:
+    result = runAltPubConsScenario(
+      adapterClass=adapterClass,
+      brokerAddress=brokerAddress,
+      numMessages=options.numMessages,
+      messageSize=options.messageSize,
+      useConsumerAcks=options.useConsumerAcks,
+      deliveryConfirmation=options.deliveryConfirmation)
+
+  if result["error"]:
+    raise RuntimeError("altpubcons failed: %s" % (result["error"],))
+
+  perf_stats.logLatency(g_log, options.impl, "round-trip",
+                        result["histograms"]["rtt."])
+
+
+
+def addAltPubConsOptions(parser):
+  """Adds the --msgs, --size, --conacks and --pubacks options of the
+  altpubcons commands to the given OptionParser
+  """
+  parser.add_option(
+      "--msgs",
+      action="store",
+      type="int",
+      dest="numMessages",
+      default=1000,
+      help="Number of messages to send [default: %default]")
+
+  parser.add_option(
+      "--size",
+      action="store",
+      type="int",
+      dest="messageSize",
+      default=1024,
+      help="Size of each message in bytes [default: %default]")
+
+  parser.add_option(
+    "--conacks",
+    action="store_true",
+    dest="useConsumerAcks",
+    default=False,
+    help=("Configure consumer with noack=False and ack consumed messages "
+          "one-at-a-time [defaults to OFF]"))
+
+  parser.add_option(
+      "--pubacks",
+      action="store_true",
+      dest="deliveryConfirmation",
+      default=False,
+      help="Publish in delivery confirmation mode [defaults to OFF]")
+
+
+
+def _handleLatencyTest(args):
+  """ Parse args and invoke the end-to-end latency scenario for each selected
+  client
+
+  :param args: sequence of commandline args passed after the "latency"
+    keyword
+  """
+  helpString = (
+    "\n"
+    "\t%prog latency OPTIONS\n"
+    "\t%prog latency --help\n"
+    "\t%prog --help\n"
+    "\n"
+    "Publishes the given number of messages, each stamped with a sequence\n"
+    "number and its send time, to a queue that a consumer drains\n"
+    "concurrently, via each of the selected client\n"
+    "interfaces in turn. Reports the distribution of publish-to-delivery\n"
+    "latencies and any missing, duplicate and reordered messages")
+
+  parser = OptionParser(helpString)
+
+  addClientsOption(parser)
+
+  parser.add_option(
+      "--msgs",
+      action="store",
+      type="int",
+      dest="numMessages",
+      default=1000,
+      help="Number of messages to send [default: %default]")
+
+  parser.add_option(
+      "--size",
+      action="store",
+      type="int",
+      dest="messageSize",
+      default=1024,
+      help=("Size of each message in bytes; at least %d for the stamp "
+            "[default: %%default]" % (perf_payload.STAMP.size,)))
+
+  parser.add_option(
+      "--consumer-process",
+      action="store_true",
+      dest="consumerProcess",
+      default=False,
+      help=("Consume via a connection of a separate process instead of on a "
+            "second channel of the publishing connection, whose deliveries "
+            "are dispatched between publishes [defaults to OFF]"))
+
+  parser.add_option(
+      "--drain-timeout",
+      action="store",
+      type="float",
+      dest="drainTimeout",
+      default=DEFAULT_DRAIN_TIMEOUT,
+      help=("Seconds without deliveries after the last publish after which "
+            "the remaining messages count as missing [default: %default]"))
+
+  addRateOption(parser)
+
+  embedded_broker.addBrokerOption(parser)
+
+  options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  if options.messageSize < perf_payload.STAMP.size:
+    parser.error("--size must be at least %d" % (perf_payload.STAMP.size,))
+  if options.drainTimeout <= 0:
+    parser.error("--drain-timeout must be positive")
+  if options.rate is not None and options.rate <= 0:
+    parser.error("--rate must be positive")
+
+  adapters = selectAdapters(parser, options.clients)
+
+  results = []
+  with embedded_broker.brokerContext(options.broker) as brokerAddress:
+    for adapterClass in adapters:
+      results.append(
+        runLatencyScenario(
+          adapterClass=adapterClass,
+          brokerAddress=brokerAddress,
+          numMessages=options.numMessages,
+          messageSize=options.messageSize,
+          rate=options.rate,
+          consumerProcess=options.consumerProcess,
+          drainTimeout=options.drainTimeout))
+
+  columns = list(LATENCY_RESULT_COLUMNS)
+  if options.rate is not None:
+    columns.extend(RATE_COLUMNS)
+
+  printResultsTable(results, columns)
+
+
+
+def _handleConcurrentTest(args):
+  """ Parse args and invoke the concurrent producers/consumers scenario for
+  each selected client
+
+  :param args: sequence of commandline args passed after the "concurrent"
+    keyword
+  """
+  helpString = (
+    "\n"
+    "\t%prog concurrent OPTIONS\n"
+    "\t%prog concurrent --help\n"
+    "\t%prog --help\n"
+    "\n"
+    "Runs the given number of producer tasks, each publishing its share of\n"
+    "timestamped messages, and consumers of their queue, all multiplexed over\n"
+    "one connection the way an asyncio service's tasks share its event loop,\n"
+    "via each of the selected client interfaces in turn. Reports the\n"
+    "aggregate throughput, the spread of the producers' rates and of the\n"
+    "consumers' shares, and publish-to-delivery latencies")
+
+  parser = OptionParser(helpString)
+
+  addClientsOption(parser)
+
+  parser.add_option(
+      "--producers",
+      action="store",
+      type="int",
+      dest="numProducers",
+      default=100,
+      help="Number of concurrent producer tasks [default: %default]")
+
+  parser.add_option(
+      "--consumers",
+      action="store",
+      type="int",
+      dest="numConsumers",
+      default=10,
+      help=("Number of consumers, each on a channel of its own, that share "
+            "the queue [default: %default]"))
+
+  parser.add_option(
+      "--msgs",
+      action="store",
+      type="int",
+      dest="numMessages",
+      default=100,
+      help="Number of messages that each producer sends [default: %default]")
+
+  parser.add_option(
+      "--size",
+      action="store",
+      type="int",
+      dest="messageSize",
+      default=1024,
+      help=("Size of each message in bytes; at least %d for the stamp "
+            "[default: %%default]" % (perf_payload.STAMP.size,)))
+
+  parser.add_option(
+      "--pubacks",
+      action="store_true",
+      dest="deliveryConfirmation",
+      default=False,
+      help=("Publish in delivery confirmation mode, with each producer "
+            "waiting for the Basic.Ack of its message before the next one, "
+            "like a task awaiting its publish [defaults to OFF]"))
+
+  parser.add_option(
+      "--no-ack",
+      action="store_true",
+      dest="noAck",
+      default=False,
+      help=("Consume in no-ack mode; otherwise, each consumer acks every "
+            "message as it's delivered [defaults to OFF]"))
+
+  parser.add_option(
+      "--prefetch",
+      action="store",
+      type="int",
+      dest="prefetch",
+      default=0,
+      help=("basic.qos prefetch count of each consumer; 0 for unlimited "
+            "[default: %default]"))
+
+  parser.add_option(
+      "--producer-rate",
+      action="store",
+      type="float",
+      dest="producerRate",
+      default=None,
+      help=("Messages per second that each producer publishes at, on a fixed "
+            "schedule (open loop) staggered across the producers; latencies "
+            "are measured from the scheduled send times [default: publish as "
+            "fast as possible]"))
+
+  parser.add_option(
+      "--drain-timeout",
+      action="store",
+      type="float",
+      dest="drainTimeout",
+      default=DEFAULT_DRAIN_TIMEOUT,
+      help=("Seconds without deliveries after the last publish after which "
+            "the remaining messages count as missing [default: %default]"))
+
+  embedded_broker.addBrokerOption(parser)
+
+  options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  if options.numProducers < 1:
+    parser.error("--producers must be at least 1")
+  if options.numConsumers < 1:
+    parser.error("--consumers must be at least 1")
+  if options.messageSize < perf_payload.STAMP.size:
+    parser.error("--size must be at least %d" % (perf_payload.STAMP.size,))
+  if options.prefetch < 0:
+    parser.error("--prefetch must not be negative")
+  if options.producerRate is not None and options.producerRate <= 0:
+    parser.error("--producer-rate must be positive")
+  if options.drainTimeout <= 0:
+    parser.error("--drain-timeout must be positive")
+
+  adapters = selectAdapters(parser, options.clients)
+
+  results = []
+  with embedded_broker.brokerContext(options.broker) as brokerAddress:
+    for adapterClass in adapters:
+      results.append(
+        runConcurrentScenario(
+          adapterClass=adapterClass,
+          brokerAddress=brokerAddress,
+          numProducers=options.numProducers,
+          numConsumers=options.numConsumers,
+          numMessages=options.numMessages,
+          messageSize=options.messageSize,
+          deliveryConfirmation=options.deliveryConfirmation,
+          noAck=options.noAck,
+          prefetch=options.prefetch,
+          producerRate=options.producerRate,
+          drainTimeout=options.drainTimeout))
+
+  columns = list(CONCURRENT_RESULT_COLUMNS)
+  if options.deliveryConfirmation:
+    columns.extend(CONFIRM_LATENCY_COLUMNS)
+  if options.producerRate is not None:
+    columns.extend(RATE_COLUMNS)
+
+  printResultsTable(results, columns)
+
+
+
+def _handleSweepCommand(args):
+  """ Parse args and run the selected scenario over the Cartesian product of
+  the given parameter lists
+
+  :param args: sequence of commandline args passed after the "sweep" keyword
+  """
+  helpString = (
+    "\n"
+    "\t%prog sweep OPTIONS\n"
+    "\t%prog sweep --help\n"
+    "\t%prog --help\n"
+    "\n"
+    "Runs the selected scenario once per combination of the given parameter\n"
+    "values and client interfaces, each in a fresh process, and writes the\n"
+    "results to PREFIX.jsonl and PREFIX.csv. Numeric lists are either\n"
+    "comma-separated values or log-spaced ranges MIN..MAX[*FACTOR] (FACTOR\n"
+    "defaults to 2); values accept K, M and G suffixes (e.g., 16..4M).\n"
+    "Switches take comma-separated on/off values.")
+
+  parser = OptionParser(helpString)
+
+  parser.add_option(
+      "--scenario",
+      action="store",
+      type="choice",
+      dest="scenario",
+      choices=sorted(SWEEP_SCENARIOS),
+      default="publish",
+      help=("Scenario to run; one of: %s [default: %%default]"
+            % ", ".join(sorted(SWEEP_SCENARIOS))))
+
+  addClientsOption(parser)
+
+  parser.add_option(
+      "--exg",
+      action="store",
+      type="string",
+      dest="exchange",
+      help="Destination exchange [REQUIRED for the publish scenario]")
+
+  parser.add_option(
+      "--sizes",
+      action="store",
+      type="string",
+      dest="messageSizes",
+      default="1024",
+      help="Message sizes in bytes [default: %default]")
+
+  parser.add_option(
+      "--msgs",
+      action="store",
+      type="string",
+      dest="numMessages",
+      default="1000",
+      help="Numbers of messages per run [default: %default]")
+
+  parser.add_option(
+      "--max-bytes",
+      action="store",
+      type="string",
+      dest="maxBytes",
+      default="0",
+      help=("If non-zero, reduce the number of messages of runs that would "
+            "otherwise transfer more than this many bytes of message bodies, "
+            "so large sizes finish in reasonable time [default: %default]"))
+
+  parser.add_option(
+      "--pubacks",
+      action="store",
+      type="string",
+      dest="deliveryConfirmation",
+      default="off",
+      help=("Publisher confirms on/off (publish and altpubcons scenarios) "
+            "[default: %default]"))
+
+  parser.add_option(
+      "--confirm-window",
+      action="store",
+      type="string",
+      dest="confirmWindow",
+      default="1",
+      help=("Confirm windows of publish runs with pubacks on "
+            "[default: %default]"))
+
+  parser.add_option(
+      "--prefetch",
+      action="store",
+      type="string",
+      dest="prefetch",
+      default="0",
+      help="basic.qos prefetch counts (consume scenario) [default: %default]")
+
+  parser.add_option(
+      "--no-ack",
+      action="store",
+      type="string",
+      dest="noAck",
+      default="off",
+      help="Consumer no-ack mode on/off (consume scenario) [default: %default]")
+
+  parser.add_option(
+      "--ack-batch",
+      action="store",
+      type="string",
+      dest="ackBatch",
+      default="1",
+      help=("Consumer ack batch sizes of consume runs with no-ack off "
+            "[default: %default]"))
+
+  parser.add_option(
+      "--conacks",
+      action="store",
+      type="string",
+      dest="useConsumerAcks",
+      default="off",
+      help="Consumer acks on/off (altpubcons scenario) [default: %default]")
+
+  parser.add_option(
+      "--procs",
+      action="store",
+      type="string",
+      dest="numProcs",
+      default="1",
+      help="Numbers of worker processes per run [default: %default]")
+
+  addDurationOptions(parser)
+
+  parser.add_option(
+      "--cooldown",
+      action="store",
+      type="float",
+      dest="cooldown",
+      default=1.0,
+      help="Seconds to pause between runs [default: %default]")
+
+  parser.add_option(
+      "--output",
+      action="store",
+      type="string",
+      dest="outputPrefix",
+      default=time.strftime("sweep-%Y%m%d-%H%M%S"),
+      help="Path prefix of the output files [default: sweep-DATE-TIME]")
+
+  embedded_broker.addBrokerOption(parser)
+
+  options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  if options.scenario == "publish" and options.exchange is None:
+    parser.error("--exg must be specified with a valid destination exchange "
+                 "name for the publish scenario")
+
+  checkDurationOptions(parser, options)
+  if options.duration is not None and options.scenario == "consume":
+    parser.error("--duration is not supported by the consume scenario, which "
+                 "drains a pre-filled queue")
+
+  adapters = selectAdapters(parser, options.clients)
+
+  maxBytes = _parseSweepNumbers(parser, "--max-bytes", options.maxBytes,
+                                minimum=0)
+  if len(maxBytes) != 1:
+    parser.error("--max-bytes takes a single value")
+
+  cells = buildSweepCells(
+    scenario=options.scenario,
+    adapters=adapters,
+    messageSizes=_parseSweepNumbers(parser, "--sizes", options.messageSizes),
+    numMessages=_parseSweepNumbers(parser, "--msgs", options.numMessages),
+    maxBytes=maxBytes[0],
+    numProcs=_parseSweepNumbers(parser, "--procs", options.numProcs),
+    deliveryConfirmation=_parseSweepSwitches(parser, "--pubacks",
+                                             options.deliveryConfirmation),
+    confirmWindow=_parseSweepNumbers(parser, "--confirm-window",
+                                     options.confirmWindow),
+    prefetch=_parseSweepNumbers(parser, "--prefetch", options.prefetch,
+                                minimum=0),
+    noAck=_parseSweepSwitches(parser, "--no-ack", options.noAck),
+    ackBatch=_parseSweepNumbers(parser, "--ack-batch", options.ackBatch),
+    useConsumerAcks=_parseSweepSwitches(parser, "--conacks",
+                                        options.useConsumerAcks),
+    durationKwargs=getDurationKwargs(options))
+
+  results = runSweep(
+    cells,
+    scenario=options.scenario,
+    exchange=options.exchange,
+    brokerMode=options.broker,
+    cooldown=options.cooldown,
+    outputPrefix=options.outputPrefix)
+
+  columns = list(SWEEP_COLUMNS)
+  columns[4:4] = SWEEP_PARAM_COLUMNS[options.scenario]
+  if options.duration is not None:
+    columns.extend(STEADY_STATE_COLUMNS)
+  printResultsTable(results, columns)
+
+
+
+def _parseSweepNumbers(parser, optionName, value, minimum=1):
+  """Parses a comma-separated list of numbers and log-spaced ranges
+  MIN..MAX[*FACTOR], with optional K/M/G suffixes
+
+  :returns: list of ints in the given order, without duplicates
+  """
+  def parseNumber(text):
+    text = text.strip().upper()
+    multiplier = 1
+    if text and text[-1] in "KMG":
+      multiplier = 1024 ** ("KMG".index(text[-1]) + 1)
+      text = text[:-1]
+    return int(text) * multiplier
+
+  numbers = []
+  try:
+    for item in value.split(","):
+      if ".." not in item:
+        numbers.append(parseNumber(item))
+        continue
+
+      low, high = item.split("..")
+      factor = 2
+      if "*" in high:
+        high, factor = high.split("*")
+        factor = int(factor)
+      low, high = parseNumber(low), parseNumber(high)
+      if low < 1 or factor < 2:
+        raise ValueError(item)
+      while low <= high:
+        numbers.append(low)
+        low *= factor
+  except ValueError:
+    parser.error("Invalid %s value %r" % (optionName, value))
+
+  if not numbers or min(numbers) < minimum:
+    parser.error("%s values must be at least %d, but got %r"
+                 % (optionName, minimum, value))
+
+  return sorted(set(numbers), key=numbers.index)
+
+
+
+def _parseSweepSwitches(parser, optionName, value):
+  """Parses a comma-separated list of on/off values
+
+  :returns: list of bools
+  """
+  switches = []
+  for item in value.split(","):
+    item = item.strip().lower()
+    if item not in ("on", "off"):
+      parser.error("%s takes comma-separated on/off values, but got %r"
+                   % (optionName, value))
+    switches.append(item == "on")
+  return sorted(set(switches), key=switches.index)
+
+
+
+def buildSweepCells(scenario, adapters, messageSizes, numMessages, maxBytes,
+                    numProcs, deliveryConfirmation, confirmWindow, prefetch,
+                    noAck, ackBatch, useConsumerAcks, durationKwargs=None):
+  """Enumerates the runs of a sweep; parameters that don't apply to the given
+  scenario are ignored, and combinations that would be redundant (e.g.,
+  confirm windows without pubacks) or would stall (an ack batch that exceeds
+  the prefetch) are skipped.
+
+  :param durationKwargs: optional duration-mode args from getDurationKwargs()
+    for every run of the publish or altpubcons scenario
+
+  :returns: list of (numProcs, kwargs) pairs, where kwargs are the scenario
+    function's args other than brokerAddress and exchange
+  """
+  cells = []
+
+  for adapterClass, size, msgs, procs in itertools.product(
+      adapters, messageSizes, numMessages, numProcs):
+    if maxBytes and size * msgs > maxBytes:
+      msgs = max(1, maxBytes // size)
+
+    common = dict(adapterClass=adapterClass, messageSize=size,
+                  numMessages=msgs, **(durationKwargs or {}))
+
+    if scenario == "publish":
+      for pubacks in deliveryConfirmation:
+        windows = confirmWindow
+        if not pubacks or adapterClass.STOP_AND_WAIT_CONFIRMS:
+          windows = [1]
+        for window in windows:
+          cells.append((procs, dict(common, deliveryConfirmation=pubacks,
+                                    confirmWindow=window)))
+
+    elif scenario == "consume":
+      for qos, noAckMode in itertools.product(prefetch, noAck):
+        for batch in ([1] if noAckMode else ackBatch):
+          if not noAckMode and qos and batch > qos:
+            continue
+          cells.append((procs, dict(common, prefetch=qos, noAck=noAckMode,
+                                    ackBatch=batch)))
+
+    else:
+      for pubacks, conacks in itertools.product(deliveryConfirmation,
+                                                useConsumerAcks):
+        cells.append((procs, dict(common, deliveryConfirmation=pubacks,
+                                  useConsumerAcks=conacks)))
+
+  # Drop duplicates resulting from the message count cap
+  uniqueCells = []
+  for cell in cells:
+    if cell not in uniqueCells:
+      uniqueCells.append(cell)
+
+  return uniqueCells
+
+
+
+def runSweep(cells, scenario, exchange, brokerMode, cooldown, outputPrefix):
+  """Runs each sweep cell in fresh worker processes against a fresh embedded
+  broker (unless brokerMode is external), appending each result to
+  outputPrefix.jsonl as it completes and writing outputPrefix.csv at the end
+
+  :param cells: list of (numProcs, kwargs) pairs from buildSweepCells()
+  :returns: list of result dicts
+  """
+  scenarioFunc = SWEEP_SCENARIOS[scenario]
+  exchanges = [] if exchange is None else [exchange]
+
+  results = []
+
+  jsonPath = outputPrefix + ".jsonl"
+  with open(jsonPath, "w") as jsonFile:
+    for i, (numProcs, kwargs) in enumerate(cells):
+      if i and cooldown:
+        time.sleep(cooldown)
+
+      g_log.info("Sweep run %d of %d: scenario=%s; numProcs=%d; %s", i + 1,
+                 len(cells), scenario, numProcs, kwargs)
+
+      if scenario == "publish":
+        kwargs = dict(kwargs, exchange=exchange)
+
+      with embedded_broker.brokerContext(brokerMode,
+                                         exchanges=exchanges) as brokerAddress:
+        result = runScenarioInProcesses(numProcs, scenarioFunc, isolate=True,
+                                        brokerAddress=brokerAddress, **kwargs)
+
+      result = dict((key, value) for key, value in result.items()
+                    if key != "histograms")
+      result["scenario"] = scenario
+      results.append(result)
+
+      jsonFile.write(json.dumps(result, sort_keys=True) + "\n")
+      jsonFile.flush()
+
+  csvPath = outputPrefix + ".csv"
+  allKeys = set(itertools.chain.from_iterable(results))
+  fieldNames = [key for key in SWEEP_CSV_FIELDS if key in allKeys]
+  fieldNames.extend(sorted(allKeys.difference(SWEEP_CSV_FIELDS, ["error"])))
+  fieldNames.append("error")
+  with open(csvPath, "wb") as csvFile:
+    writer = csv.DictWriter(csvFile, fieldNames)
+    writer.writerow(dict(zip(fieldNames, fieldNames)))
+    writer.writerows(results)
+
+  g_log.info("Wrote %d sweep results to %s and %s", len(results), jsonPath,
+             csvPath)
+
+  return results
+
+
+
+def _handleFindMaxCommand(args):
+  """ Parse args and search for the highest sustainable offered rate of each
+  selected client under a latency SLO
+
+  :param args: sequence of commandline args passed after the "findmax"
+    keyword
+  """
+  helpString = (
+    "\n"
+    "\t%prog findmax OPTIONS\n"
+    "\t%prog findmax --help\n"
+    "\t%prog --help\n"
+    "\n"
+    "Runs the publish (with pubacks) or altpubcons scenario open-loop at\n"
+    "varying offered rates and finds the highest rate that each selected\n"
+    "client interface sustains: the achieved rate keeps up with the offered\n"
+    "one and the given percentile of confirm (publish) or round-trip\n"
+    "(altpubcons) latency stays within --slo-ms. The rate is doubled from\n"
+    "--min-rate until a run fails, and then binary-searched.")
+
+  parser = OptionParser(helpString)
+
+  parser.add_option(
+      "--scenario",
+      action="store",
+      type="choice",
+      dest="scenario",
+      choices=sorted(FINDMAX_LATENCY_PREFIXES),
+      default="publish",
+      help=("Scenario to run; one of: %s [default: %%default]"
+            % ", ".join(sorted(FINDMAX_LATENCY_PREFIXES))))
+
+  addClientsOption(parser)
+
+  parser.add_option(
+      "--exg",
+      action="store",
+      type="string",
+      dest="exchange",
+      help="Destination exchange [REQUIRED for the publish scenario]")
+
+  parser.add_option(
+      "--size",
+      action="store",
+      type="int",
+      dest="messageSize",
+      default=1024,
+      help="Size of each message in bytes [default: %default]")
+
+  perf_stats.addConfirmWindowOption(parser)
+
+  parser.add_option(
+    "--conacks",
+    action="store_true",
+    dest="useConsumerAcks",
+    default=False,
+    help="Ack consumed messages in the altpubcons scenario [defaults to OFF]")
+
+  parser.add_option(
+      "--pubacks",
+      action="store_true",
+      dest="deliveryConfirmation",
+      default=False,
+      help=("Publish in delivery confirmation mode in the altpubcons scenario; "
+            "the publish scenario always does [defaults to OFF]"))
+
+  parser.add_option(
+      "--slo-ms",
+      action="store",
+      type="float",
+      dest="sloMillis",
+      help="Latency objective in milliseconds [REQUIRED]")
+
+  parser.add_option(
+      "--percentile",
+      action="store",
+      type="float",
+      dest="percentile",
+      default=99,
+      help="Latency percentile that must meet --slo-ms [default: %default]")
+
+  parser.add_option(
+      "--tolerance",
+      action="store",
+      type="float",
+      dest="tolerance",
+      default=0.95,
+      help=("Minimum ratio of achieved to offered rate of a sustainable run "
+            "[default: %default]"))
+
+  parser.add_option(
+      "--min-rate",
+      action="store",
+      type="float",
+      dest="minRate",
+      default=100,
+      help="Offered rate of the first run in msgs/s [default: %default]")
+
+  parser.add_option(
+      "--max-rate",
+      action="store",
+      type="float",
+      dest="maxRate",
+      default=None,
+      help="Highest offered rate to try in msgs/s [default: no limit]")
+
+  parser.add_option(
+      "--precision",
+      action="store",
+      type="float",
+      dest="precision",
+      default=0.05,
+      help=("Stop once the lowest failing rate is within this fraction above "
+            "the highest sustainable one [default: %default]"))
+
+  addProcsOption(parser)
+
+  addDurationOptions(parser)
+  parser.set_defaults(duration=5.0, warmup=1.0)
+
+  embedded_broker.addBrokerOption(parser)
+
+  options, positionalArgs = parser.parse_args(args)
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  if options.scenario == "publish" and options.exchange is None:
+    parser.error("--exg must be specified with a valid destination exchange "
+                 "name for the publish scenario")
+
+  if options.sloMillis is None or options.sloMillis <= 0:
+    parser.error("--slo-ms is required and must be positive")
+
+  if not 0 < options.percentile <= 100:
+    parser.error("--percentile must be in (0, 100]")
+
+  if not 0 < options.tolerance <= 1:
+    parser.error("--tolerance must be in (0, 1]")
+
+  if options.minRate <= 0:
+    parser.error("--min-rate must be positive")
+
+  if options.maxRate is not None and options.maxRate < options.minRate:
+    parser.error("--max-rate may not be less than --min-rate")
+
+  if options.precision <= 0:
+    parser.error("--precision must be positive")
+
+  checkDurationOptions(parser, options)
+
+  adapters = selectAdapters(parser, options.clients)
+
+  scenarioKwargs = dict(messageSize=options.messageSize,
+                        numMessages=0,
+                        **getDurationKwargs(options))
+  if options.scenario == "publish":
+    scenarioFunc = runPublishScenario
+    scenarioKwargs.update(exchange=options.exchange,
+                          deliveryConfirmation=True)
+  else:
+    scenarioFunc = runAltPubConsScenario
+    scenarioKwargs.update(useConsumerAcks=options.useConsumerAcks,
+                          deliveryConfirmation=options.deliveryConfirmation)
+
+  latencyPrefix = FINDMAX_LATENCY_PREFIXES[options.scenario]
+  slo = options.sloMillis / 1000.0
+
+  results = []
+  exchanges = [] if options.exchange is None else [options.exchange]
+  with embedded_broker.brokerContext(options.broker,
+                                     exchanges=exchanges) as brokerAddress:
+    for adapterClass in adapters:
+      kwargs = dict(scenarioKwargs, adapterClass=adapterClass,
+                    brokerAddress=brokerAddress)
+      if options.scenario == "publish":
+        kwargs["confirmWindow"] = (1 if adapterClass.STOP_AND_WAIT_CONFIRMS
+                                   else options.confirmWindow)
+
+      def probe(rate):
+        result = runScenarioInProcesses(options.numProcs, scenarioFunc,
+                                        rate=rate / options.numProcs,
+                                        **kwargs)
+        return _checkFindMaxProbe(result, latencyPrefix, options.percentile,
+                                  slo, options.tolerance), result
+
+      best, numProbes = findMaxRate(probe, options.minRate, options.maxRate,
+                                    options.precision)
+
+      summary = dict(client=adapterClass.getName(),
+                     numProcs=options.numProcs,
+                     messageSize=options.messageSize,
+                     confirmWindow=kwargs.get("confirmWindow"),
+                     sloMillis=options.sloMillis,
+                     numProbes=numProbes)
+      if best is None:
+        g_log.warning("%s: not sustainable even at --min-rate=%s",
+                      summary["client"], options.minRate)
+      else:
+        summary.update(
+          maxRate=best["offeredRate"],
+          msgsPerSec=best["msgsPerSec"],
+          latency=best["histograms"][latencyPrefix].percentile(
+            options.percentile))
+        g_log.info("%s sustains %.0f msgs/s at p%g < %gms for %d-byte "
+                   "messages", summary["client"], summary["maxRate"],
+                   options.percentile, options.sloMillis, options.messageSize)
+      results.append(summary)
+
+  columns = list(FINDMAX_COLUMNS)
+  if options.scenario == "publish":
+    columns.insert(3, CONFIRM_WINDOW_COLUMN)
+  latencyColumn = ("p%g(ms)" % (options.percentile,), "latency",
+                   _formatMillis)
+  columns.insert(columns.index(FINDMAX_COLUMNS[-1]), latencyColumn)
+  printResultsTable(results, columns)
+
+
+
+def _checkFindMaxProbe(result, latencyPrefix, percentile, slo, tolerance):
+  """
+  :returns: True if the open-loop scenario result meets the latency SLO and
+    the achieved rate keeps up with the offered one
+  """
+  if result["error"]:
+    g_log.warning("findmax run at %.0f msgs/s failed: %s",
+                  result.get("offeredRate", 0), result["error"])
+    return False
+
+  latency = result["histograms"][latencyPrefix].percentile(percentile)
+  achieved = result["msgsPerSec"] / result["offeredRate"]
+  passed = latency is not None and latency <= slo and achieved >= tolerance
+
+  g_log.info("findmax: %s at %.0f msgs/s: achieved %.0f msgs/s (%.1f%%); "
+             "p%g=%.3fms: %s", result["client"], result["offeredRate"],
+             result["msgsPerSec"], achieved * 100, percentile,
+             (latency or 0) * 1000, "PASS" if passed else "FAIL")
+  return passed
+
+
+
+def findMaxRate(probe, minRate, maxRate, precision):
+  """Finds the highest rate that passes the given probe, assuming that all
+  lower rates pass too
+
+  Starting from minRate, the rate is doubled until a probe fails or maxRate
+  is reached, and then the interval between the highest passing and lowest
+  failing rates is bisected until its width is within the given fraction of
+  the former.
+
+  :param probe: probe(rate) -> (passed, result)
+  :param maxRate: highest rate to probe; None for no limit
+  :returns: (result of the highest passing probe or None if minRate fails,
+    number of probes made)
+  """
+  best = None
+  # Highest passing and lowest failing rates so far
+  low = high = None
+  numProbes = 0
+
+  rate = minRate
+  while True:
+    numProbes += 1
+    passed, result = probe(rate)
+    if passed:
+      best, low = result, rate
+    else:
+      high = rate
+
+    if low is None:
+      return None, numProbes
+
+    if high is None:
+      if maxRate is not None and low >= maxRate:
+        return best, numProbes
+      rate = low * 2 if maxRate is None else min(low * 2, maxRate)
+    elif high <= low * (1 + precision):
+      return best, numProbes
+    else:
+      rate = (low + high) / 2.0
+
+
+
+def addDurationOptions(parser):
+  """Adds the --duration, --warmup, --interval and --steady-cv options to the
+  given OptionParser
+  """
+  parser.add_option(
+      "--duration",
+      action="store",
+      type="float",
+      dest="duration",
+      default=None,
+      help=("Run for this many seconds after the warmup instead of sending "
+            "--msgs messages, sampling throughput in fixed intervals and "
+            "reporting the rate of the steady-state window [default: use "
+            "--msgs]"))
+
+  parser.add_option(
+      "--warmup",
+      action="store",
+      type="float",
+      dest="warmup",
+      default=0,
+      help=("With --duration, seconds to run before measuring; its messages "
+            "and latencies are discarded [default: %default]"))
+
+  parser.add_option(
+      "--interval",
+      action="store",
+      type="float",
+      dest="sampleInterval",
+      default=1.0,
+      help=("With --duration, length of each throughput sample in seconds "
+            "[default: %default]"))
+
+  parser.add_option(
+      "--steady-cv",
+      action="store",
+      type="float",
+      dest="steadyCv",
+      default=DEFAULT_STEADY_CV,
+      help=("With --duration, the steady state is the longest trailing run of "
+            "intervals whose coefficient of variation (stdev/mean) of "
+            "throughput is within this threshold [default: %default]"))
+
+
+
+def checkDurationOptions(parser, options):
+  """Validates the options added by addDurationOptions()"""
+  if options.duration is not None and options.duration <= 0:
+    parser.error("--duration must be positive")
+  if options.warmup < 0:
+    parser.error("--warmup may not be negative")
+  if options.sampleInterval <= 0:
+    parser.error("--interval must be positive")
+  if options.steadyCv <= 0:
+    parser.error("--steady-cv must be positive")
+
+
+
+def getDurationKwargs(options):
+  """
+  :returns: the duration-mode args of runPublishScenario() and
+    runAltPubConsScenario() from the options added by addDurationOptions();
+    empty if --duration wasn't given
+  """
+  if options.duration is None:
+    return {}
+  return dict(duration=options.duration,
+              warmup=options.warmup,
+              sampleInterval=options.sampleInterval,
+              steadyCv=options.steadyCv)
+
+
+
+def addPhasesOption(parser):
+  """Adds the --phases option to the given OptionParser"""
+  parser.add_option(
+      "--phases",
+      action="store_true",
+      dest="printPhases",
+      default=False,
+      help=("Also print the elapsed and CPU time of each phase of each run "
+            "(import, connect, channel open, confirm.select, publish, drain, "
+            "close, etc.) [defaults to OFF]"))
+
+
+
+def getRunFileKwargs(options, adapterClass, runNumber):
+  """
+  :param runNumber: number of the run within the command, for unique file
+    names
+  :returns: the profile and recording args of the scenario functions from the
+    options added by perf_profile.addProfileOptions() and
+    addRecordingOptions(); empty if neither was given
+  """
+  kwargs = {}
+  runName = "%s-%d" % (adapterClass.getName().replace(":", "-"), runNumber)
+  if options.profile is not None:
+    kwargs["profile"] = (options.profile,
+                         "%s-%s" % (options.profileOutput, runName))
+  if options.record is not None:
+    kwargs["recording"] = (RECORD, "%s-%s.stream" % (options.record, runName))
+  elif options.replay is not None:
+    kwargs["recording"] = (REPLAY, "%s-%s.stream" % (options.replay, runName))
+  return kwargs
+
+
+
+def addIoStatsOption(parser):
+  """Adds the --io-stats option to the given OptionParser"""
+  parser.add_option(
+      "--io-stats",
+      action="store_true",
+      dest="ioStats",
+      default=False,
+      help=("Count the send/recv calls, bytes and AMQP frames of the clients' "
+            "sockets during the timed interval and print the distributions "
+            "of send sizes and frames per send [defaults to OFF]"))
+
+
+
+def addRecordingOptions(parser):
+  """Adds the --record and --replay options to the given OptionParser"""
+  parser.add_option(
+      "--record",
+      action="store",
+      type="string",
+      dest="record",
+      default=None,
+      help=("Save the bytes that each run's client receives from the broker "
+            "to PREFIX-CLIENT-RUN.stream for --replay [default: don't "
+            "record]"))
+
+  parser.add_option(
+      "--replay",
+      action="store",
+      type="string",
+      dest="replay",
+      default=None,
+      help=("Feed each run's client the bytes saved by --record with the "
+            "same PREFIX and otherwise the same options from memory instead "
+            "of connecting to a broker, which measures only the client's own "
+            "parsing and dispatch of the broker's frames; what the client "
+            "sends is discarded [default: use a broker]"))
+
+
+
+def checkRecordingOptions(parser, options):
+  """Validates the options added by addRecordingOptions(); --replay runs don't
+  use a broker
+  """
+  if options.record is None and options.replay is None:
+    return
+  if options.record is not None and options.replay is not None:
+    parser.error("--record and --replay are mutually exclusive")
+  if options.numProcs > 1:
+    parser.error("--record and --replay require --procs=1")
+  if getattr(options, "duration", None) is not None:
+    # The number of messages, and hence the recording, varies from run to run
+    parser.error("--record and --replay may not be combined with --duration")
+  if options.replay is not None:
+    options.broker = embedded_broker.BROKER_EXTERNAL
+
+
+
+def addMemTraceOption(parser):
+  """Adds the --memtrace option to the given OptionParser"""
+  parser.add_option(
+      "--memtrace",
+      action="store_true",
+      dest="memTrace",
+      default=False,
+      help=("Sample the RSS during the timed interval (with the number of "
+            "unconfirmed messages in --pubacks mode), and report the peak, "
+            "the memory allocated per message and the top allocation sites; "
+            "tracemalloc, where available, slows the run down "
+            "[defaults to OFF]"))
+
+
+
+def getPayloadColumns(options):
+  """
+  :returns: the columns of the options added by
+    perf_payload.addPayloadOptions(); empty if both are the defaults
+  """
+  columns = []
+  if options.payloadMode != perf_payload.REUSED:
+    columns.append(PAYLOAD_COLUMN)
+  if options.sizeDistribution != perf_payload.FIXED:
+    columns.extend(SIZE_DISTRIBUTION_COLUMNS)
+  return columns
+
+
+
+def addRateOption(parser):
+  """Adds the --rate option to the given OptionParser"""
+  parser.add_option(
+      "--rate",
+      action="store",
+      type="float",
+      dest="rate",
+      default=None,
+      help=("Offered load in messages per second, split evenly among the "
+            "--procs workers. Messages are sent on a fixed schedule "
+            "regardless of how long earlier ones took (open loop), and "
+            "latencies are measured from the scheduled send times "
+            "[default: send as fast as possible]"))
+
+
+
+def getRateKwargs(parser, options):
+  """
+  :returns: the rate arg of runPublishScenario() and runAltPubConsScenario()
+    for each worker process (or thread) from the --rate, --procs and
+    --threads options; empty if --rate wasn't given
+  """
+  if options.rate is None:
+    return {}
+  if options.rate <= 0:
+    parser.error("--rate must be positive")
+  numThreads = getattr(options, "numThreads", None) or 1
+  return dict(rate=options.rate / (options.numProcs * numThreads))
+
+
+
+def addProcsOption(parser):
+  """Adds the --procs option to the given OptionParser"""
+  parser.add_option(
+      "--procs",
+      action="store",
+      type="int",
+      dest="numProcs",
+      default=1,
+      help=("Number of worker processes, each running the scenario with its "
+            "own connection in parallel; the message counts and throughput "
+            "of the resulting rows are totals across the workers "
+            "[default: %default]"))
+
+
+
+def addThreadsOptions(parser):
+  """Adds the --threads and --thread-mode options to the given OptionParser"""
+  parser.add_option(
+      "--threads",
+      action="store",
+      type="int",
+      dest="numThreads",
+      default=None,
+      help=("Number of threads publishing at once in this process, each "
+            "sending --msgs messages, to see whether threads of blocking "
+            "clients scale or contend on the GIL; the row reports the "
+            "process's CPU use per second and the CPU time of each thread "
+            "[default: no threads]"))
+
+  parser.add_option(
+      "--thread-mode",
+      action="store",
+      type="choice",
+      dest="threadMode",
+      choices=THREAD_MODES,
+      default=None,
+      help=("How the --threads share connections: %s - each thread runs the "
+            "scenario with connections of its own; %s - the threads hand "
+            "their messages off through a thread-safe queue to the main "
+            "thread, which publishes them on one connection "
+            "[default: %s]" % (OWN_CONNECTION, SHARED_CONNECTION,
+                                OWN_CONNECTION)))
+
+
+
+def checkThreadsOptions(parser, options):
+  """Validates the options added by addThreadsOptions(); sets the default
+  --thread-mode if --threads was given
+  """
+  if options.numThreads is None:
+    if options.threadMode is not None:
+      parser.error("--thread-mode requires --threads")
+    return
+
+  if options.numThreads < 1:
+    parser.error("--threads must be at least 1")
+  if options.threadMode is None:
+    options.threadMode = OWN_CONNECTION
+
+  if options.numProcs > 1:
+    parser.error("--threads requires --procs=1")
+  if (options.profile is not None or options.ioStats or options.memTrace or
+      options.gc is not None or options.record is not None or
+      options.replay is not None):
+    # Their hooks and measurements are process-wide
+    parser.error("--threads may not be combined with --profile, --io-stats, "
+                 "--memtrace, --gc, --record or --replay")
+  if options.threadMode == SHARED_CONNECTION and (
+      options.duration is not None or options.rate is not None or
+      options.numConnections > 1 or options.channelsPerConnection > 1):
+    parser.error("--thread-mode=%s may not be combined with --duration, "
+                 "--rate, --connections or --channels-per-conn"
+                 % (SHARED_CONNECTION,))
+
+
+
+def addChannelsOptions(parser):
+  """Adds the --connections, --channels-per-conn and --distribution options
+  to the given OptionParser
+  """
+  parser.add_option(
+      "--connections",
+      action="store",
+      type="int",
+      dest="numConnections",
+      default=1,
+      help="Number of connections per process [default: %default]")
+
+  parser.add_option(
+      "--channels-per-conn",
+      action="store",
+      type="int",
+      dest="channelsPerConnection",
+      default=1,
+      help="Number of channels per connection [default: %default]")
+
+  parser.add_option(
+      "--distribution",
+      action="store",
+      type="choice",
+      dest="distribution",
+      choices=[ROUND_ROBIN, DEDICATED],
+      default=ROUND_ROBIN,
+      help=("How messages are spread over the channels: %s rotates through "
+            "them message by message; %s gives each channel a contiguous "
+            "share of the messages [default: %%default]"
+            % (ROUND_ROBIN, DEDICATED)))
+
+
+
+def loadAdapters():
+  """Imports the adapter modules of the installed client libraries
+
+  :returns: (adapters, failedModules) tuple, where adapters is a list of
+    client_adapter.ClientAdapter subclasses and failedModules is a list of
+    (moduleName, ImportError) pairs for libraries that aren't installed
+  """
+  adapters = []
+  failedModules = []
+  for moduleName in ADAPTER_MODULES:
+    startTime = time.time()
+    startCpuTimes = perf_stats.getCpuTimes()
+    try:
+      module = importlib.import_module(moduleName)
+      g_importTimes.setdefault(
+        moduleName,
+        (time.time() - startTime, perf_stats.getCpuTimes(since=startCpuTimes)))
+    except ImportError as e:
+      g_log.debug("Skipping %s: %r", moduleName, e)
+      failedModules.append((moduleName, e))
+    else:
+      adapters.extend(module.ADAPTERS)
+
+  return adapters, failedModules
+
+
+
+def loadCodecs():
+  """Imports the adapter modules of the installed client libraries
+
+  :returns: list of the client_adapter.FrameCodec subclasses that they provide
+  """
+  loadAdapters()
+  return [sys.modules[moduleName].CODEC for moduleName in ADAPTER_MODULES
+          if getattr(sys.modules.get(moduleName), "CODEC", None) is not None]
+
+
+
+def selectAdapters(parser, clients):
+  """
+  :param parser: OptionParser for reporting errors
+  :param clients: value of the --clients option
+  :returns: the requested available adapter classes, in the order given
+  """
+  adapters, failedModules = loadAdapters()
+  available = [a for a in adapters if a.isAvailable()]
+
+  if not clients:
+    if not available:
+      parser.error("No client libraries are installed: %s" % (failedModules,))
+    return available
+
+  selected = []
+  for spec in clients.split(","):
+    spec = spec.strip()
+    matches = [a for a in available
+               if spec in (a.LIBRARY, a.getName()) and a not in selected]
+    if not matches:
+      parser.error("Unknown or unavailable client %r; available: %s" % (
+        spec, ", ".join(a.getName() for a in available)))
+    selected.extend(matches)
+
+  return selected
+
+
+
+def runPublishScenario(adapterClass,
+                       brokerAddress,
+                       exchange,
+                       numMessages,
+                       messageSize,
+                       deliveryConfirmation,
+                       confirmWindow=1,
+                       txBatch=None,
+                       numConnections=1,
+                       channelsPerConnection=1,
+                       distribution=ROUND_ROBIN,
+                       duration=None,
+                       warmup=0,
+                       sampleInterval=1.0,
+                       steadyCv=DEFAULT_STEADY_CV,
+                       rate=None,
+                       payloadMode=perf_payload.REUSED,
+                       sizeDistribution=(perf_payload.FIXED, None),
+                       profile=None,
+                       ioStats=False,
+                       recording=None,
+                       memTrace=False,
+                       gcMode=None,
+                       startGate=None):
+  """Publishes the given number of messages via one client interface
+
+  The timed interval spans the publish loop, waiting for any outstanding
+  confirms and closing the channels (which flushes the output of clients that
+  buffer it).
+
+  With a duration, messages are published until it elapses instead, and the
+  reported throughput is the publish rate of the steady-state window that
+  _addDurationThroughput() finds.
+
+  With a rate, publishing is open-loop: each message is due at a fixed
+  interval from the start, and the client's I/O is pumped while waiting for
+  that time. Confirm latencies are measured from the due time, and the delay
+  of each publish call past its due time is recorded under the "lag." prefix.
+
+  :param confirmWindow: maximum number of unconfirmed messages in flight per
+    channel in deliveryConfirmation mode
+  :param txBatch: if not None, the number of publishes per transaction: each
+    channel is put in transactional mode, and every txBatch'th publish on it
+    is followed by a tx.commit; the latencies from the publish calls to the
+    commits are recorded under the "commit." prefix. Exclusive with
+    deliveryConfirmation.
+  :param numConnections: number of connections to open
+  :param channelsPerConnection: number of channels to open on each connection
+  :param distribution: how messages are spread over the channels: ROUND_ROBIN
+    or DEDICATED
+  :param duration: if not None, seconds to publish for after the warmup;
+    numMessages is ignored and distribution must be ROUND_ROBIN
+  :param warmup: seconds to publish for before measuring in duration mode
+  :param sampleInterval: seconds per throughput sample in duration mode
+  :param steadyCv: coefficient of variation threshold of the steady-state
+    detector in duration mode
+  :param rate: if not None, messages per second to publish at
+  :param payloadMode: how the message bodies are made; one of
+    perf_payload.PAYLOAD_MODES
+  :param sizeDistribution: perf_payload.parseSizeDistribution() result; the
+    reported messageSize is the mean unless it's FIXED
+  :param profile, ioStats, recording, memTrace, gcMode: instruments of the
+    timed interval; see _Instrumentation
+  :param startGate: if not None, StartGate to wait on once the channels are
+    ready
+
+  :returns: result dict for printResultsTable
+  """
+  clientName = adapterClass.getName()
+
+  g_log.info(
+    "runPublishScenario: client=%s; exchange=%s; numMessages=%d; "
+    "messageSize=%s; deliveryConfirmation=%s; confirmWindow=%s; "
+    "txBatch=%s; numConnections=%s; channelsPerConnection=%s; "
+    "distribution=%s; duration=%s; warmup=%s; rate=%s", clientName, exchange,
+    numMessages, messageSize, deliveryConfirmation, confirmWindow, txBatch,
+    numConnections, channelsPerConnection, distribution, duration, warmup,
+    rate)
+
+  if txBatch is not None and deliveryConfirmation:
+    raise ValueError("A channel can't be in both transactional and confirm "
+                     "mode")
+
+  result = dict(client=clientName,
+                numMessages=numMessages,
+                messageSize=messageSize,
+                deliveryConfirmation=deliveryConfirmation,
+                confirmWindow=confirmWindow,
+                txBatch=txBatch,
+                numConnections=numConnections,
+                channelsPerConnection=channelsPerConnection,
+                distribution=distribution,
+                error=None)
+  if txBatch is not None:
+    result["confirmWindow"] = None
+
+  payloads = _createPayloads(result, messageSize, payloadMode,
+                             sizeDistribution)
+
+  # Delays of open-loop publish calls past their due times
+  lags = perf_stats.LatencyHistogram()
+
+  adapters = []
+  # (adapter, ChannelHandle, ConfirmTracker) of each channel
+  channels = []
+  # ChannelHandle -> perf_stats.TransactionTracker in txBatch mode
+  transactions = {}
+
+  phases = _startPhaseTimer(adapterClass)
+
+  getOutstanding = None
+  if deliveryConfirmation:
+    getOutstanding = lambda: sum(confirms.numOutstanding
+                                 for _adapter, _channel, confirms in channels)
+  instruments = _Instrumentation(adapterClass, profile, ioStats, recording,
+                                 memTrace, gcMode, getOutstanding, startGate)
+
+  try:
+    for _ in xrange(numConnections):
+      adapter = adapterClass(brokerAddress)
+      instruments.connect(adapter, deliveryConfirmation)
+      adapters.append(adapter)
+      phases.lap("connect")
+
+      for _ in xrange(channelsPerConnection):
+        channel = adapter.openChannel()
+        phases.lap("openChannel")
+        confirms = perf_stats.ConfirmTracker()
+        if deliveryConfirmation:
+          adapter.enableConfirms(channel, confirms.onAck, confirms.onNack)
+          phases.lap("confirmSelect")
+        if txBatch is not None:
+          adapter.selectTransactions(channel)
+          transactions[channel] = perf_stats.TransactionTracker()
+          phases.lap("txSelect")
+        channels.append((adapter, channel, confirms))
+
+    g_log.info("%s: opened %d connection(s) with %d channel(s) each; "
+               "deliveryConfirmation=%s; txBatch=%s", clientName,
+               numConnections, channelsPerConnection, deliveryConfirmation,
+               txBatch)
+
+    if startGate is not None:
+      startGate.wait()
+      phases.restart()
+
+    limiter = None
+    if rate is not None:
+      limiter = perf_stats.RateLimiter(rate)
+
+    timer = None
+    if duration is not None:
+      def onWarmupEnd():
+        lags.reset()
+        for _adapter, _channel, confirms in channels:
+          confirms.histogram.reset()
+        for tracker in transactions.values():
+          tracker.histogram.reset()
+        instruments.onWarmupEnd()
+
+      timer = perf_stats.DurationTimer(duration, warmup, sampleInterval,
+                                       onWarmupEnd=onWarmupEnd)
+      numMessages = None
+
+    instruments.start()
+    startTime = time.time()
+    startCpuTimes = perf_stats.getCpuTimes()
+    if limiter is not None:
+      limiter.start()
+    if timer is not None:
+      timer.start()
+
+    sendTime = None
+    for adapter, channel, confirms in _scheduleChannels(channels, numMessages,
+                                                        distribution):
+      if limiter is not None:
+        sendTime = limiter.nextSendTime()
+        _pumpUntil(adapter, sendTime)
+      if deliveryConfirmation and confirms.numOutstanding >= confirmWindow:
+        adapter.waitUntil(lambda: confirms.numOutstanding < confirmWindow)
+      if timer is not None and not timer.tick():
+        break
+      if limiter is not None:
+        lags.record(time.time() - sendTime)
+      if deliveryConfirmation:
+        confirms.onPublish(sendTime)
+      if txBatch is not None:
+        transactions[channel].onPublish(sendTime)
+      adapter.publish(channel, exchange, ROUTING_KEY, next(payloads))
+      if (txBatch is not None and
+          transactions[channel].numUncommitted >= txBatch):
+        adapter.commit(channel)
+        transactions[channel].onCommit()
+
+    phases.lap("publish")
+
+    for adapter, channel, confirms in channels:
+      if deliveryConfirmation:
+        adapter.waitUntil(lambda: not confirms.numOutstanding)
+        phases.lap("drain")
+      if txBatch is not None and transactions[channel].numUncommitted:
+        adapter.commit(channel)
+        transactions[channel].onCommit()
+        phases.lap("commit")
+      adapter.closeChannel(channel)
+      phases.lap("closeChannel")
+
+    elapsed = time.time() - startTime
+    cpuTimes = perf_stats.getCpuTimes(since=startCpuTimes)
+    instruments.stop()
+
+    g_log.info("%s: published %s messages of size=%d in %.3fs", clientName,
+               numMessages if timer is None else "timed", messageSize,
+               elapsed)
+
+    for adapter in adapters:
+      adapter.close()
+    phases.lap("close")
+    g_log.info("%s: DONE", clientName)
+
+  except Exception as e:
+    g_log.exception("%s: publish scenario failed", clientName)
+    result["error"] = repr(e)
+    instruments.stop()
+
+  else:
+    if timer is None:
+      _addThroughput(result, elapsed, cpuTimes)
+    else:
+      _addDurationThroughput(result, timer, steadyCv)
+
+    _addPhases(result, phases)
+    instruments.addTo(result)
+
+    histograms = {}
+    if deliveryConfirmation:
+      histogram = perf_stats.LatencyHistogram()
+      for _adapter, _channel, confirms in channels:
+        histogram.merge(confirms.histogram)
+      histograms["confirm."] = histogram
+    if txBatch is not None:
+      histogram = perf_stats.LatencyHistogram()
+      for tracker in transactions.values():
+        histogram.merge(tracker.histogram)
+      histograms["commit."] = histogram
+    if rate is not None:
+      result["offeredRate"] = rate
+      histograms["lag."] = lags
+    _addHistograms(result, histograms)
+
+  return result
+
+
+
+def runHandOffPublishScenario(adapterClass,
+                              brokerAddress,
+                              exchange,
+                              numThreads,
+                              numMessages,
+                              messageSize,
+                              deliveryConfirmation,
+                              confirmWindow=1,
+                              payloadMode=perf_payload.REUSED,
+                              sizeDistribution=(perf_payload.FIXED, None)):
+  """Publishes the messages of the given number of producer threads via one
+  connection: the producers hand the bodies off through a bounded thread-safe
+  queue to the calling thread, which owns the connection and publishes them,
+  as thread pools that share a client connection do
+
+  The timed interval spans starting the producers to waiting for any
+  outstanding confirms and closing the channel.
+
+  :param numThreads: number of producer threads
+  :param numMessages: number of messages per producer thread
+  :param confirmWindow: maximum number of unconfirmed messages in flight in
+    deliveryConfirmation mode
+  :param payloadMode: how the message bodies are made; one of
+    perf_payload.PAYLOAD_MODES
+  :param sizeDistribution: perf_payload.parseSizeDistribution() result; the
+    reported messageSize is the mean unless it's FIXED
+
+  :returns: result dict for printResultsTable, including the CPU times of the
+    threads; see _addThreadCpu()
+  """
+  clientName = adapterClass.getName()
+
+  g_log.info(
+    "runHandOffPublishScenario: client=%s; exchange=%s; numThreads=%d; "
+    "numMessages=%d; messageSize=%s; deliveryConfirmation=%s; "
+    "confirmWindow=%s", clientName, exchange, numThreads, numMessages,
+    messageSize, deliveryConfirmation, confirmWindow)
+
+  result = dict(client=clientName,
+                numThreads=numThreads,
+                threadMode=SHARED_CONNECTION,
+                numMessages=numThreads * numMessages,
+                messageSize=messageSize,
+                deliveryConfirmation=deliveryConfirmation,
+                confirmWindow=confirmWindow,
+                error=None)
+
+  # Each producer needs an iterator of its own, since generators aren't
+  # thread-safe
+  payloads = [_createPayloads(result, messageSize, payloadMode,
+                              sizeDistribution)
+              for _ in xrange(numThreads)]
+
+  handOff = Queue.Queue(HANDOFF_QUEUE_SIZE)
+  # (user, system) CPU seconds of each producer thread
+  threadCpuTimes = [None] * numThreads
+
+  def produce(index):
+    startCpuTimes = perf_stats.getThreadCpuTimes()
+    try:
+      for _ in xrange(numMessages):
+        handOff.put(next(payloads[index]))
+    finally:
+      # Tells the publishing thread that this producer is done
+      handOff.put(None)
+      if startCpuTimes is not None:
+        threadCpuTimes[index] = perf_stats.getThreadCpuTimes(
+          since=startCpuTimes)
+
+  confirms = perf_stats.ConfirmTracker()
+  producers = []
+
+  try:
+    adapter = adapterClass(brokerAddress)
+    adapter.connect(deliveryConfirmation)
+    channel = adapter.openChannel()
+    if deliveryConfirmation:
+      adapter.enableConfirms(channel, confirms.onAck, confirms.onNack)
+
+    producers = [threading.Thread(target=produce, args=(i,),
+                                  name="Producer-%d" % (i,))
+                 for i in xrange(numThreads)]
+    for producer in producers:
+      producer.daemon = True
+
+    startTime = time.time()
+    startCpuTimes = perf_stats.getCpuTimes()
+    startThreadCpuTimes = perf_stats.getThreadCpuTimes()
+    for producer in producers:
+      producer.start()
+
+    numDone = 0
+    while numDone < numThreads:
+      body = handOff.get()
+      if body is None:
+        numDone += 1
+        continue
+      if deliveryConfirmation:
+        if confirms.numOutstanding >= confirmWindow:
+          adapter.waitUntil(lambda: confirms.numOutstanding < confirmWindow)
+        confirms.onPublish()
+      adapter.publish(channel, exchange, ROUTING_KEY, body)
+
+    if deliveryConfirmation:
+      adapter.waitUntil(lambda: not confirms.numOutstanding)
+    adapter.closeChannel(channel)
+
+    elapsed = time.time() - startTime
+    cpuTimes = perf_stats.getCpuTimes(since=startCpuTimes)
+    publisherCpuTimes = None
+    if startThreadCpuTimes is not None:
+      publisherCpuTimes = perf_stats.getThreadCpuTimes(
+        since=startThreadCpuTimes)
+
+    g_log.info("%s: published %d messages of size=%d from %d threads in "
+               "%.3fs", clientName, result["numMessages"], messageSize,
+               numThreads, elapsed)
+
+    adapter.close()
+    g_log.info("%s: DONE", clientName)
+
+  except Exception as e:
+    g_log.exception("%s: hand-off publish scenario failed", clientName)
+    result["error"] = repr(e)
+
+  else:
+    _addThroughput(result, elapsed, cpuTimes)
+    _addThreadCpu(result, threadCpuTimes)
+    if publisherCpuTimes is not None:
+      result["thread.publisherCpu"] = sum(publisherCpuTimes)
+    if deliveryConfirmation:
+      _addHistograms(result, {"confirm.": confirms.histogram})
+
+  finally:
+    # Unblocks producers stuck on a full queue after a failure
+    while any(producer.is_alive() for producer in producers):
+      try:
+        handOff.get(timeout=0.1)
+      except Queue.Empty:
+        pass
+
+  return result
+
+
+
+def _addThreadCpu(result, threadCpuTimes):
+  """Adds the spread of the threads' CPU seconds (user + system) and the
+  process's CPU seconds per elapsed second to the result of a threaded run.
+  Under the GIL, threads that run Python code add up to little more than 1.0
+  regardless of their number.
+
+  :param threadCpuTimes: (user, system) CPU seconds of each thread; None if
+    unavailable
+  """
+  totals = [sum(cpuTimes) for cpuTimes in threadCpuTimes
+            if cpuTimes is not None]
+  result["thread.cpuMin"] = min(totals) if totals else None
+  result["thread.cpuMean"] = sum(totals) / len(totals) if totals else None
+  result["thread.cpuMax"] = max(totals) if totals else None
+  result["cpuPerSec"] = ((result["cpuUser"] + result["cpuSys"]) /
+                         result["elapsed"] if result["elapsed"] else None)
+
+
+
+def _createPayloads(result, messageSize, payloadMode, sizeDistribution):
+  """Adds the payload settings to a scenario result; the messageSize is the
+  mean of the size distribution unless it's FIXED
+
+  :returns: endless iterator of the message bodies; see
+    perf_payload.PayloadSource
+  """
+  source = perf_payload.PayloadSource(messageSize, payloadMode,
+                                      sizeDistribution)
+  result["payloadMode"] = payloadMode
+  result["sizeDistribution"] = sizeDistribution[0]
+  if sizeDistribution[0] != perf_payload.FIXED:
+    result["messageSize"] = source.meanSize
+    result["maxMessageSize"] = source.maxSize
+  return iter(source)
+
+
+
+def _pumpUntil(adapter, deadline):
+  """Pumps the adapter's I/O until the given time.time() value, so that
+  confirms keep being dispatched while an open-loop sender waits
+  """
+  remaining = deadline - time.time()
+  while remaining > 0:
+    adapter.pump(remaining)
+    remaining = deadline - time.time()
+
+
+
+def _addThroughput(result, elapsed, cpuTimes):
+  """Adds the timed phase's duration, throughput and CPU usage to a scenario
+  result that has numMessages and messageSize
+
+  :param cpuTimes: (user, system) CPU seconds used during the timed phase
+  """
+  result["elapsed"] = elapsed
+  result["msgsPerSec"] = (result["numMessages"] / elapsed if elapsed
+                          else float("inf"))
+  result["mbPerSec"] = (result["msgsPerSec"] * result["messageSize"] /
+                        (1024.0 * 1024))
+  result["cpuUser"], result["cpuSys"] = cpuTimes
+
+
+
+def _addDurationThroughput(result, timer, steadyCv):
+  """Adds the throughput of a duration-based run to a scenario result that has
+  messageSize, replacing its numMessages with the number of messages after
+  the warmup
+
+  :param timer: the run's perf_stats.DurationTimer
+  :param steadyCv: coefficient of variation threshold of the steady-state
+    detector
+  """
+  result["numMessages"] = timer.numMeasured
+  _addThroughput(result, timer.measuredDuration, timer.cpuTimes)
+  result["warmupIntervals"] = timer.warmupIntervals
+  result["sampleInterval"] = timer.interval
+  _addSteadyState(result, timer.getMeasuredRates(), steadyCv)
+
+
+
+def _addSteadyState(result, intervalRates, steadyCv):
+  """Adds per-interval rates and the steady-state detector's verdict to a
+  scenario result, and if a steady window is found, replaces the throughput
+  with that of the window
+
+  :param intervalRates: messages per second in each measured interval
+  """
+  result["intervalRates"] = intervalRates
+  result["steadyCvThreshold"] = steadyCv
+
+  steadyState = perf_stats.findSteadyState(intervalRates, steadyCv)
+  if steadyState is None:
+    g_log.warning("%s: no steady state with cv<=%s in interval rates %s",
+                  result["client"], steadyCv,
+                  ["%.0f" % (rate,) for rate in intervalRates])
+    result["steadyIntervals"] = 0
+    result["steadyCv"] = None
+    return
+
+  first, meanRate, cv = steadyState
+  result["steadyIntervals"] = len(intervalRates) - first
+  result["steadyCv"] = cv
+  result["msgsPerSec"] = meanRate
+  result["mbPerSec"] = meanRate * result["messageSize"] / (1024.0 * 1024)
+
+
+
+def _startPhaseTimer(adapterClass):
+  """
+  :returns: perf_stats.PhaseTimer for the phases of a scenario run, starting
+    with the "import" phase of the adapter's module if loadAdapters() timed
+    it
+  """
+  phases = perf_stats.PhaseTimer()
+  if adapterClass.__module__ in g_importTimes:
+    phases.add("import", *g_importTimes[adapterClass.__module__])
+  return phases
+
+
+
+def _addPhases(result, phases):
+  """Adds the elapsed and CPU seconds of each phase of a scenario run to its
+  result under "phase.NAME." keys, and logs them as a JSON record
+
+  :param phases: the run's perf_stats.PhaseTimer
+  """
+  record = dict(
+    client=result["client"],
+    phases=[dict(phase=name, elapsed=elapsed, cpuUser=cpuUser, cpuSys=cpuSys)
+            for name, (elapsed, cpuUser, cpuSys) in phases.phases.items()])
+  g_log.info("%s: phases: %s", result["client"], json.dumps(record))
+
+  result.update(phases.summary())
+
+
+
+def _addIoRatios(result):
+  """Adds per-call and per-message averages to a scenario result with the
+  "io." counts of socket_stats.SocketStats.summary()
+  """
+  sendCalls = result["io.sendCalls"]
+  recvCalls = result["io.recvCalls"]
+  result["io.sendsPerMsg"] = (sendCalls / float(result["numMessages"])
+                              if result["numMessages"] else None)
+  result["io.bytesPerSend"] = (result["io.sendBytes"] / float(sendCalls)
+                               if sendCalls else None)
+  result["io.meanFramesPerSend"] = (result["io.framesSent"] / float(sendCalls)
+                                    if sendCalls else None)
+  result["io.bytesPerRecv"] = (result["io.recvBytes"] / float(recvCalls)
+                               if recvCalls else None)
+
+
+
+class _Instrumentation(object):
+  """The optional instruments of a scenario run: a profiler, socket I/O
+  counts, a recording or replay of the received bytes, memory tracing and GC
+  monitoring. They cover the timed interval from start() to stop(), except for
+  what they gathered before onWarmupEnd() in duration mode.
+  """
+
+  def __init__(self, adapterClass, profile=None, ioStats=False,
+               recording=None, memTrace=False, gcMode=None,
+               getOutstanding=None, startGate=None):
+    """
+    :param profile: if not None, (mode, pathPrefix) of a perf_profile
+      profiler to run during the timed interval
+    :param ioStats: count the socket I/O of the timed interval; see
+      socket_stats
+    :param recording: if not None, (RECORD, path) to save the bytes that the
+      client receives to, or (REPLAY, path) to feed the client the bytes of
+      such a recording instead of connecting to the broker
+    :param memTrace: track the memory use of the timed interval; see
+      perf_memory
+    :param gcMode: if not None, perf_gc mode to apply during the timed
+      interval, whose garbage collections are reported
+    :param getOutstanding: if not None, function returning the current number
+      of unconfirmed messages, which memTrace samples along with the RSS
+    :param startGate: the run's StartGate, if any; runs in worker processes
+      add their process id to the path prefix of the profile
+    """
+    self._adapterClass = adapterClass
+    self._clientName = adapterClass.getName()
+    self._startGate = startGate
+
+    self._profile = profile
+    self._profiler = None
+    if profile is not None:
+      self._profiler = perf_profile.createProfiler(profile[0])
+
+    self._sockets = socket_stats.SocketStats() if ioStats else None
+    self._ioSummary = None
+
+    self._recording = recording
+    self._recorder = self._replayer = None
+    if recording is not None:
+      mode, path = recording
+      if mode == RECORD:
+        self._recorder = socket_stats.StreamRecorder()
+      else:
+        self._replayer = socket_stats.StreamReplayer.load(path,
+                                                          self._clientName)
+
+    self._memory = None
+    if memTrace:
+      self._memory = perf_memory.MemoryTracer(getOutstanding=getOutstanding)
+
+    self._gcMonitor = perf_gc.GcMonitor(gcMode) if gcMode is not None else None
+
+
+  def connect(self, adapter, deliveryConfirmation):
+    """Connects the adapter, instrumenting the sockets that it creates"""
+    if (self._sockets is None and self._recorder is None and
+        self._replayer is None):
+      adapter.connect(deliveryConfirmation)
+      return
+
+    with socket_stats.instrumentSockets(self._sockets, self._recorder,
+                                        self._replayer):
+      adapter.connect(deliveryConfirmation)
+
+
+  def start(self):
+    """Starts the instruments; call just before the clock of the timed
+    interval starts, since the memory tracer takes its initial snapshot here
+    """
+    if self._gcMonitor is not None:
+      self._gcMonitor.start()
+    if self._memory is not None:
+      self._memory.start()
+    if self._sockets is not None:
+      self._sockets.reset()
+    if self._profiler is not None:
+      self._profiler.start()
+
+
+  def onWarmupEnd(self):
+    """Discards what the instruments gathered during the warmup"""
+    if self._profiler is not None:
+      self._profiler.reset()
+    if self._sockets is not None:
+      self._sockets.reset()
+    if self._memory is not None:
+      self._memory.rebaseline()
+    if self._gcMonitor is not None:
+      self._gcMonitor.reset()
+
+
+  def stop(self):
+    """Stops the instruments at the end of the timed interval or when the run
+    fails
+    """
+    if self._profiler is not None:
+      self._profiler.stop()
+    if self._gcMonitor is not None:
+      self._gcMonitor.stop()
+    if self._memory is not None:
+      self._memory.stop()
+    if self._sockets is not None:
+      self._ioSummary = self._sockets.summary(prefix="io.")
+
+
+  def addTo(self, result):
+    """Writes the profile and the recording and adds the instruments' results
+    to the result of a successful run, which must have the final numMessages
+    """
+    if self._profiler is not None:
+      self._writeProfile(result)
+    if self._sockets is not None:
+      result.update(self._ioSummary)
+      _addIoRatios(result)
+    if self._recorder is not None:
+      self._recorder.save(self._recording[1], self._clientName)
+      result["recording"] = self._recording[1]
+    if self._memory is not None:
+      self._addMemory(result)
+    if self._gcMonitor is not None:
+      result.update(self._gcMonitor.summary(result["numMessages"],
+                                            prefix="gc."))
+
+
+  def _writeProfile(self, result):
+    """Writes the profile, logs the client library's functions with the most
+    self time and adds the path prefix of the profile files to the result
+    """
+    pathPrefix = self._profile[1]
+    if self._startGate is not None:
+      pathPrefix = "%s.%d" % (pathPrefix, os.getpid())
+
+    library = self._adapterClass.LIBRARY
+    top = self._profiler.write(pathPrefix, perf_profile.getLibraryDir(library))
+
+    g_log.info("%s: top %s functions by self time (see %s.*):\n%s",
+               self._clientName, library, pathPrefix,
+               "\n".join("%10.4fs %10d  %s" % entry for entry in top[:10]))
+    result["profile"] = pathPrefix
+
+
+  def _addMemory(self, result):
+    """Adds the "mem." summary of the memory tracer to the result and logs
+    the RSS samples
+    """
+    memory = self._memory
+    result.update(memory.summary(result["numMessages"], prefix="mem."))
+    g_log.info("%s: RSS samples (seconds: MB[, unconfirmed messages]): %s",
+               self._clientName,
+               "; ".join("%.1f: %s%s" % (
+                           elapsed, _formatMegabytes(rss),
+                           "" if outstanding is None else ", %d" % outstanding)
+                         for elapsed, rss, outstanding in memory.samples))
+
+
+
+def _addHistograms(result, histograms):
+  """Adds latency histograms and their summaries to a scenario result
+
+  :param histograms: dict of perf_stats.LatencyHistogram keyed by the prefix of
+    its summary keys in the result; e.g., "confirm." for "confirm.p99"
+  """
+  result["histograms"] = histograms
+  for prefix, histogram in histograms.items():
+    result.update(histogram.summary(prefix=prefix))
+
+
+
+def _scheduleChannels(channels, numMessages, distribution):
+  """Generates the channel entry to use for each of numMessages publishes
+
+  ROUND_ROBIN rotates through the channels message by message. DEDICATED
+  gives each channel an equal contiguous share of the messages, as if each
+  channel were owned by its own producer, and runs the producers one after
+  another.
+
+  :param numMessages: number of publishes; None for an endless ROUND_ROBIN
+    sequence
+  """
+  numChannels = len(channels)
+  if numMessages is None:
+    assert distribution == ROUND_ROBIN, distribution
+    for entry in itertools.cycle(channels):
+      yield entry
+  elif distribution == ROUND_ROBIN:
+    for i in xrange(numMessages):
+      yield channels[i % numChannels]
+  else:
+    share, remainder = divmod(numMessages, numChannels)
+    for i, entry in enumerate(channels):
+      for _ in xrange(share + (i < remainder)):
+        yield entry
+
+
+
+def runConsumeScenario(adapterClass,
+                       brokerAddress,
+                       numMessages,
+                       messageSize,
+                       prefetch,
+                       noAck,
+                       ackBatch,
+                       payloadMode=perf_payload.REUSED,
+                       sizeDistribution=(perf_payload.FIXED, None),
+                       profile=None,
+                       ioStats=False,
+                       recording=None,
+                       memTrace=False,
+                       gcMode=None,
+                       startGate=None):
+  """Pre-fills a temporary queue with the given number of messages and then
+  consumes them via one client interface
+
+  The timed interval spans basic.consume, receiving all messages, sending the
+  final ack and closing the channel.
+
+  :param prefetch: basic.qos prefetch count; 0 for unlimited
+  :param noAck: True to consume in no-ack mode
+  :param ackBatch: in manual ack mode, acknowledge every ackBatch'th message
+    with multiple=True (individually if 1)
+  :param payloadMode: how the message bodies are made; one of
+    perf_payload.PAYLOAD_MODES
+  :param sizeDistribution: perf_payload.parseSizeDistribution() result; the
+    reported messageSize is the mean unless it's FIXED
+  :param profile, ioStats, recording, memTrace, gcMode: instruments of the
+    timed interval; see _Instrumentation
+  :param startGate: if not None, StartGate to wait on once the queue is filled
+
+  :returns: result dict for printResultsTable
+  """
+  clientName = adapterClass.getName()
+
+  g_log.info(
+    "runConsumeScenario: client=%s; numMessages=%d; messageSize=%s; "
+    "prefetch=%s; noAck=%s; ackBatch=%s", clientName, numMessages,
+    messageSize, prefetch, noAck, ackBatch)
+
+  result = dict(client=clientName,
+                numMessages=numMessages,
+                messageSize=messageSize,
+                prefetch=prefetch,
+                noAck=noAck,
+                ackBatch=None if noAck else ackBatch,
+                error=None)
+
+  payloads = _createPayloads(result, messageSize, payloadMode,
+                             sizeDistribution)
+
+  adapter = adapterClass(brokerAddress)
+
+  class State(object):
+    numReceived = 0
+    lastDeliveryTag = None
+    numUnacked = 0
+
+  def onMessage(body, deliveryTag):
+    State.numReceived += 1
+    if noAck:
+      return
+    State.numUnacked += 1
+    State.lastDeliveryTag = deliveryTag
+    if State.numUnacked >= ackBatch:
+      adapter.ack(channel, deliveryTag, multiple=ackBatch > 1)
+      State.numUnacked = 0
+
+  phases = _startPhaseTimer(adapterClass)
+
+  instruments = _Instrumentation(adapterClass, profile, ioStats, recording,
+                                 memTrace, gcMode, startGate=startGate)
+
+  try:
+    instruments.connect(adapter, False)
+    g_log.info("%s: opened connection", clientName)
+    phases.lap("connect")
+
+    channel = adapter.openChannel()
+    g_log.info("%s: opened channel", clientName)
+    phases.lap("openChannel")
+
+    queue = adapter.declareQueue(channel)
+
+    fillStartTime = time.time()
+    for _ in xrange(numMessages):
+      adapter.publish(channel, "", queue, next(payloads))
+    # The broker handles a channel's methods in order, so the queue has all
+    # of the messages by the time the re-declare completes
+    adapter.declareQueue(channel, queue)
+    g_log.info("%s: filled queue=%s with %d messages in %.3fs", clientName,
+               queue, numMessages, time.time() - fillStartTime)
+    phases.lap("fill")
+
+    if startGate is not None:
+      startGate.wait()
+      phases.restart()
+
+    instruments.start()
+    startTime = time.time()
+    startCpuTimes = perf_stats.getCpuTimes()
+
+    adapter.consume(channel, queue, onMessage, noAck=noAck, prefetch=prefetch)
+
+    adapter.waitUntil(lambda: State.numReceived >= numMessages)
+
+    if State.numUnacked:
+      adapter.ack(channel, State.lastDeliveryTag, multiple=True)
+    phases.lap("consume")
+
+    adapter.closeChannel(channel)
+    phases.lap("closeChannel")
+
+    elapsed = time.time() - startTime
+    cpuTimes = perf_stats.getCpuTimes(since=startCpuTimes)
+    instruments.stop()
+
+    g_log.info("%s: consumed %d messages of size=%d in %.3fs", clientName,
+               numMessages, messageSize, elapsed)
+
+    adapter.close()
+    phases.lap("close")
+    g_log.info("%s: DONE", clientName)
+
+  except Exception as e:
+    g_log.exception("%s: consume scenario failed", clientName)
+    result["error"] = repr(e)
+    instruments.stop()
+
+  else:
+    _addThroughput(result, elapsed, cpuTimes)
+    _addPhases(result, phases)
+    instruments.addTo(result)
+
+  return result
+
+
+
+def runAltPubConsScenario(adapterClass,
+                          brokerAddress,
+                          numMessages,
+                          messageSize,
+                          useConsumerAcks,
+                          deliveryConfirmation,
+                          duration=None,
+                          warmup=0,
+                          sampleInterval=1.0,
+                          steadyCv=DEFAULT_STEADY_CV,
+                          rate=None,
+                          payloadMode=perf_payload.REUSED,
+                          sizeDistribution=(perf_payload.FIXED, None),
+                          profile=None,
+                          ioStats=False,
+                          recording=None,
+                          memTrace=False,
+                          gcMode=None,
+                          startGate=None):
+  """Alternates publishing/consuming the given number of messages of the given
+  size one message at a time via default exchange and a temporary queue
+
+  Each round trip spans publishing the message, waiting for its Basic.Ack in
+  deliveryConfirmation mode, waiting for its delivery and, if useConsumerAcks,
+  acking it.
+
+  With a duration, round trips are made until it elapses instead, as in
+  runPublishScenario().
+
+  With a rate, round trips start at fixed intervals, and their latencies are
+  measured from the due times, so a round trip that delays the next one
+  shows up in the latter's latency as well.
+
+  :param useConsumerAcks: consume with no_ack=False and ack each message
+  :param duration: if not None, seconds to run for after the warmup;
+    numMessages is ignored
+  :param warmup: seconds to run for before measuring in duration mode
+  :param sampleInterval: seconds per throughput sample in duration mode
+  :param steadyCv: coefficient of variation threshold of the steady-state
+    detector in duration mode
+  :param rate: if not None, round trips per second to start
+  :param payloadMode: how the message bodies are made; one of
+    perf_payload.PAYLOAD_MODES
+  :param sizeDistribution: perf_payload.parseSizeDistribution() result; the
+    reported messageSize is the mean unless it's FIXED
+  :param profile, ioStats, recording, memTrace, gcMode: instruments of the
+    timed interval; see _Instrumentation
+  :param startGate: if not None, StartGate to wait on once the consumer is set
+    up
+
+  :returns: result dict for printResultsTable, including round-trip latency
+    percentiles under the "rtt." prefix
+  """
+  clientName = adapterClass.getName()
+
+  g_log.info(
+    "runAltPubConsScenario: client=%s; numMessages=%d; messageSize=%s; "
+    "useConsumerAcks=%s; deliveryConfirmation=%s; duration=%s; warmup=%s; "
+    "rate=%s", clientName, numMessages, messageSize, useConsumerAcks,
+    deliveryConfirmation, duration, warmup, rate)
+
+  result = dict(client=clientName,
+                numMessages=numMessages,
+                messageSize=messageSize,
+                useConsumerAcks=useConsumerAcks,
+                deliveryConfirmation=deliveryConfirmation,
+                error=None)
+
+  payloads = _createPayloads(result, messageSize, payloadMode,
+                             sizeDistribution)
+
+  confirms = perf_stats.ConfirmTracker()
+  roundTrips = perf_stats.LatencyHistogram()
+
+  # Delivery tags of consumed messages that haven't been processed yet
+  incoming = []
+  # [size] of the message in flight
+  expectedSize = [None]
+
+  def onMessage(body, deliveryTag):
+    assert len(body) == expectedSize[0], len(body)
+    incoming.append(deliveryTag)
+
+  adapter = adapterClass(brokerAddress)
+
+  phases = _startPhaseTimer(adapterClass)
+
+  getOutstanding = None
+  if deliveryConfirmation:
+    getOutstanding = lambda: confirms.numOutstanding
+  instruments = _Instrumentation(adapterClass, profile, ioStats, recording,
+                                 memTrace, gcMode, getOutstanding, startGate)
+
+  try:
+    instruments.connect(adapter, deliveryConfirmation)
+    g_log.info("%s: opened connection", clientName)
+    phases.lap("connect")
+
+    channel = adapter.openChannel()
+    g_log.info("%s: opened channel", clientName)
+    phases.lap("openChannel")
+
+    if deliveryConfirmation:
+      adapter.enableConfirms(channel, confirms.onAck, confirms.onNack)
+      g_log.info("%s: enabled message delivery confirmation", clientName)
+      phases.lap("confirmSelect")
+
+    queue = adapter.declareQueue(channel)
+    adapter.consume(channel, queue, onMessage, noAck=not useConsumerAcks)
+    g_log.info("%s: consuming from queue=%s", clientName, queue)
+    phases.lap("startConsumer")
+
+    if startGate is not None:
+      startGate.wait()
+      phases.restart()
+
+    limiter = None
+    if rate is not None:
+      limiter = perf_stats.RateLimiter(rate)
+
+    timer = None
+    trips = xrange(numMessages)
+    if duration is not None:
+      def onWarmupEnd():
+        confirms.histogram.reset()
+        roundTrips.reset()
+        instruments.onWarmupEnd()
+
+      timer = perf_stats.DurationTimer(duration, warmup, sampleInterval,
+                                       onWarmupEnd=onWarmupEnd)
+      trips = itertools.repeat(None)
+
+    instruments.start()
+    startTime = time.time()
+    startCpuTimes = perf_stats.getCpuTimes()
+    if limiter is not None:
+      limiter.start()
+    if timer is not None:
+      timer.start()
+
+    for _ in trips:
+      if limiter is not None:
+        sendTime = limiter.nextSendTime()
+        # Nothing is in flight between round trips, so there's no I/O to pump
+        delay = sendTime - time.time()
+        if delay > 0:
+          time.sleep(delay)
+
+      if timer is not None and not timer.tick():
+        break
+
+      if limiter is None:
+        sendTime = time.time()
+
+      payload = next(payloads)
+      expectedSize[0] = len(payload)
+      if deliveryConfirmation:
+        confirms.onPublish(sendTime)
+      adapter.publish(channel, "", queue, payload)
+      if deliveryConfirmation:
+        adapter.waitUntil(lambda: not confirms.numOutstanding)
+
+      adapter.waitUntil(lambda: incoming)
+      assert len(incoming) == 1, incoming
+      deliveryTag = incoming.pop()
+      if useConsumerAcks:
+        adapter.ack(channel, deliveryTag)
+
+      roundTrips.record(time.time() - sendTime)
+
+    phases.lap("roundTrips")
+
+    adapter.closeChannel(channel)
+    phases.lap("closeChannel")
+
+    elapsed = time.time() - startTime
+    cpuTimes = perf_stats.getCpuTimes(since=startCpuTimes)
+    instruments.stop()
+
+    g_log.info("%s: completed %s round trips with messages of size=%d in "
+               "%.3fs", clientName, numMessages if timer is None else "timed",
+               messageSize, elapsed)
+
+    adapter.close()
+    phases.lap("close")
+    g_log.info("%s: DONE", clientName)
+
+  except Exception as e:
+    g_log.exception("%s: altpubcons scenario failed", clientName)
+    result["error"] = repr(e)
+    instruments.stop()
+
+  else:
+    if timer is None:
+      _addThroughput(result, elapsed, cpuTimes)
+    else:
+      _addDurationThroughput(result, timer, steadyCv)
+
+    _addPhases(result, phases)
+    instruments.addTo(result)
+
+    histograms = {"rtt.": roundTrips}
+    if deliveryConfirmation:
+      histograms["confirm."] = confirms.histogram
+    if rate is not None:
+      result["offeredRate"] = rate
+    _addHistograms(result, histograms)
+
+  return result
+
+
+
+def runLatencyScenario(adapterClass,
+                       brokerAddress,
+                       numMessages,
+                       messageSize,
+                       rate=None,
+                       consumerProcess=False,
+                       drainTimeout=DEFAULT_DRAIN_TIMEOUT):
+  """Publishes the given number of messages, each stamped with its sequence
+  number and send time, to a queue that a consumer drains meanwhile, and
+  measures each message's latency from the publish call to its dispatch by
+  the consumer's client
+
+  The timed interval spans the first publish to the last delivery. Messages
+  that haven't arrived drainTimeout seconds after the last publish (and the
+  last delivery) count as missing.
+
+  With a rate, publishing is open-loop as in runPublishScenario(), and the
+  latencies are measured from the due times. The delay of each publish call
+  past its due time is recorded under the "lag." prefix.
+
+  :param rate: if not None, messages per second to publish at
+  :param consumerProcess: True to consume via a connection of a separate
+    process; otherwise the consumer is on a second channel of the
+    publishing connection, whose deliveries are dispatched between publishes
+  :param drainTimeout: seconds to wait for more deliveries once all messages
+    are published
+
+  :returns: result dict for printResultsTable, including the latency
+    percentiles under the "e2e." prefix and the sequence checks of
+    perf_stats.SequenceTracker under the "seq." prefix
+  """
+  clientName = adapterClass.getName()
+
+  g_log.info(
+    "runLatencyScenario: client=%s; numMessages=%d; messageSize=%s; rate=%s; "
+    "consumerProcess=%s", clientName, numMessages, messageSize, rate,
+    consumerProcess)
+
+  result = dict(client=clientName,
+                numMessages=numMessages,
+                messageSize=messageSize,
+                consumerMode="process" if consumerProcess else "same",
+                error=None)
+
+  if rate is not None and not consumerProcess and adapterClass.BLOCKING_CONSUME:
+    # Its pump() blocks in the consumer until the next delivery, so the
+    # publisher would miss its due times once nothing is in flight
+    result["error"] = "its consumer blocks the connection between sends"
+    return result
+
+  padding = b"a" * (messageSize - perf_payload.STAMP.size)
+
+  tracker = None
+  consumer = None
+  # Delays of open-loop publish calls past their due times
+  lags = perf_stats.LatencyHistogram()
+
+  try:
+    if consumerProcess:
+      queue = "amqp-perf-latency-%d" % (os.getpid(),)
+      consumer = _LatencyConsumerProcess(adapterClass, brokerAddress, queue,
+                                         numMessages, drainTimeout)
+
+    adapter = adapterClass(brokerAddress)
+    adapter.connect(deliveryConfirmation=False)
+    channel = adapter.openChannel()
+
+    if consumer is None:
+      tracker = perf_stats.SequenceTracker(numMessages)
+      consumerChannel = adapter.openChannel()
+      queue = adapter.declareQueue(consumerChannel)
+      adapter.consume(
+        consumerChannel, queue,
+        lambda body, _deliveryTag: tracker.onMessage(
+          *perf_payload.readStamp(body)),
+        noAck=True)
+    else:
+      consumer.waitUntilReady()
+    g_log.info("%s: consuming from queue=%s", clientName, queue)
+
+    limiter = None
+    if rate is not None:
+      limiter = perf_stats.RateLimiter(rate)
+
+    startTime = time.time()
+    startCpuTimes = perf_stats.getCpuTimes()
+    if limiter is not None:
+      limiter.start()
+
+    for seq in xrange(numMessages):
+      if limiter is not None:
+        sendTime = limiter.nextSendTime()
+        _pumpUntil(adapter, sendTime)
+        lags.record(time.time() - sendTime)
+      else:
+        sendTime = time.time()
+      adapter.publish(channel, "", queue,
+                      perf_payload.stampBody(seq, sendTime, padding))
+      if consumer is None and limiter is None:
+        # Dispatch whatever has arrived meanwhile
+        adapter.pump(0)
+
+    if consumer is None:
+      _drainLatencyConsumer(adapter, tracker, drainTimeout)
+      adapter.closeChannel(consumerChannel)
+    # Flushes the output of clients that buffer it
+    adapter.closeChannel(channel)
+    if consumer is None:
+      consumerCpuTimes = (0, 0)
+    else:
+      tracker, consumerCpuTimes = consumer.getResult()
+
+    endTime = tracker.lastReceiveTime or time.time()
+    cpuTimes = perf_stats.getCpuTimes(since=startCpuTimes)
+
+    g_log.info("%s: received %d of %d messages of size=%d in %.3fs",
+               clientName, tracker.numUnique, numMessages, messageSize,
+               endTime - startTime)
+
+    adapter.close()
+    g_log.info("%s: DONE", clientName)
+
+  except Exception as e:
+    g_log.exception("%s: latency scenario failed", clientName)
+    result["error"] = repr(e)
+
+  else:
+    _addThroughput(result, endTime - startTime,
+                   tuple(cpu + consumerCpu for cpu, consumerCpu
+                         in zip(cpuTimes, consumerCpuTimes)))
+    result.update(tracker.summary(prefix="seq."))
+    histograms = {"e2e.": tracker.histogram}
+    if rate is not None:
+      result["offeredRate"] = rate
+      histograms["lag."] = lags
+    _addHistograms(result, histograms)
+
+  finally:
+    if consumer is not None:
+      consumer.stop()
+
+  return result
+
+
+
+def _drainLatencyConsumer(adapter, tracker, drainTimeout):
+  """Pumps the consumer's I/O until all messages of a latency scenario have
+  arrived, or none has for drainTimeout seconds
+  """
+  idleSince = time.time()
+  numReceived = tracker.numReceived
+  while not tracker.isComplete:
+    now = time.time()
+    if tracker.numReceived != numReceived:
+      numReceived = tracker.numReceived
+      idleSince = now
+    elif now - idleSince >= drainTimeout:
+      g_log.warning("No deliveries for %ss; %d messages are missing",
+                    drainTimeout, tracker.numMessages - tracker.numUnique)
+      break
+    adapter.pump(min(drainTimeout - (now - idleSince), 0.1))
+
+
+
+class _LatencyConsumerProcess(object):
+  """Consumer of runLatencyScenario() in a process of its own, which starts
+  draining once all messages are published
+  """
+
+  def __init__(self, adapterClass, brokerAddress, queue, numMessages,
+               drainTimeout):
+    self._drainTimeout = drainTimeout
+    self._ready = multiprocessing.Event()
+    self._published = multiprocessing.Event()
+    self._resultQueue = multiprocessing.Queue()
+    self._process = multiprocessing.Process(
+      target=_runLatencyConsumer,
+      args=(adapterClass, brokerAddress, queue, numMessages, drainTimeout,
+            self._ready, self._published, self._resultQueue),
+      name="LatencyConsumer")
+    self._process.daemon = True
+    self._process.start()
+
+
+  def waitUntilReady(self):
+    """Waits until the consumer has declared the queue and started
+    consuming
+    """
+    while not self._ready.wait(1):
+      if self._process.exitcode is not None:
+        raise RuntimeError("Latency consumer exited with exitcode=%s" % (
+          self._process.exitcode,))
+
+
+  def getResult(self):
+    """Tells the consumer that all messages are published and waits for it to
+    finish draining
+
+    :returns: (perf_stats.SequenceTracker, (user, system) CPU seconds of the
+      consumer's timed part)
+    """
+    self._published.set()
+    while True:
+      try:
+        error, tracker, cpuTimes = self._resultQueue.get(timeout=1)
+      except Queue.Empty:
+        if self._process.exitcode is not None:
+          raise RuntimeError("Latency consumer exited with exitcode=%s" % (
+            self._process.exitcode,))
+      else:
+        break
+    if error is not None:
+      raise RuntimeError("Latency consumer failed: %s" % (error,))
+    return tracker, cpuTimes
+
+
+  def stop(self):
+    if self._process.is_alive():
+      self._process.terminate()
+    self._process.join()
+
+
+
+def _runLatencyConsumer(adapterClass, brokerAddress, queue, numMessages,
+                        drainTimeout, ready, published, resultQueue):
+  """Process entry point of _LatencyConsumerProcess"""
+  tracker = perf_stats.SequenceTracker(numMessages)
+  try:
+    adapter = adapterClass(brokerAddress)
+    adapter.connect(deliveryConfirmation=False)
+    channel = adapter.openChannel()
+    adapter.declareQueue(channel, queue)
+    adapter.consume(
+      channel, queue,
+      lambda body, _deliveryTag: tracker.onMessage(
+        *perf_payload.readStamp(body)),
+      noAck=True)
+    startCpuTimes = perf_stats.getCpuTimes()
+    ready.set()
+
+    # The drain timeout counts from the last publish
+    adapter.waitUntil(lambda: tracker.isComplete or published.is_set())
+    _drainLatencyConsumer(adapter, tracker, drainTimeout)
+    cpuTimes = perf_stats.getCpuTimes(since=startCpuTimes)
+
+    adapter.close()
+  except Exception as e:
+    g_log.exception("Latency consumer failed")
+    resultQueue.put((repr(e), None, None))
+  else:
+    resultQueue.put((None, tracker, cpuTimes))
+
+
+
+def runConcurrentScenario(adapterClass,
+                          brokerAddress,
+                          numProducers,
+                          numConsumers,
+                          numMessages,
+                          messageSize,
+                          deliveryConfirmation=False,
+                          noAck=False,
+                          prefetch=0,
+                          producerRate=None,
+                          drainTimeout=DEFAULT_DRAIN_TIMEOUT):
+  """Runs many producers and consumers concurrently on one connection:
+  producer tasks of a perf_tasks.TaskLoop share a channel to publish
+  timestamped messages to a queue, which consumers on channels of their own
+  drain meanwhile
+
+  The timed interval spans the first publish to the last delivery. Messages
+  that haven't arrived drainTimeout seconds after the last publish (and the
+  last delivery) count as missing. Since the producers interleave, the
+  sequence numbers are only checked for missing and duplicate messages.
+
+  :param numProducers: number of producer tasks
+  :param numConsumers: number of consumers
+  :param numMessages: number of messages per producer
+  :param deliveryConfirmation: True to put the producers' channel in confirm
+    mode; each producer waits for the Basic.Ack of its message before
+    publishing the next one
+  :param noAck: True to consume in no-ack mode; otherwise, the consumers ack
+    each message from within its delivery callback
+  :param prefetch: basic.qos prefetch count of each consumer; 0 for unlimited
+  :param producerRate: if not None, messages per second that each producer
+    publishes at, open-loop as in runPublishScenario(); the producers'
+    schedules are staggered evenly over the interval between messages
+  :param drainTimeout: seconds to wait for more deliveries once all messages
+    are published
+
+  :returns: result dict for printResultsTable, including the latency
+    percentiles under the "e2e." prefix and the sequence checks of
+    perf_stats.SequenceTracker under the "seq." prefix
+  """
+  clientName = adapterClass.getName()
+
+  g_log.info(
+    "runConcurrentScenario: client=%s; numProducers=%d; numConsumers=%d; "
+    "numMessages=%d; messageSize=%s; deliveryConfirmation=%s; noAck=%s; "
+    "prefetch=%s; producerRate=%s", clientName, numProducers, numConsumers,
+    numMessages, messageSize, deliveryConfirmation, noAck, prefetch,
+    producerRate)
+
+  result = dict(client=clientName,
+                numProducers=numProducers,
+                numConsumers=numConsumers,
+                numMessages=numProducers * numMessages,
+                messageSize=messageSize,
+                deliveryConfirmation=deliveryConfirmation,
+                noAck=noAck,
+                prefetch=prefetch,
+                error=None)
+
+  if adapterClass.BLOCKING_CONSUME:
+    # Its pump() blocks in the consumer until the next delivery, so the
+    # TaskLoop couldn't resume the producers in between
+    result["error"] = "its consumers block the connection between tasks"
+    return result
+
+  padding = b"a" * (messageSize - perf_payload.STAMP.size)
+
+  tracker = perf_stats.SequenceTracker(numProducers * numMessages)
+  confirms = perf_stats.ConfirmTracker()
+  # Delays of open-loop publish calls past their due times
+  lags = perf_stats.LatencyHistogram()
+  # Number of messages delivered to each consumer
+  consumerCounts = [0] * numConsumers
+  # time.time() of each producer's last publish
+  producerEndTimes = [None] * numProducers
+
+  def createOnMessage(index, consumerChannel):
+    def onMessage(body, deliveryTag):
+      consumerCounts[index] += 1
+      tracker.onMessage(*perf_payload.readStamp(body))
+      if not noAck:
+        adapter.ack(consumerChannel, deliveryTag)
+    return onMessage
+
+  def produce(index, startTime):
+    """Producer task publishing sequence numbers index*numMessages and up"""
+    limiter = None
+    if producerRate is not None:
+      limiter = perf_stats.RateLimiter(producerRate)
+      limiter.start(startTime + index / (producerRate * numProducers))
+
+    for seq in xrange(index * numMessages, (index + 1) * numMessages):
+      if limiter is not None:
+        sendTime = limiter.nextSendTime()
+        yield sendTime
+        lags.record(time.time() - sendTime)
+      else:
+        sendTime = time.time()
+      if deliveryConfirmation:
+        confirms.onPublish(sendTime)
+        deliveryTag = confirms.numPublished
+      adapter.publish(channel, "", queue,
+                      perf_payload.stampBody(seq, sendTime, padding))
+      if deliveryConfirmation:
+        yield lambda: confirms.isConfirmed(deliveryTag)
+      elif limiter is None:
+        yield None
+
+    producerEndTimes[index] = time.time()
+
+  try:
+    adapter = adapterClass(brokerAddress)
+    adapter.connect(deliveryConfirmation)
+    channel = adapter.openChannel()
+    if deliveryConfirmation:
+      adapter.enableConfirms(channel, confirms.onAck, confirms.onNack)
+    queue = adapter.declareQueue(channel)
+
+    consumerChannels = []
+    for index in xrange(numConsumers):
+      consumerChannel = adapter.openChannel()
+      adapter.consume(consumerChannel, queue,
+                      createOnMessage(index, consumerChannel), noAck=noAck,
+                      prefetch=prefetch)
+      consumerChannels.append(consumerChannel)
+    g_log.info("%s: %d consumer(s) of queue=%s", clientName, numConsumers,
+               queue)
+
+    loop = perf_tasks.TaskLoop(adapter)
+
+    startTime = time.time()
+    startCpuTimes = perf_stats.getCpuTimes()
+
+    for index in xrange(numProducers):
+      loop.spawn(produce(index, startTime))
+    loop.run()
+
+    _drainLatencyConsumer(adapter, tracker, drainTimeout)
+    endTime = tracker.lastReceiveTime or time.time()
+    cpuTimes = perf_stats.getCpuTimes(since=startCpuTimes)
+
+    g_log.info("%s: received %d of %d messages of size=%d in %.3fs",
+               clientName, tracker.numUnique, tracker.numMessages,
+               messageSize, endTime - startTime)
+
+    for consumerChannel in consumerChannels:
+      adapter.closeChannel(consumerChannel)
+    adapter.closeChannel(channel)
+    adapter.close()
+    g_log.info("%s: DONE", clientName)
+
+  except Exception as e:
+    g_log.exception("%s: concurrent scenario failed", clientName)
+    result["error"] = repr(e)
+
+  else:
+    _addThroughput(result, endTime - startTime, cpuTimes)
+    result.update(tracker.summary(prefix="seq."))
+
+    producerRates = [numMessages / (producerEndTime - startTime)
+                     for producerEndTime in producerEndTimes
+                     if producerEndTime > startTime]
+    result["producerMinRate"] = min(producerRates) if producerRates else None
+    result["producerMaxRate"] = max(producerRates) if producerRates else None
+    result["consumerMinMsgs"] = min(consumerCounts)
+    result["consumerMaxMsgs"] = max(consumerCounts)
+
+    histograms = {"e2e.": tracker.histogram}
+    if deliveryConfirmation:
+      histograms["confirm."] = confirms.histogram
+    if producerRate is not None:
+      result["offeredRate"] = producerRate * numProducers
+      histograms["lag."] = lags
+    _addHistograms(result, histograms)
+
+  return result
+
+
+
+class StartGate(object):
+  """Lines up the start of the timed phase of scenarios running in worker
+  processes, so that connection setup isn't measured as part of the parallel
+  run
+  """
+
+  def __init__(self):
+    self._numReady = multiprocessing.Semaphore(0)
+    self._go = multiprocessing.Event()
+    # Whether this worker has reported; per thread for runScenarioInThreads
+    self._local = threading.local()
+
+
+  def wait(self):
+    """Called by a worker: reports readiness and blocks until open() is
+    called. Workers that fail before reaching wait() must call abandon().
+    """
+    self.abandon()
+    self._go.wait()
+
+
+  def abandon(self):
+    """Called by a worker to report it's done with the gate"""
+    if not getattr(self._local, "passed", False):
+      self._local.passed = True
+      self._numReady.release()
+
+
+  def open(self, numWorkers):
+    """Called by the parent: waits until the given number of workers have
+    called wait() or abandon(), then lets them all proceed
+    """
+    for _ in xrange(numWorkers):
+      self._numReady.acquire()
+    self._go.set()
+
+
+
+def _runScenarioWorker(scenario, startGate, resultQueue, workerIndex, kwargs):
+  """Worker process entry point for runScenarioInProcesses"""
+  try:
+    result = scenario(startGate=startGate, **kwargs)
+  except Exception as e:
+    g_log.exception("Worker %d failed", workerIndex)
+    result = dict(client=kwargs["adapterClass"].getName(), error=repr(e))
+  finally:
+    startGate.abandon()
+  resultQueue.put((workerIndex, result))
+
+
+
+def runScenarioInProcesses(numProcs, scenario, isolate=False, **kwargs):
+  """Runs the scenario concurrently in the given number of worker processes,
+  starting their timed phases together, and aggregates their results
+
+  :param numProcs: number of worker processes; 1 runs the scenario in this
+    process unless isolate is True
+  :param scenario: scenario function, such as runPublishScenario, that
+    accepts a startGate arg and returns a result dict
+  :param isolate: True to run the scenario in a fresh worker process even if
+    numProcs is 1, so that it doesn't inherit state left over by earlier runs
+  :param kwargs: args for the scenario function
+  :returns: result dict for printResultsTable
+  """
+  if numProcs == 1 and not isolate:
+    return scenario(**kwargs)
+
+  startGate = StartGate()
+  resultQueue = multiprocessing.Queue()
+
+  workers = [
+    multiprocessing.Process(target=_runScenarioWorker,
+                            args=(scenario, startGate, resultQueue, i, kwargs),
+                            name="ScenarioWorker-%d" % (i,))
+    for i in xrange(numProcs)]
+
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+
+  startGate.open(numProcs)
+  g_log.info("Released %d workers", numProcs)
+
+  # Drain the queue before joining, since a worker blocked on a full queue
+  # never exits
+  workerResults = {}
+  while len(workerResults) < numProcs:
+    try:
+      index, result = resultQueue.get(timeout=1)
+    except Queue.Empty:
+      for i, worker in enumerate(workers):
+        if worker.exitcode and i not in workerResults:
+          workerResults[i] = dict(
+            client=kwargs["adapterClass"].getName(),
+            error="worker exited with exitcode=%s" % (worker.exitcode,))
+    else:
+      workerResults[index] = result
+
+  for worker in workers:
+    worker.join()
+
+  return aggregateResults([workerResults[i] for i in xrange(numProcs)])
+
+
+
+def runScenarioInThreads(numThreads, scenario, **kwargs):
+  """Runs the scenario concurrently in the given number of threads of this
+  process, each with connections of its own, starting their timed phases
+  together, and aggregates their results like aggregateResults()
+
+  Since the threads share the process, its CPU times are measured here from
+  the start of the timed phases until all threads are done, instead of
+  summing those of the threads' results. Each thread's own CPU time, which
+  includes its connection setup, is summarized by _addThreadCpu().
+
+  :param numThreads: number of threads
+  :param scenario: scenario function, such as runPublishScenario, that
+    accepts a startGate arg and returns a result dict
+  :param kwargs: args for the scenario function
+  :returns: result dict for printResultsTable
+  """
+  adapterClass = kwargs["adapterClass"]
+  if numThreads > 1 and adapterClass.PROCESS_WIDE_IOLOOP:
+    return dict(client=adapterClass.getName(),
+                numThreads=numThreads,
+                threadMode=OWN_CONNECTION,
+                error="its connections share a process-wide ioloop")
+
+  startGate = StartGate()
+  workerResults = [None] * numThreads
+  # (user, system) CPU seconds of each thread
+  threadCpuTimes = [None] * numThreads
+
+  def runThread(index):
+    startCpuTimes = perf_stats.getThreadCpuTimes()
+    try:
+      workerResults[index] = scenario(startGate=startGate, **kwargs)
+    except Exception as e:
+      g_log.exception("Thread %d failed", index)
+      workerResults[index] = dict(client=adapterClass.getName(),
+                                  error=repr(e))
+    finally:
+      startGate.abandon()
+    if startCpuTimes is not None:
+      threadCpuTimes[index] = perf_stats.getThreadCpuTimes(
+        since=startCpuTimes)
+
+  threads = [threading.Thread(target=runThread, args=(i,),
+                              name="ScenarioThread-%d" % (i,))
+             for i in xrange(numThreads)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+  startGate.open(numThreads)
+  startCpuTimes = perf_stats.getCpuTimes()
+  g_log.info("Released %d threads", numThreads)
+
+  for thread in threads:
+    thread.join()
+  cpuTimes = perf_stats.getCpuTimes(since=startCpuTimes)
+
+  result = aggregateResults(workerResults)
+  del result["numProcs"]
+  result["numThreads"] = numThreads
+  result["threadMode"] = OWN_CONNECTION
+  if not result.get("error"):
+    result["cpuUser"], result["cpuSys"] = cpuTimes
+    _addThreadCpu(result, threadCpuTimes)
+  return result
+
+
+
+def aggregateResults(workerResults):
+  """Combines the result dicts of scenarios that ran concurrently into one.
+
+  Message counts are summed, elapsed is that of the slowest worker (since they
+  started together) and throughput is computed from those, so it's the
+  combined rate of all workers. The interval rates of duration-based runs are
+  summed before looking for a steady state. CPU times are summed, per-phase
+  elapsed times are those of the slowest worker, and latency histograms are
+  merged.
+
+  :param workerResults: non-empty sequence of result dicts
+  :returns: result dict for printResultsTable
+  """
+  for i, result in enumerate(workerResults):
+    if "elapsed" in result:
+      g_log.info("Worker %d: %d messages in %.3fs (%.0f msgs/s)", i,
+                 result["numMessages"], result["elapsed"],
+                 result["msgsPerSec"])
+
+  result = dict(workerResults[0])
+  result["numProcs"] = len(workerResults)
+
+  errors = ["worker %d: %s" % (i, r["error"])
+            for i, r in enumerate(workerResults) if r.get("error")]
+  if errors:
+    result["error"] = "; ".join(errors)
+    for key in ("elapsed", "msgsPerSec", "mbPerSec", "cpuUser", "cpuSys"):
+      result.pop(key, None)
+    return result
+
+  result["numMessages"] = sum(r["numMessages"] for r in workerResults)
+  _addThroughput(result,
+                 max(r["elapsed"] for r in workerResults),
+                 (sum(r["cpuUser"] for r in workerResults),
+                  sum(r["cpuSys"] for r in workerResults)))
+
+  if "offeredRate" in result:
+    result["offeredRate"] = sum(r["offeredRate"] for r in workerResults)
+
+  if "io.sendCalls" in result:
+    for key in IO_COUNT_KEYS:
+      result[key] = sum(r[key] for r in workerResults)
+    for key in IO_HISTOGRAM_KEYS:
+      histogram = collections.defaultdict(int)
+      for r in workerResults:
+        for value, count in r[key].items():
+          histogram[value] += count
+      result[key] = dict(histogram)
+    _addIoRatios(result)
+
+  if "mem.topSites" in result:
+    # Each worker is a process of its own, so their memory adds up
+    for key in MEMORY_SUM_KEYS:
+      values = [r[key] for r in workerResults]
+      result[key] = None if None in values else sum(values)
+    result["mem.bytesPerMsg"] = (
+      result["mem.allocatedBytes"] / float(result["numMessages"])
+      if result["mem.allocatedBytes"] is not None and result["numMessages"]
+      else None)
+    siteSizes = {}
+    siteCounts = collections.defaultdict(int)
+    for r in workerResults:
+      for site, size, count in r["mem.topSites"]:
+        if size is not None:
+          siteSizes[site] = siteSizes.get(site, 0) + size
+        siteCounts[site] += count
+    result["mem.topSites"] = sorted(
+      ((site, siteSizes.get(site), count)
+       for site, count in siteCounts.items()),
+      key=lambda site: (site[1], site[2]),
+      reverse=True)[:perf_memory.NUM_TOP_SITES]
+    # The workers' samples don't line up
+    result["mem.samples"] = None
+
+  if "gc.mode" in result:
+    for key in GC_SUM_KEYS:
+      result[key] = sum(r[key] for r in workerResults)
+    result["gc.pauseMax"] = max(r["gc.pauseMax"] for r in workerResults)
+    # The workers collect in parallel, so this is their mean share
+    result["gc.pauseShare"] = (
+      sum(r["gc.pauseShare"] for r in workerResults) / len(workerResults)
+      if None not in [r["gc.pauseShare"] for r in workerResults] else None)
+    result["gc.pausePerMsg"] = (
+      result["gc.pauseTotal"] / result["numMessages"]
+      if result["numMessages"] else None)
+
+  # Phases overlap across workers, so their wall-clock times don't add up
+  for key in result:
+    if key.startswith("phase."):
+      values = [r[key] for r in workerResults]
+      result[key] = max(values) if key.endswith(".elapsed") else sum(values)
+
+  if "intervalRates" in result:
+    # The workers' intervals line up, since they started together
+    _addSteadyState(result,
+                    [sum(rates) for rates in
+                     zip(*[r["intervalRates"] for r in workerResults])],
+                    result["steadyCvThreshold"])
+
+  histograms = {}
+  for r in workerResults:
+    for prefix, histogram in r.get("histograms", {}).items():
+      histograms.setdefault(prefix, perf_stats.LatencyHistogram()).merge(
+        histogram)
+  _addHistograms(result, histograms)
+
+  return result
+
+
+
+# Scenario functions that the sweep command can run, by name
+SWEEP_SCENARIOS = {
+  "publish": runPublishScenario,
+  "consume": runConsumeScenario,
+  "altpubcons": runAltPubConsScenario,
+}
+
+# Leading CSV columns of sweep results; the remaining keys (mostly latency
+# percentiles) follow in sorted order
+SWEEP_CSV_FIELDS = [
+  "scenario", "client", "numProcs", "numMessages", "messageSize",
+  "deliveryConfirmation", "confirmWindow", "prefetch", "noAck", "ackBatch",
+  "useConsumerAcks", "elapsed", "msgsPerSec", "mbPerSec", "cpuUser", "cpuSys",
+]
+
+
+
+# Latency histogram prefix whose percentile findmax holds to the SLO, by
+# scenario
+FINDMAX_LATENCY_PREFIXES = {
+  "publish": "confirm.",
+  "altpubcons": "rtt.",
+}
+
+
+
+def _formatMillis(seconds):
+  return "%.3f" % (seconds * 1000,)
+
+
+
+# (heading, result key, format string or function) of printResultsTable()
+# columns
+RESULT_COLUMNS = [
+  ("client", "client", "%s"),
+  ("msgs", "numMessages", "%d"),
+  ("size", "messageSize", "%d"),
+  ("pubacks", "deliveryConfirmation", "%s"),
+  ("elapsed(s)", "elapsed", "%.3f"),
+  ("msgs/s", "msgsPerSec", "%.0f"),
+  ("MB/s", "mbPerSec", "%.2f"),
+]
+
+CONSUME_RESULT_COLUMNS = [
+  ("client", "client", "%s"),
+  ("msgs", "numMessages", "%d"),
+  ("size", "messageSize", "%d"),
+  ("prefetch", "prefetch", "%d"),
+  ("no_ack", "noAck", "%s"),
+  ("ack batch", "ackBatch", "%d"),
+  ("elapsed(s)", "elapsed", "%.3f"),
+  ("msgs/s", "msgsPerSec", "%.0f"),
+  ("MB/s", "mbPerSec", "%.2f"),
+]
+
+ALTPUBCONS_RESULT_COLUMNS = [
+  ("client", "client", "%s"),
+  ("msgs", "numMessages", "%d"),
+  ("size", "messageSize", "%d"),
+  ("conacks", "useConsumerAcks", "%s"),
+  ("pubacks", "deliveryConfirmation", "%s"),
+  ("elapsed(s)", "elapsed", "%.3f"),
+  ("trips/s", "msgsPerSec", "%.0f"),
+  ("rtt p50(ms)", "rtt.p50", _formatMillis),
+  ("p90", "rtt.p90", _formatMillis),
+  ("p99", "rtt.p99", _formatMillis),
+  ("p99.9", "rtt.p99.9", _formatMillis),
+  ("max", "rtt.max", _formatMillis),
+]
+
+PROCS_COLUMN = ("procs", "numProcs", "%d")
+
+# Scenario parameter columns are inserted after "size"
+SWEEP_COLUMNS = [
+  ("client", "client", "%s"),
+  ("procs", "numProcs", "%d"),
+  ("msgs", "numMessages", "%d"),
+  ("size", "messageSize", "%d"),
+  ("elapsed(s)", "elapsed", "%.3f"),
+  ("msgs/s", "msgsPerSec", "%.0f"),
+  ("MB/s", "mbPerSec", "%.2f"),
+  ("cpu user(s)", "cpuUser", "%.3f"),
+  ("cpu sys(s)", "cpuSys", "%.3f"),
+]
+
+SWEEP_PARAM_COLUMNS = {
+  "publish": [
+    ("pubacks", "deliveryConfirmation", "%s"),
+    ("window", "confirmWindow", "%d"),
+  ],
+  "consume": [
+    ("prefetch", "prefetch", "%d"),
+    ("no_ack", "noAck", "%s"),
+    ("ack batch", "ackBatch", "%d"),
+  ],
+  "altpubcons": [
+    ("conacks", "useConsumerAcks", "%s"),
+    ("pubacks", "deliveryConfirmation", "%s"),
+  ],
+}
+
+CHANNELS_COLUMNS = [
+  ("conns", "numConnections", "%d"),
+  ("chans/conn", "channelsPerConnection", "%d"),
+  ("distribution", "distribution", "%s"),
+]
+
+CONFIRM_WINDOW_COLUMN = ("window", "confirmWindow", "%d")
+
+TX_BATCH_COLUMN = ("tx batch", "txBatch", "%d")
+
+THREADS_COLUMNS = [
+  ("threads", "numThreads", "%d"),
+  ("mode", "threadMode", "%s"),
+]
+
+# CPU seconds of the process per elapsed second and of each thread; the
+# publisher is the thread that owns the connection in --thread-mode=shared
+THREAD_CPU_COLUMNS = [
+  ("cpu/s", "cpuPerSec", "%.2f"),
+  ("thread cpu min(s)", "thread.cpuMin", "%.3f"),
+  ("mean", "thread.cpuMean", "%.3f"),
+  ("max", "thread.cpuMax", "%.3f"),
+  ("publisher cpu(s)", "thread.publisherCpu", "%.3f"),
+]
+
+LATENCY_RESULT_COLUMNS = [
+  ("client", "client", "%s"),
+  ("msgs", "numMessages", "%d"),
+  ("size", "messageSize", "%d"),
+  ("consumer", "consumerMode", "%s"),
+  ("elapsed(s)", "elapsed", "%.3f"),
+  ("msgs/s", "msgsPerSec", "%.0f"),
+  ("missing", "seq.missing", "%d"),
+  ("gaps", "seq.gaps", "%d"),
+  ("dups", "seq.duplicates", "%d"),
+  ("reordered", "seq.reordered", "%d"),
+  ("e2e p50(ms)", "e2e.p50", _formatMillis),
+  ("p90", "e2e.p90", _formatMillis),
+  ("p99", "e2e.p99", _formatMillis),
+  ("p99.9", "e2e.p99.9", _formatMillis),
+  ("max", "e2e.max", _formatMillis),
+]
+
+# Producer rates are each producer's messages over the time from the start to
+# its last publish; consumer counts are the messages delivered to each consumer
+CONCURRENT_RESULT_COLUMNS = [
+  ("client", "client", "%s"),
+  ("producers", "numProducers", "%d"),
+  ("consumers", "numConsumers", "%d"),
+  ("msgs", "numMessages", "%d"),
+  ("size", "messageSize", "%d"),
+  ("pubacks", "deliveryConfirmation", "%s"),
+  ("elapsed(s)", "elapsed", "%.3f"),
+  ("msgs/s", "msgsPerSec", "%.0f"),
+  ("MB/s", "mbPerSec", "%.2f"),
+  ("producer min msgs/s", "producerMinRate", "%.0f"),
+  ("max", "producerMaxRate", "%.0f"),
+  ("consumer min msgs", "consumerMinMsgs", "%d"),
+  ("max", "consumerMaxMsgs", "%d"),
+  ("missing", "seq.missing", "%d"),
+  ("dups", "seq.duplicates", "%d"),
+  ("e2e p50(ms)", "e2e.p50", _formatMillis),
+  ("p90", "e2e.p90", _formatMillis),
+  ("p99", "e2e.p99", _formatMillis),
+  ("p99.9", "e2e.p99.9", _formatMillis),
+  ("max", "e2e.max", _formatMillis),
+]
+
+# Columns of open-loop (--rate) runs: offered load and publish call lag
+RATE_COLUMNS = [
+  ("rate", "offeredRate", "%.0f"),
+  ("lag p99(ms)", "lag.p99", _formatMillis),
+]
+
+# findmax summary columns; the latency percentile column is inserted before
+# "runs"
+FINDMAX_COLUMNS = [
+  ("client", "client", "%s"),
+  ("procs", "numProcs", "%d"),
+  ("size", "messageSize", "%d"),
+  ("slo(ms)", "sloMillis", "%g"),
+  ("max rate", "maxRate", "%.0f"),
+  ("msgs/s", "msgsPerSec", "%.0f"),
+  ("runs", "numProbes", "%d"),
+]
+
+# Phases timed by the scenarios, in the order they run
+PHASE_ORDER = [
+  "import", "connect", "openChannel", "confirmSelect", "txSelect", "fill",
+  "startConsumer", "publish", "consume", "roundTrips", "drain", "commit",
+  "closeChannel", "close",
+]
+
+PHASE_COLUMNS = [
+  ("client", "client", "%s"),
+  ("phase", "phase", "%s"),
+  ("elapsed(ms)", "elapsed", _formatMillis),
+  ("cpu user(ms)", "cpuUser", _formatMillis),
+  ("cpu sys(ms)", "cpuSys", _formatMillis),
+]
+
+# Summed socket_stats.SocketStats.summary() counts and histograms of results
+# with --io-stats
+IO_COUNT_KEYS = [
+  "io.sendCalls", "io.sendBytes", "io.framesSent", "io.recvCalls",
+  "io.recvBytes", "io.framesReceived",
+]
+IO_HISTOGRAM_KEYS = ["io.sendSizes", "io.framesPerSend"]
+
+CODEC_COLUMNS = [
+  ("library", "library", "%s"),
+  ("operation", "operation", "%s"),
+  ("size", "messageSize", "%d"),
+  ("headers", "numHeaders", "%d"),
+  ("frames/op", "framesPerOp", "%d"),
+  ("ns/frame", "nsPerFrame", "%.0f"),
+  ("frames/s", "framesPerSec", "%.0f"),
+  ("objs/frame", "objectsPerFrame", "%.1f"),
+]
+
+def _formatMegabytes(numBytes):
+  return "%.1f" % (numBytes / 1048576.0,) if numBytes is not None else "-"
+
+
+
+MEMORY_COLUMNS = [
+  ("rss(MB)", "mem.rssEnd", _formatMegabytes),
+  ("peak(MB)", "mem.rssPeak", _formatMegabytes),
+  ("alloc(MB)", "mem.allocatedBytes", _formatMegabytes),
+  ("B/msg", "mem.bytesPerMsg", "%.0f"),
+]
+
+# In --pubacks mode
+MEMORY_CONFIRM_COLUMNS = [
+  ("unconfirmed@peak", "mem.outstandingAtPeak", "%d"),
+  ("max unconfirmed", "mem.maxOutstanding", "%d"),
+]
+
+# Memory counts that add up across worker processes
+MEMORY_SUM_KEYS = [
+  "mem.rssStart", "mem.rssEnd", "mem.rssPeak", "mem.outstandingAtPeak",
+  "mem.maxOutstanding", "mem.allocatedBytes",
+]
+
+MEMORY_SITE_COLUMNS = [
+  ("client", "client", "%s"),
+  ("allocation site", "site", "%s"),
+  ("alloc(KB)", "size", lambda size: "%.1f" % (size / 1024.0,)),
+  ("count", "count", "%+d"),
+]
+
+PAYLOAD_COLUMN = ("payload", "payloadMode", "%s")
+
+# With --size-dist; the size column shows the mean
+SIZE_DISTRIBUTION_COLUMNS = [
+  ("sizes", "sizeDistribution", "%s"),
+  ("max size", "maxMessageSize", "%d"),
+]
+
+GC_COLUMNS = [
+  ("gc", "gc.mode", "%s"),
+  ("gcs", "gc.collections", "%d"),
+  ("gen2", "gc.gen2Collections", "%d"),
+  ("gc pause(ms)", "gc.pauseTotal", _formatMillis),
+  ("max pause(ms)", "gc.pauseMax", _formatMillis),
+  ("gc%", "gc.pauseShare", "%.1f"),
+  ("gc us/msg", "gc.pausePerMsg", lambda seconds: "%.2f" % (seconds * 1e6,)),
+]
+
+# Collection counts and pauses that add up across worker processes
+GC_SUM_KEYS = [
+  "gc.collections", "gc.gen0Collections", "gc.gen1Collections",
+  "gc.gen2Collections", "gc.pauseTotal",
+]
+
+IO_COLUMNS = [
+  ("sends", "io.sendCalls", "%d"),
+  ("sends/msg", "io.sendsPerMsg", "%.2f"),
+  ("bytes/send", "io.bytesPerSend", "%.0f"),
+  ("frames/send", "io.meanFramesPerSend", "%.2f"),
+  ("recvs", "io.recvCalls", "%d"),
+  ("bytes/recv", "io.bytesPerRecv", "%.0f"),
+]
+
+IO_HISTOGRAM_COLUMNS = [
+  ("client", "client", "%s"),
+  ("histogram", "histogram", "%s"),
+  ("value", "value", "%s"),
+  ("sends", "count", "%d"),
+  ("share(%)", "share", "%.1f"),
+]
+
+# Steady-state detector columns of duration-based runs
+STEADY_STATE_COLUMNS = [
+  ("steady intervals", "steadyIntervals", "%d"),
+  ("cv", "steadyCv", "%.3f"),
+]
+
+# Publish->Basic.Ack latency columns
+CONFIRM_LATENCY_COLUMNS = [
+  ("ack p50(ms)", "confirm.p50", _formatMillis),
+  ("p90", "confirm.p90", _formatMillis),
+  ("p99", "confirm.p99", _formatMillis),
+  ("p99.9", "confirm.p99.9", _formatMillis),
+  ("max", "confirm.max", _formatMillis),
+]
+
+# Publish->Tx.Commit-Ok latency columns
+COMMIT_LATENCY_COLUMNS = [
+  ("commit p50(ms)", "commit.p50", _formatMillis),
+  ("p90", "commit.p90", _formatMillis),
+  ("p99", "commit.p99", _formatMillis),
+  ("p99.9", "commit.p99.9", _formatMillis),
+  ("max", "commit.max", _formatMillis),
+]
+
+
+def printPhasesTable(results, stream=sys.stdout):
+  """Prints the per-phase times of scenario results as an aligned text table,
+  one row per phase of each result
+  """
+  rows = []
+  for result in results:
+    names = sorted(set(key.split(".")[1] for key in result
+                       if key.startswith("phase.")),
+                   key=PHASE_ORDER.index)
+    for name in names:
+      rows.append(dict(
+        client=result["client"],
+        phase=name,
+        elapsed=result["phase.%s.elapsed" % (name,)],
+        cpuUser=result["phase.%s.cpuUser" % (name,)],
+        cpuSys=result["phase.%s.cpuSys" % (name,)],
+        error=None))
+
+  printResultsTable(rows, PHASE_COLUMNS, stream)
+
+
+
+def printIoHistograms(results, stream=sys.stdout):
+  """Prints the send size and frames per send distributions of scenario
+  results with --io-stats counts as an aligned text table
+  """
+  rows = []
+  for result in results:
+    if "io.sendSizes" not in result:
+      continue
+    for key, label, formatValue in (
+        ("io.sendSizes", "send size", lambda size: "%d-%d" % (size, size * 2 - 1)
+         if size > 1 else "%d" % (size,)),
+        ("io.framesPerSend", "frames/send", str)):
+      histogram = result[key]
+      total = sum(histogram.values())
+      for value in sorted(histogram):
+        rows.append(dict(client=result["client"],
+                         histogram=label,
+                         value=formatValue(value),
+                         count=histogram[value],
+                         share=histogram[value] * 100.0 / total,
+                         error=None))
+
+  printResultsTable(rows, IO_HISTOGRAM_COLUMNS, stream)
+
+
+
+def printMemorySites(results, stream=sys.stdout):
+  """Prints the top allocation sites of scenario results with --memtrace
+  summaries as an aligned text table; the sites are object types where
+  tracemalloc isn't available
+  """
+  rows = []
+  for result in results:
+    for site, size, count in result.get("mem.topSites", ()):
+      rows.append(dict(client=result["client"],
+                       site=site,
+                       size=size,
+                       count=count,
+                       error=None))
+
+  printResultsTable(rows, MEMORY_SITE_COLUMNS, stream)
+
+
+
+def printResultsTable(results, columns=RESULT_COLUMNS, stream=sys.stdout):
+  """Prints scenario results as an aligned text table, one row per result
+
+  :param results: sequence of result dicts; failed runs have a non-None
+    "error" value
+  """
+  rows = [[heading for heading, _key, _fmt in columns]]
+  for result in results:
+    row = []
+    for _heading, key, fmt in columns:
+      value = result.get(key)
+      if value is None:
+        row.append("-")
+      elif callable(fmt):
+        row.append(fmt(value))
+      else:
+        row.append(fmt % (value,))
+    if result.get("error"):
+      row.append("FAILED: %s" % (result["error"],))
+    rows.append(row)
+
+  widths = [max(len(row[i]) for row in rows if i < len(row))
+            for i in xrange(len(columns))]
+
+  for row in rows:
+    stream.write("  ".join(cell.ljust(widths[i]) if i < len(widths) else cell
+                           for i, cell in enumerate(row)).rstrip() + "\n")
+
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,235 @@
+"""Common interface that each *_perf.py module implements once per client
+library interface, so that amqp_perf.py can drive every library through the
+same scenarios.
+"""
+
+import time
+
+
+
+class ChannelHandle(object):
+  """Adapter-side state of one open channel; returned by
+  ClientAdapter.openChannel() and passed back to the other methods
+  """
+
+  def __init__(self, impl):
+    """
+    :param impl: the client library's channel object (or None for libraries,
+      such as puka, that don't expose channels)
+    """
+    self.impl = impl
+
+    # Delivery confirmation callbacks; None until enableConfirms()
+    self.onAck = None
+    self.onNack = None
+
+    # Number of messages published in confirm mode; AMQP delivery tags of
+    # publisher confirms are 1-based sequence numbers of publishes on the
+    # channel
+    self.publishSeqNo = 0
+
+    self.closed = False
+
+
+
+class ClientAdapter(object):
+  """Drives one connection of a specific client library interface.
+
+  Methods block until the requested operation completes, except for publish()
+  and ack(), which may merely buffer output. Asynchronous events (publisher
+  confirms, deliveries) are dispatched to the given callbacks from within
+  library calls or from pump().
+  """
+
+  # Name of the client library; e.g., "pika"
+  LIBRARY = None
+
+  # Name of the library's connection class or interface; e.g.,
+  # "SelectConnection"
+  IMPL = None
+
+  # True if publish() in confirm mode returns only after the broker confirms
+  # the message (the library doesn't support pipelined publisher confirms)
+  STOP_AND_WAIT_CONFIRMS = False
+
+  # True if pump() blocks until each active consumer gets its next delivery,
+  # so a connection can't serve several consumers of which some may run dry
+  BLOCKING_CONSUME = False
+
+  # True if all connections run on one process-wide event loop, so they can't
+  # be driven from threads of their own
+  PROCESS_WIDE_IOLOOP = False
+
+  # True if the library implements AMQP transactions (tx.select and tx.commit)
+  SUPPORTS_TRANSACTIONS = False
+
+
+  def __init__(self, brokerAddress):
+    """
+    :param brokerAddress: (host, port) of the broker; None for the library's
+      default localhost:5672
+    """
+    self.brokerAddress = brokerAddress
+
+
+  @classmethod
+  def getName(cls):
+    return "%s:%s" % (cls.LIBRARY, cls.IMPL)
+
+
+  @classmethod
+  def isAvailable(cls):
+    """
+    :returns: False if the installed version of the library lacks this
+      interface
+    """
+    return True
+
+
+  def connect(self, deliveryConfirmation):
+    """Opens the connection
+
+    :param deliveryConfirmation: True if channels of this connection will be
+      put in confirm mode; some libraries (puka) configure it per connection
+    """
+    raise NotImplementedError
+
+
+  def openChannel(self):
+    """
+    :returns: ChannelHandle
+    """
+    raise NotImplementedError
+
+
+  def enableConfirms(self, channel, onAck, onNack):
+    """Puts the channel in publisher confirm mode
+
+    :param channel: ChannelHandle
+    :param onAck: onAck(deliveryTag, multiple); called on Basic.Ack
+    :param onNack: onNack(deliveryTag, multiple); called on Basic.Nack
+    """
+    raise NotImplementedError
+
+
+  def selectTransactions(self, channel):
+    """Puts the channel in transactional mode (tx.select); only if
+    SUPPORTS_TRANSACTIONS
+
+    :param channel: ChannelHandle
+    """
+    raise NotImplementedError
+
+
+  def commit(self, channel):
+    """Commits the channel's current transaction (tx.commit), blocking until
+    the broker's Commit-Ok
+
+    :param channel: ChannelHandle
+    """
+    raise NotImplementedError
+
+
+  def publish(self, channel, exchange, routingKey, body):
+    """Publishes a message with mandatory=False
+
+    :param channel: ChannelHandle
+    """
+    raise NotImplementedError
+
+
+  def declareQueue(self, channel, queue=""):
+    """Declares a non-durable, auto-delete queue
+
+    :param channel: ChannelHandle
+    :param queue: queue name; empty to have the broker generate one
+    :returns: name of the queue
+    """
+    raise NotImplementedError
+
+
+  def consume(self, channel, queue, onMessage, noAck, prefetch=0):
+    """Starts consuming from the queue
+
+    :param channel: ChannelHandle
+    :param onMessage: onMessage(body, deliveryTag); called on each delivery
+    :param noAck: True to consume in no-ack mode
+    :param prefetch: basic.qos prefetch count; 0 for unlimited
+    """
+    raise NotImplementedError
+
+
+  def ack(self, channel, deliveryTag, multiple=False):
+    """Acknowledges a message delivered to a consumer on the channel"""
+    raise NotImplementedError
+
+
+  def pump(self, timeout):
+    """Performs pending I/O and dispatches callbacks
+
+    :param timeout: maximum number of seconds to block waiting for I/O
+    """
+    raise NotImplementedError
+
+
+  def closeChannel(self, channel):
+    raise NotImplementedError
+
+
+  def close(self):
+    """Closes the connection"""
+    raise NotImplementedError
+
+
+  def waitUntil(self, predicate, timeout=None):
+    """Pumps I/O until predicate() returns True
+
+    :param timeout: give up after this many seconds; None to wait forever
+    :returns: True if predicate() became True; False on timeout
+    """
+    deadline = None if timeout is None else time.time() + timeout
+
+    while not predicate():
+      if deadline is None:
+        self.pump(1)
+      else:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self.pump(min(remaining, 1))
+
+    return True
+
+
+
+class FrameCodec(object):
+  """A client library's own AMQP frame encoding and decoding, driven without
+  a connection or socket by codec_bench.py. Each *_perf.py module may provide
+  one as its CODEC.
+  """
+
+  # Name of the client library; e.g., "pika"
+  LIBRARY = None
+
+
+  def encodePublish(self, channelNumber, exchange, routingKey, body, headers,
+                    frameMax):
+    """Encodes the frames of a basic.publish the way the library does when
+    publishing
+
+    :param headers: dict of the message's headers table; empty for none
+    :param frameMax: negotiated maximum frame size, which splits the body
+    :returns: the encoded method, content header and body frames, in whatever
+      form the library hands them to its transport
+    """
+    raise NotImplementedError
+
+
+  def decodeFrames(self, data):
+    """Decodes complete frames the way the library does when it receives
+    them, up to but excluding the dispatch to channels and consumers
+
+    :param data: received bytes; complete frames only
+    :returns: list of the library's decoded frames
+    """
+    raise NotImplementedError
@@ -0,0 +1,197 @@
+"""Socket-free micro-benchmarks of the client libraries' own AMQP frame
+codecs: the client_adapter.FrameCodec of each *_perf.py module.
+
+Each library encodes basic.publish (method, content header and body frames)
+and decodes basic.deliver (likewise) and basic.ack, as received from the
+broker, across body sizes and header table sizes. The broker side frames are
+encoded with embedded_broker's helpers, so every library decodes the same
+bytes. Nothing here depends on a broker or the network, which makes the
+results a stable baseline for how much of a scenario's time is marshalling.
+
+Per frame, each benchmark reports the best time of several repeats and the
+number of garbage-collected objects that its result keeps alive (Python 2
+has no allocation tracer, so this counts what the codec builds per frame
+rather than every temporary allocation).
+"""
+
+import gc
+import struct
+import time
+
+import embedded_broker
+
+
+
+ENCODE_PUBLISH = "encode-publish"
+DECODE_DELIVER = "decode-deliver"
+DECODE_ACK = "decode-ack"
+
+CHANNEL_NUMBER = 1
+EXCHANGE = "test"
+ROUTING_KEY = "test"
+CONSUMER_TAG = "amq.ctag-codec"
+
+# Size of a frame's header and end octet, which the body frames' payloads
+# leave room for
+FRAME_OVERHEAD = 8
+
+# Number of results kept alive while counting the objects per frame
+NUM_RETAINED = 1000
+
+
+
+def makeHeaders(numHeaders):
+  """
+  :returns: dict of numHeaders string header fields
+  """
+  return dict(("x-header-%d" % i, "value-%d" % i) for i in xrange(numHeaders))
+
+
+
+def getNumContentFrames(bodySize, frameMax):
+  """
+  :returns: number of frames of a message with content: method, content
+    header and body frames
+  """
+  bodyMax = frameMax - FRAME_OVERHEAD
+  return 2 + (bodySize + bodyMax - 1) // bodyMax
+
+
+
+def encodeDeliver(body, headers, frameMax):
+  """
+  :returns: bytes of a basic.deliver with its content header and body frames
+    as the broker sends them
+  """
+  args = (embedded_broker._shortstr(CONSUMER_TAG) + struct.pack(">Q", 1) +
+          embedded_broker._bits(False) +
+          embedded_broker._shortstr(EXCHANGE) +
+          embedded_broker._shortstr(ROUTING_KEY))
+
+  # Only the headers property (flag bit 13) is present
+  header = struct.pack(">HHQH", embedded_broker.BASIC, 0, len(body),
+                       0x2000 if headers else 0)
+  if headers:
+    header += embedded_broker._table(headers)
+
+  pieces = [
+    embedded_broker.encodeMethodFrame(CHANNEL_NUMBER, embedded_broker.BASIC,
+                                      60, args),
+    embedded_broker.encodeFrame(embedded_broker.FRAME_HEADER, CHANNEL_NUMBER,
+                                header)]
+  bodyMax = frameMax - FRAME_OVERHEAD
+  for start in xrange(0, len(body), bodyMax):
+    pieces.append(embedded_broker.encodeFrame(
+      embedded_broker.FRAME_BODY, CHANNEL_NUMBER, body[start:start + bodyMax]))
+  return b"".join(pieces)
+
+
+
+def encodeAck():
+  """
+  :returns: bytes of a basic.ack frame as the broker sends it
+  """
+  return embedded_broker.encodeMethodFrame(
+    CHANNEL_NUMBER, embedded_broker.BASIC, 80,
+    struct.pack(">Q", 1) + embedded_broker._bits(False))
+
+
+
+def timeOperation(operation, iterations, repeat):
+  """Times operation() with the garbage collector disabled, like timeit
+
+  :returns: best seconds per call of the repeats
+  """
+  gcWasEnabled = gc.isenabled()
+  gc.disable()
+  try:
+    best = None
+    for _ in xrange(repeat):
+      startTime = time.time()
+      for _ in xrange(iterations):
+        operation()
+      elapsed = time.time() - startTime
+      if best is None or elapsed < best:
+        best = elapsed
+  finally:
+    if gcWasEnabled:
+      gc.enable()
+
+  return best / iterations
+
+
+
+def countRetainedObjects(operation):
+  """
+  :returns: mean number of garbage-collected objects that the result of
+    operation() keeps alive, from the garbage collector's count of
+    allocations minus deallocations
+  """
+  gcWasEnabled = gc.isenabled()
+  gc.collect()
+  gc.disable()
+  try:
+    results = [None] * NUM_RETAINED
+    startCount = gc.get_count()[0]
+    for i in xrange(NUM_RETAINED):
+      results[i] = operation()
+    numObjects = gc.get_count()[0] - startCount
+  finally:
+    if gcWasEnabled:
+      gc.enable()
+
+  return numObjects / float(NUM_RETAINED)
+
+
+
+def runCodecBenchmarks(codec, messageSizes, headerCounts, iterations, repeat,
+                       frameMax=embedded_broker.FRAME_MAX):
+  """Benchmarks a library's codec over the product of body and header table
+  sizes; basic.ack, which has neither, once
+
+  :param codec: client_adapter.FrameCodec instance
+  :param messageSizes: sequence of body sizes in bytes
+  :param headerCounts: sequence of numbers of header table fields
+  :param iterations: number of calls per timed repeat
+  :param repeat: number of timed repeats, of which the best counts
+  :returns: list of result dicts for printResultsTable
+  """
+  ackData = encodeAck()
+  cells = [(DECODE_ACK, None, None, lambda: codec.decodeFrames(ackData), 1)]
+
+  for messageSize in messageSizes:
+    body = b"a" * messageSize
+    numFrames = getNumContentFrames(messageSize, frameMax)
+    for numHeaders in headerCounts:
+      headers = makeHeaders(numHeaders)
+      deliverData = encodeDeliver(body, headers, frameMax)
+      cells.append((
+        ENCODE_PUBLISH, messageSize, numHeaders,
+        lambda body=body, headers=headers: codec.encodePublish(
+          CHANNEL_NUMBER, EXCHANGE, ROUTING_KEY, body, headers, frameMax),
+        numFrames))
+      cells.append((
+        DECODE_DELIVER, messageSize, numHeaders,
+        lambda deliverData=deliverData: codec.decodeFrames(deliverData),
+        numFrames))
+
+  results = []
+  for operationName, messageSize, numHeaders, operation, numFrames in cells:
+    result = dict(library=codec.LIBRARY,
+                  operation=operationName,
+                  messageSize=messageSize,
+                  numHeaders=numHeaders,
+                  framesPerOp=numFrames,
+                  error=None)
+    try:
+      secondsPerFrame = timeOperation(operation, iterations, repeat) / numFrames
+      objectsPerFrame = countRetainedObjects(operation) / numFrames
+    except Exception as e:
+      result["error"] = repr(e)
+    else:
+      result["nsPerFrame"] = secondsPerFrame * 1e9
+      result["framesPerSec"] = 1 / secondsPerFrame if secondsPerFrame else None
+      result["objectsPerFrame"] = objectsPerFrame
+    results.append(result)
+
+  return results
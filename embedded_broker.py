@@ -0,0 +1,1482 @@
+"""Minimal stand-in AMQP 0-9-1 broker for running the *_perf.py tests without
+RabbitMQ.
+
+Implements just enough of the protocol for the perf tests: connection/channel
+handshake, exchange/queue declare and delete, queue bind/unbind/purge,
+basic.qos/consume/cancel/publish/deliver/get/ack/nack/reject, confirm.select
+and tx.select/commit/rollback. Messages live in memory only.
+
+The broker is a single-threaded select-based event loop, so it can run either
+in-process on a background thread or as a separate process:
+
+  python embedded_broker.py --port=5672 --exg=test
+"""
+
+import collections
+from contextlib import contextmanager
+import errno
+import itertools
+import logging
+from optparse import OptionParser
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+
+
+g_log = logging.getLogger("embedded_broker")
+
+
+PROTOCOL_HEADER = b"AMQP\x00\x00\x09\x01"
+
+FRAME_METHOD = 1
+FRAME_HEADER = 2
+FRAME_BODY = 3
+FRAME_HEARTBEAT = 8
+FRAME_END = 0xCE
+
+FRAME_MAX = 131072
+CHANNEL_MAX = 2047
+
+# Reply codes
+REPLY_SUCCESS = 200
+NO_ROUTE = 312
+NOT_FOUND = 404
+PRECONDITION_FAILED = 406
+FRAME_ERROR = 501
+COMMAND_INVALID = 503
+CHANNEL_ERROR = 504
+UNEXPECTED_FRAME = 505
+NOT_IMPLEMENTED = 540
+
+# Class ids
+CONNECTION = 10
+CHANNEL = 20
+EXCHANGE = 40
+QUEUE = 50
+BASIC = 60
+CONFIRM = 85
+TX = 90
+
+# Stop handing deliveries to a connection whose unsent output exceeds this
+# many bytes; stands in for TCP back-pressure from a slow consumer
+MAX_PENDING_OUTPUT = 4 * 1024 * 1024
+
+# Broker modes accepted by addBrokerOption()/brokerContext()
+BROKER_EXTERNAL = "external"
+BROKER_EMBEDDED = "embedded"
+BROKER_EMBEDDED_INPROC = "embedded-inproc"
+
+BROKER_CHOICES = [BROKER_EXTERNAL, BROKER_EMBEDDED, BROKER_EMBEDDED_INPROC]
+
+_LISTENING_BANNER = "EMBEDDED_BROKER_LISTENING"
+
+
+if sys.version_info[0] >= 3:
+  def _toStr(value):
+    return value.decode("utf-8")
+
+  def _toBytes(value):
+    return value.encode("utf-8") if isinstance(value, str) else bytes(value)
+else:
+  def _toStr(value):
+    return bytes(value)
+
+  def _toBytes(value):
+    return value.encode("utf-8") if isinstance(value, unicode) else value
+
+
+
+class ChannelError(Exception):
+  """Soft error that closes only the offending channel"""
+  def __init__(self, replyCode, replyText):
+    super(ChannelError, self).__init__(replyCode, replyText)
+    self.replyCode = replyCode
+    self.replyText = replyText
+
+
+
+class ConnectionError(Exception):
+  """Hard error that closes the whole connection"""
+  def __init__(self, replyCode, replyText):
+    super(ConnectionError, self).__init__(replyCode, replyText)
+    self.replyCode = replyCode
+    self.replyText = replyText
+
+
+
+class _Reader(object):
+  """Decodes AMQP method arguments from a frame payload"""
+
+  __slots__ = ("buf", "pos", "bitOctet", "bitPos")
+
+  def __init__(self, buf, pos=0):
+    self.buf = buf
+    self.pos = pos
+    self.bitOctet = 0
+    self.bitPos = 8
+
+  def octet(self):
+    self.bitPos = 8
+    value, = struct.unpack_from(">B", self.buf, self.pos)
+    self.pos += 1
+    return value
+
+  def short(self):
+    self.bitPos = 8
+    value, = struct.unpack_from(">H", self.buf, self.pos)
+    self.pos += 2
+    return value
+
+  def long(self):
+    self.bitPos = 8
+    value, = struct.unpack_from(">I", self.buf, self.pos)
+    self.pos += 4
+    return value
+
+  def longlong(self):
+    self.bitPos = 8
+    value, = struct.unpack_from(">Q", self.buf, self.pos)
+    self.pos += 8
+    return value
+
+  def shortstr(self):
+    length = self.octet()
+    value = self.buf[self.pos:self.pos + length]
+    self.pos += length
+    return _toStr(bytes(value))
+
+  def longstr(self):
+    length = self.long()
+    value = self.buf[self.pos:self.pos + length]
+    self.pos += length
+    return bytes(value)
+
+  def table(self):
+    """Skips over a field table; the broker never needs its contents"""
+    length = self.long()
+    self.pos += length
+
+  def bit(self):
+    if self.bitPos == 8:
+      self.bitOctet, = struct.unpack_from(">B", self.buf, self.pos)
+      self.pos += 1
+      self.bitPos = 0
+    value = bool(self.bitOctet & (1 << self.bitPos))
+    self.bitPos += 1
+    return value
+
+
+
+def _shortstr(value):
+  value = _toBytes(value)
+  return struct.pack(">B", len(value)) + value
+
+
+
+def _longstr(value):
+  value = _toBytes(value)
+  return struct.pack(">I", len(value)) + value
+
+
+
+def _bits(*flags):
+  octet = 0
+  for i, flag in enumerate(flags):
+    if flag:
+      octet |= 1 << i
+  return struct.pack(">B", octet)
+
+
+
+def _table(fields):
+  """Encodes a dict as an AMQP field table; supports only the value types the
+  broker sends: bool, int, str and nested dict
+  """
+  pieces = []
+  for key, value in sorted(fields.items()):
+    pieces.append(_shortstr(key))
+    if isinstance(value, bool):
+      pieces.append(b"t" + struct.pack(">B", int(value)))
+    elif isinstance(value, int):
+      pieces.append(b"I" + struct.pack(">i", value))
+    elif isinstance(value, dict):
+      pieces.append(b"F" + _table(value))
+    else:
+      pieces.append(b"S" + _longstr(value))
+  payload = b"".join(pieces)
+  return struct.pack(">I", len(payload)) + payload
+
+
+
+def encodeFrame(frameType, channelNumber, payload):
+  """
+  :returns: bytes of a complete AMQP frame
+  """
+  return b"".join((struct.pack(">BHI", frameType, channelNumber, len(payload)),
+                   payload,
+                   b"\xce"))
+
+
+
+def encodeMethodFrame(channelNumber, classId, methodId, args=b""):
+  return encodeFrame(FRAME_METHOD, channelNumber,
+                     struct.pack(">HH", classId, methodId) + args)
+
+
+
+class Message(object):
+  """A published message held by the broker"""
+
+  __slots__ = ("exchange", "routingKey", "header", "body", "redelivered")
+
+  def __init__(self, exchange, routingKey, header, body):
+    self.exchange = exchange
+    self.routingKey = routingKey
+    # Raw content header frame payload, re-sent verbatim on delivery
+    self.header = header
+    self.body = body
+    self.redelivered = False
+
+
+
+class Exchange(object):
+
+  def __init__(self, name, exchangeType):
+    self.name = name
+    self.type = exchangeType
+    # list of (routingKey, queue name, routingKey split on "." for topics)
+    self.bindings = []
+
+
+  def bind(self, queueName, routingKey):
+    for key, qname, _words in self.bindings:
+      if key == routingKey and qname == queueName:
+        return
+    words = tuple(routingKey.split(".")) if self.type == "topic" else None
+    self.bindings.append((routingKey, queueName, words))
+
+
+  def unbind(self, queueName, routingKey=None):
+    self.bindings = [
+      b for b in self.bindings
+      if not (b[1] == queueName and (routingKey is None or b[0] == routingKey))]
+
+
+  def route(self, routingKey):
+    """
+    :returns: list of destination queue names
+    """
+    if self.type == "fanout":
+      return [qname for _key, qname, _words in self.bindings]
+    elif self.type == "topic":
+      keyWords = tuple(routingKey.split("."))
+      return [qname for _key, qname, words in self.bindings
+              if _topicMatches(words, keyWords)]
+    else:
+      return [qname for key, qname, _words in self.bindings
+              if key == routingKey]
+
+
+
+def _topicMatches(bindingWords, keyWords):
+  """
+  :param bindingWords: binding key split on "."
+  :param keyWords: routing key split on "."
+  :returns: True if the topic binding matches the routing key
+  """
+  if not bindingWords:
+    return not keyWords
+  word = bindingWords[0]
+  if word == "#":
+    return any(_topicMatches(bindingWords[1:], keyWords[i:])
+               for i in range(len(keyWords) + 1))
+  if not keyWords or (word != "*" and word != keyWords[0]):
+    return False
+  return _topicMatches(bindingWords[1:], keyWords[1:])
+
+
+
+def _getSettledTags(unackedTags, deliveryTag, multiple):
+  """
+  :param unackedTags: delivery tags of a channel's unacked deliveries, in
+    delivery order
+  :returns: list of the tags that a Basic.Ack/Reject/Nack settles
+  :raises ChannelError: if the delivery tag is unknown
+  """
+  if multiple:
+    if deliveryTag == 0:
+      return list(unackedTags)
+    tags = []
+    for tag in unackedTags:
+      if tag > deliveryTag:
+        break
+      tags.append(tag)
+    return tags
+  elif deliveryTag in unackedTags:
+    return [deliveryTag]
+  raise ChannelError(PRECONDITION_FAILED,
+                     "PRECONDITION_FAILED - unknown delivery tag %d"
+                     % (deliveryTag,))
+
+
+
+class Queue(object):
+
+  def __init__(self, name, autoDelete, exclusiveOwner):
+    self.name = name
+    self.autoDelete = autoDelete
+    self.exclusiveOwner = exclusiveOwner
+    self.messages = collections.deque()
+    self.consumers = collections.deque()
+    self.hadConsumers = False
+
+
+
+class Consumer(object):
+
+  __slots__ = ("tag", "channel", "queue", "noAck")
+
+  def __init__(self, tag, channel, queue, noAck):
+    self.tag = tag
+    self.channel = channel
+    self.queue = queue
+    self.noAck = noAck
+
+
+  def canAccept(self):
+    if self.noAck:
+      return True
+    prefetch = self.channel.prefetchCount
+    return not prefetch or len(self.channel.unacked) < prefetch
+
+
+
+class Channel(object):
+
+  def __init__(self, connection, number):
+    self.connection = connection
+    self.number = number
+    self.closing = False
+    self.prefetchCount = 0
+    self.consumers = {}
+    # deliveryTag -> (queue, message), in delivery order
+    self.unacked = collections.OrderedDict()
+    self.nextDeliveryTag = 1
+    self.confirmMode = False
+    self.publishSeqNo = 0
+    # Highest publishSeqNo acked so far
+    self.confirmedSeqNo = 0
+    self.txMode = False
+    self.txPublishes = []
+    # Basic.Ack/Reject/Nack deferred to tx.commit: (deliveryTag, multiple,
+    # requeue)
+    self.txAcks = []
+    # In-progress content: [publish args, header payload, body size, chunks,
+    # bytes received]
+    self.pendingContent = None
+
+
+
+class ClientConnection(object):
+
+  def __init__(self, broker, sock, address):
+    self.broker = broker
+    self.sock = sock
+    self.address = address
+    self.inbuf = bytearray()
+    # Don't bother parsing inbuf until it holds at least this many bytes
+    self.bytesNeeded = 0
+    self.outbuf = collections.deque()
+    self.outbufSize = 0
+    self.gotProtocolHeader = False
+    self.frameMax = FRAME_MAX
+    self.channels = {}
+    # Channels with publishes awaiting Basic.Ack
+    self.unconfirmedChannels = set()
+    self.closing = False
+    self.closed = False
+
+
+  def send(self, data):
+    self.outbuf.append(data)
+    self.outbufSize += len(data)
+
+
+  def sendMethod(self, channelNumber, classId, methodId, args=b""):
+    self.send(encodeMethodFrame(channelNumber, classId, methodId, args))
+
+
+  def flush(self):
+    """Writes as much pending output as the socket will take without blocking
+    """
+    while self.outbuf:
+      if len(self.outbuf) > 1:
+        data = b"".join(self.outbuf)
+        self.outbuf.clear()
+        self.outbuf.append(data)
+      else:
+        data = self.outbuf[0]
+
+      try:
+        numSent = self.sock.send(data)
+      except socket.error as e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          return
+        raise
+
+      self.outbufSize -= numSent
+      if numSent == len(data):
+        self.outbuf.popleft()
+      else:
+        self.outbuf[0] = data[numSent:]
+        return
+
+
+
+class EmbeddedBroker(object):
+  """In-memory AMQP 0-9-1 broker serving any number of client connections
+  from a single select loop
+  """
+
+  SERVER_PROPERTIES = {
+    "product": "amqp-perf embedded broker",
+    "version": "0.1",
+    "platform": "Python",
+    "capabilities": {
+      "publisher_confirms": True,
+      "basic.nack": True,
+      "consumer_cancel_notify": True,
+      "exchange_exchange_bindings": False,
+      "per_consumer_qos": False,
+      "authentication_failure_close": True,
+      "connection.blocked": False,
+    },
+  }
+
+
+  def __init__(self, host="127.0.0.1", port=0, exchanges=()):
+    """
+    :param host: interface to listen on
+    :param port: port to listen on; 0 picks a free ephemeral port
+    :param exchanges: names of direct exchanges to pre-declare, so that the
+      publish tests can be pointed at them via --exg
+    """
+    self._listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._listenSock.bind((host, port))
+    self._listenSock.listen(128)
+    self._listenSock.setblocking(False)
+    self.address = self._listenSock.getsockname()
+
+    self._connections = {}
+    self._exchanges = {}
+    self._queues = {}
+    self._dirtyQueues = set()
+    # Queues whose dispatch stopped because their consumers' connections had
+    # MAX_PENDING_OUTPUT unsent; dispatched again once output was flushed
+    self._backedUpQueues = set()
+    self._queueNameSeq = itertools.count(1)
+    self._consumerTagSeq = itertools.count(1)
+    self._stopRequested = False
+    self._thread = None
+
+    for name, exchangeType in [("", "direct"),
+                               ("amq.direct", "direct"),
+                               ("amq.fanout", "fanout"),
+                               ("amq.topic", "topic")]:
+      self._exchanges[name] = Exchange(name, exchangeType)
+
+    for name in exchanges:
+      self._exchanges[name] = Exchange(name, "direct")
+
+
+  @property
+  def port(self):
+    return self.address[1]
+
+
+  def start(self):
+    """Runs the broker's event loop on a daemon thread"""
+    assert self._thread is None
+    self._thread = threading.Thread(target=self.run, name="EmbeddedBroker")
+    self._thread.daemon = True
+    self._thread.start()
+    g_log.info("Started in-process embedded broker on %s:%s", *self.address)
+
+
+  def stop(self):
+    """Stops the event loop and closes all sockets"""
+    self._stopRequested = True
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+
+  def run(self):
+    """Runs the event loop until stop() is called"""
+    try:
+      while not self._stopRequested:
+        self._poll(timeout=0.1)
+    finally:
+      for conn in list(self._connections.values()):
+        self._dropConnection(conn)
+      self._listenSock.close()
+
+
+  def _poll(self, timeout):
+    readers = [self._listenSock]
+    readers.extend(self._connections)
+    writers = [sock for sock, conn in self._connections.items()
+               if conn.outbuf]
+
+    try:
+      readable, writable, _ = select.select(readers, writers, [], timeout)
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        return
+      raise
+
+    for sock in writable:
+      conn = self._connections.get(sock)
+      if conn is not None:
+        self._guard(conn, conn.flush)
+
+    if self._backedUpQueues:
+      self._dirtyQueues.update(self._backedUpQueues)
+      self._backedUpQueues.clear()
+
+    for sock in readable:
+      if sock is self._listenSock:
+        self._accept()
+      else:
+        conn = self._connections.get(sock)
+        if conn is not None:
+          self._guard(conn, lambda: self._onReadable(conn))
+
+    self._dispatchDeliveries()
+
+    for conn in list(self._connections.values()):
+      if conn.outbuf:
+        self._guard(conn, conn.flush)
+      if conn.closing and not conn.outbuf:
+        self._dropConnection(conn)
+
+
+  def _guard(self, conn, func):
+    try:
+      func()
+    except socket.error as e:
+      g_log.debug("Connection %s failed: %r", conn.address, e)
+      self._dropConnection(conn)
+
+
+  def _accept(self):
+    try:
+      sock, address = self._listenSock.accept()
+    except socket.error as e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        return
+      raise
+    sock.setblocking(False)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._connections[sock] = ClientConnection(self, sock, address)
+    g_log.debug("Accepted connection from %s", address)
+
+
+  def _dropConnection(self, conn):
+    if conn.closed:
+      return
+    conn.closed = True
+    for channel in list(conn.channels.values()):
+      self._releaseChannel(channel)
+    conn.channels.clear()
+    for queue in list(self._queues.values()):
+      if queue.exclusiveOwner is conn:
+        del self._queues[queue.name]
+        self._dirtyQueues.discard(queue)
+        self._backedUpQueues.discard(queue)
+    self._connections.pop(conn.sock, None)
+    try:
+      conn.sock.close()
+    except socket.error:
+      pass
+    g_log.debug("Dropped connection from %s", conn.address)
+
+
+  def _onReadable(self, conn):
+    try:
+      data = conn.sock.recv(65536)
+    except socket.error as e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        return
+      raise
+
+    if not data:
+      self._dropConnection(conn)
+      return
+
+    if conn.closing:
+      # Discard everything after connection.close, close-ok included, since
+      # the framing may be broken; the client closes the socket after its
+      # close-ok, which drops the connection above
+      return
+
+    conn.inbuf.extend(data)
+
+    try:
+      self._processInput(conn)
+    except ConnectionError as e:
+      g_log.debug("Closing connection %s: %s", conn.address, e)
+      conn.closing = True
+      conn.sendMethod(0, CONNECTION, 50,
+                      struct.pack(">H", e.replyCode) +
+                      _shortstr(e.replyText) + struct.pack(">HH", 0, 0))
+
+
+  def _processInput(self, conn):
+    buf = conn.inbuf
+
+    if not conn.gotProtocolHeader:
+      if len(buf) < len(PROTOCOL_HEADER):
+        return
+      if bytes(buf[:len(PROTOCOL_HEADER)]) != PROTOCOL_HEADER:
+        conn.send(PROTOCOL_HEADER)
+        conn.closing = True
+        return
+      del buf[:len(PROTOCOL_HEADER)]
+      conn.gotProtocolHeader = True
+      conn.sendMethod(0, CONNECTION, 10,
+                      struct.pack(">BB", 0, 9) +
+                      _table(self.SERVER_PROPERTIES) +
+                      _longstr("PLAIN AMQPLAIN") + _longstr("en_US"))
+
+    if len(buf) < conn.bytesNeeded:
+      return
+
+    data = bytes(buf)
+    offset = 0
+    dataLen = len(data)
+    try:
+      while not conn.closing:
+        if dataLen - offset < 8:
+          conn.bytesNeeded = 8
+          break
+        frameType, channelNumber, size = struct.unpack_from(">BHI", data,
+                                                            offset)
+        frameEnd = offset + 7 + size
+        if dataLen <= frameEnd:
+          conn.bytesNeeded = frameEnd + 1 - offset
+          break
+        if data[frameEnd:frameEnd + 1] != b"\xce":
+          raise ConnectionError(FRAME_ERROR, "FRAME_ERROR - bad frame end")
+
+        self._onFrame(conn, frameType, channelNumber,
+                      data[offset + 7:frameEnd])
+        offset = frameEnd + 1
+    finally:
+      del buf[:offset]
+
+    self._sendConfirms(conn)
+
+
+  def _onFrame(self, conn, frameType, channelNumber, payload):
+    if frameType == FRAME_HEARTBEAT:
+      return
+
+    if channelNumber == 0:
+      if frameType != FRAME_METHOD:
+        raise ConnectionError(UNEXPECTED_FRAME,
+                              "UNEXPECTED_FRAME - content on channel 0")
+      self._onConnectionMethod(conn, _Reader(payload))
+      return
+
+    channel = conn.channels.get(channelNumber)
+
+    if frameType == FRAME_METHOD:
+      reader = _Reader(payload)
+      classId = reader.short()
+      methodId = reader.short()
+
+      if channel is None:
+        if (classId, methodId) == (CHANNEL, 10):
+          self._onChannelOpen(conn, channelNumber)
+          return
+        raise ConnectionError(CHANNEL_ERROR,
+                              "CHANNEL_ERROR - unknown channel %d"
+                              % (channelNumber,))
+
+      if channel.pendingContent is not None:
+        raise ConnectionError(UNEXPECTED_FRAME,
+                              "UNEXPECTED_FRAME - method during content")
+
+      if channel.closing:
+        # Only channel.close-ok is of interest once we asked to close
+        if (classId, methodId) == (CHANNEL, 41):
+          self._releaseChannel(channel)
+          del conn.channels[channelNumber]
+        elif (classId, methodId) == (CHANNEL, 40):
+          conn.sendMethod(channelNumber, CHANNEL, 41)
+        return
+
+      handler = self._METHOD_HANDLERS.get((classId, methodId))
+      if handler is None:
+        raise ConnectionError(NOT_IMPLEMENTED,
+                              "NOT_IMPLEMENTED - method %d.%d"
+                              % (classId, methodId))
+      if (classId, methodId) != (BASIC, 40):
+        # Keep acks ahead of the replies to any later methods
+        self._sendChannelConfirm(channel)
+
+      try:
+        handler(self, channel, reader)
+      except ChannelError as e:
+        self._closeChannel(channel, e.replyCode, e.replyText, classId,
+                           methodId)
+
+    elif channel is None:
+      raise ConnectionError(CHANNEL_ERROR,
+                            "CHANNEL_ERROR - unknown channel %d"
+                            % (channelNumber,))
+
+    elif channel.closing:
+      # Drop content of publishes that raced with our channel.close
+      return
+
+    elif frameType == FRAME_HEADER:
+      content = channel.pendingContent
+      if content is None or content[1] is not None:
+        raise ConnectionError(UNEXPECTED_FRAME,
+                              "UNEXPECTED_FRAME - unexpected content header")
+      content[1] = payload
+      content[2], = struct.unpack_from(">Q", payload, 4)
+      if content[2] == 0:
+        self._completeContent(channel)
+
+    elif frameType == FRAME_BODY:
+      content = channel.pendingContent
+      if content is None or content[1] is None:
+        raise ConnectionError(UNEXPECTED_FRAME,
+                              "UNEXPECTED_FRAME - unexpected content body")
+      content[3].append(payload)
+      content[4] += len(payload)
+      if content[4] >= content[2]:
+        self._completeContent(channel)
+
+    else:
+      raise ConnectionError(FRAME_ERROR,
+                            "FRAME_ERROR - unknown frame type %d"
+                            % (frameType,))
+
+
+  def _onConnectionMethod(self, conn, reader):
+    classId = reader.short()
+    methodId = reader.short()
+
+    if classId != CONNECTION:
+      raise ConnectionError(COMMAND_INVALID,
+                            "COMMAND_INVALID - method %d.%d on channel 0"
+                            % (classId, methodId))
+
+    if methodId == 11:    # start-ok
+      conn.sendMethod(0, CONNECTION, 30,
+                      struct.pack(">HIH", CHANNEL_MAX, FRAME_MAX, 0))
+    elif methodId == 31:  # tune-ok
+      reader.short()
+      frameMax = reader.long()
+      if frameMax:
+        conn.frameMax = min(frameMax, FRAME_MAX)
+    elif methodId == 40:  # open
+      conn.sendMethod(0, CONNECTION, 41, _shortstr(""))
+    elif methodId == 50:  # close
+      conn.sendMethod(0, CONNECTION, 51)
+      conn.closing = True
+    elif methodId == 51:  # close-ok
+      self._dropConnection(conn)
+    else:
+      raise ConnectionError(NOT_IMPLEMENTED,
+                            "NOT_IMPLEMENTED - connection method %d"
+                            % (methodId,))
+
+
+  def _onChannelOpen(self, conn, channelNumber):
+    conn.channels[channelNumber] = Channel(conn, channelNumber)
+    conn.sendMethod(channelNumber, CHANNEL, 11, _longstr(""))
+
+
+  def _closeChannel(self, channel, replyCode, replyText, classId, methodId):
+    """Initiates a broker-side close of the channel due to a soft error"""
+    g_log.debug("Closing channel %d: %s %s", channel.number, replyCode,
+                replyText)
+    channel.closing = True
+    channel.pendingContent = None
+    self._releaseChannel(channel)
+    channel.connection.sendMethod(
+      channel.number, CHANNEL, 40,
+      struct.pack(">H", replyCode) + _shortstr(replyText) +
+      struct.pack(">HH", classId, methodId))
+
+
+  def _releaseChannel(self, channel):
+    """Cancels the channel's consumers and requeues its unacked messages"""
+    for consumer in list(channel.consumers.values()):
+      self._removeConsumer(consumer)
+    channel.consumers.clear()
+
+    for queue, message in reversed(list(channel.unacked.values())):
+      message.redelivered = True
+      queue.messages.appendleft(message)
+      self._dirtyQueues.add(queue)
+    channel.unacked.clear()
+
+
+  def _removeConsumer(self, consumer):
+    queue = consumer.queue
+    try:
+      queue.consumers.remove(consumer)
+    except ValueError:
+      pass
+    if queue.autoDelete and queue.hadConsumers and not queue.consumers:
+      self._deleteQueue(queue)
+
+
+  def _deleteQueue(self, queue):
+    self._queues.pop(queue.name, None)
+    self._dirtyQueues.discard(queue)
+    self._backedUpQueues.discard(queue)
+    for exchange in self._exchanges.values():
+      exchange.unbind(queue.name)
+    for consumer in list(queue.consumers):
+      consumer.channel.consumers.pop(consumer.tag, None)
+      # Let the client know, as RabbitMQ does with consumer_cancel_notify
+      consumer.channel.connection.sendMethod(
+        consumer.channel.number, BASIC, 30, _shortstr(consumer.tag) + _bits(True))
+    queue.consumers.clear()
+
+
+  def _getQueue(self, channel, name):
+    queue = self._queues.get(name)
+    if queue is None:
+      raise ChannelError(NOT_FOUND, "NOT_FOUND - no queue '%s'" % (name,))
+    if (queue.exclusiveOwner is not None and
+        queue.exclusiveOwner is not channel.connection):
+      raise ChannelError(405, "RESOURCE_LOCKED - exclusive queue '%s'"
+                         % (name,))
+    return queue
+
+
+  def _getExchange(self, name):
+    exchange = self._exchanges.get(name)
+    if exchange is None:
+      raise ChannelError(NOT_FOUND, "NOT_FOUND - no exchange '%s'" % (name,))
+    return exchange
+
+
+  #
+  # Channel-level method handlers
+  #
+
+  def _onChannelClose(self, channel, reader):
+    conn = channel.connection
+    self._releaseChannel(channel)
+    del conn.channels[channel.number]
+    conn.sendMethod(channel.number, CHANNEL, 41)
+
+
+  def _onChannelFlow(self, channel, reader):
+    channel.connection.sendMethod(channel.number, CHANNEL, 21,
+                                  _bits(reader.bit()))
+
+
+  def _onExchangeDeclare(self, channel, reader):
+    reader.short()
+    name = reader.shortstr()
+    exchangeType = reader.shortstr()
+    passive = reader.bit()
+    reader.bit()  # durable
+    reader.bit()  # auto-delete
+    reader.bit()  # internal
+    noWait = reader.bit()
+    reader.table()
+
+    exchange = self._exchanges.get(name)
+    if exchange is None:
+      if passive:
+        raise ChannelError(NOT_FOUND, "NOT_FOUND - no exchange '%s'" % (name,))
+      if exchangeType not in ("direct", "fanout", "topic"):
+        raise ConnectionError(COMMAND_INVALID,
+                              "COMMAND_INVALID - unsupported exchange type '%s'"
+                              % (exchangeType,))
+      self._exchanges[name] = Exchange(name, exchangeType)
+    elif not passive and exchange.type != exchangeType:
+      raise ChannelError(PRECONDITION_FAILED,
+                         "PRECONDITION_FAILED - exchange '%s' is of type '%s'"
+                         % (name, exchange.type))
+
+    if not noWait:
+      channel.connection.sendMethod(channel.number, EXCHANGE, 11)
+
+
+  def _onExchangeDelete(self, channel, reader):
+    reader.short()
+    name = reader.shortstr()
+    reader.bit()  # if-unused
+    noWait = reader.bit()
+    self._getExchange(name)
+    del self._exchanges[name]
+    if not noWait:
+      channel.connection.sendMethod(channel.number, EXCHANGE, 21)
+
+
+  def _onQueueDeclare(self, channel, reader):
+    reader.short()
+    name = reader.shortstr()
+    passive = reader.bit()
+    reader.bit()  # durable
+    exclusive = reader.bit()
+    autoDelete = reader.bit()
+    noWait = reader.bit()
+    reader.table()
+
+    if passive:
+      queue = self._getQueue(channel, name)
+    else:
+      if not name:
+        name = "amq.gen-%d" % (next(self._queueNameSeq),)
+      queue = self._queues.get(name)
+      if queue is None:
+        queue = Queue(name, autoDelete,
+                      channel.connection if exclusive else None)
+        self._queues[name] = queue
+        self._exchanges[""].bind(name, name)
+      else:
+        self._getQueue(channel, name)
+
+    if not noWait:
+      channel.connection.sendMethod(
+        channel.number, QUEUE, 11,
+        _shortstr(name) +
+        struct.pack(">II", len(queue.messages), len(queue.consumers)))
+
+
+  def _onQueueBind(self, channel, reader):
+    reader.short()
+    queueName = reader.shortstr()
+    exchangeName = reader.shortstr()
+    routingKey = reader.shortstr()
+    noWait = reader.bit()
+    reader.table()
+
+    queue = self._getQueue(channel, queueName)
+    self._getExchange(exchangeName).bind(queue.name, routingKey)
+    if not noWait:
+      channel.connection.sendMethod(channel.number, QUEUE, 21)
+
+
+  def _onQueueUnbind(self, channel, reader):
+    reader.short()
+    queueName = reader.shortstr()
+    exchangeName = reader.shortstr()
+    routingKey = reader.shortstr()
+    reader.table()
+
+    self._getExchange(exchangeName).unbind(queueName, routingKey)
+    channel.connection.sendMethod(channel.number, QUEUE, 51)
+
+
+  def _onQueuePurge(self, channel, reader):
+    reader.short()
+    queue = self._getQueue(channel, reader.shortstr())
+    noWait = reader.bit()
+    count = len(queue.messages)
+    queue.messages.clear()
+    if not noWait:
+      channel.connection.sendMethod(channel.number, QUEUE, 31,
+                                    struct.pack(">I", count))
+
+
+  def _onQueueDelete(self, channel, reader):
+    reader.short()
+    queue = self._getQueue(channel, reader.shortstr())
+    reader.bit()  # if-unused
+    reader.bit()  # if-empty
+    noWait = reader.bit()
+    count = len(queue.messages)
+    self._deleteQueue(queue)
+    if not noWait:
+      channel.connection.sendMethod(channel.number, QUEUE, 41,
+                                    struct.pack(">I", count))
+
+
+  def _onBasicQos(self, channel, reader):
+    reader.long()  # prefetch-size
+    channel.prefetchCount = reader.short()
+    reader.bit()  # global
+    for consumer in channel.consumers.values():
+      self._dirtyQueues.add(consumer.queue)
+    channel.connection.sendMethod(channel.number, BASIC, 11)
+
+
+  def _onBasicConsume(self, channel, reader):
+    reader.short()
+    queue = self._getQueue(channel, reader.shortstr())
+    tag = reader.shortstr()
+    reader.bit()  # no-local
+    noAck = reader.bit()
+    reader.bit()  # exclusive
+    noWait = reader.bit()
+    reader.table()
+
+    if not tag:
+      tag = "amq.ctag-%d" % (next(self._consumerTagSeq),)
+    elif tag in channel.consumers:
+      raise ConnectionError(530, "NOT_ALLOWED - reused consumer tag '%s'"
+                            % (tag,))
+
+    consumer = Consumer(tag, channel, queue, noAck)
+    channel.consumers[tag] = consumer
+    queue.consumers.append(consumer)
+    queue.hadConsumers = True
+    self._dirtyQueues.add(queue)
+
+    if not noWait:
+      channel.connection.sendMethod(channel.number, BASIC, 21, _shortstr(tag))
+
+
+  def _onBasicCancel(self, channel, reader):
+    tag = reader.shortstr()
+    noWait = reader.bit()
+    consumer = channel.consumers.pop(tag, None)
+    if consumer is not None:
+      self._removeConsumer(consumer)
+    if not noWait:
+      channel.connection.sendMethod(channel.number, BASIC, 31, _shortstr(tag))
+
+
+  def _onBasicPublish(self, channel, reader):
+    reader.short()
+    exchange = reader.shortstr()
+    routingKey = reader.shortstr()
+    mandatory = reader.bit()
+    # Content header and body frames follow: [args, header, size, chunks, got]
+    channel.pendingContent = [(exchange, routingKey, mandatory), None, 0, [], 0]
+
+
+  def _completeContent(self, channel):
+    """Publishes the channel's completed content; errors close the channel
+    as failures of the Basic.Publish that started the content
+    """
+    try:
+      self._onContentComplete(channel)
+    except ChannelError as e:
+      self._closeChannel(channel, e.replyCode, e.replyText, BASIC, 40)
+
+
+  def _onContentComplete(self, channel):
+    (exchange, routingKey, mandatory), header, _size, chunks, _got = (
+      channel.pendingContent)
+    channel.pendingContent = None
+    message = Message(exchange, routingKey, header, b"".join(chunks))
+
+    if channel.txMode:
+      self._getExchange(exchange)
+      channel.txPublishes.append((message, mandatory))
+    else:
+      self._publish(channel, message, mandatory)
+
+    if channel.confirmMode:
+      channel.publishSeqNo += 1
+      channel.connection.unconfirmedChannels.add(channel)
+
+
+  def _sendConfirms(self, conn):
+    """Acks the publishes received in the latest batch of input. Like
+    RabbitMQ, this coalesces consecutive confirms into one Basic.Ack with
+    multiple=True, which is what windowed publishers get to see.
+    """
+    for channel in conn.unconfirmedChannels:
+      self._sendChannelConfirm(channel)
+    conn.unconfirmedChannels.clear()
+
+
+  def _sendChannelConfirm(self, channel):
+    numUnconfirmed = channel.publishSeqNo - channel.confirmedSeqNo
+    if not numUnconfirmed or channel.closing or channel.connection.closing:
+      return
+    channel.connection.sendMethod(
+      channel.number, BASIC, 80,
+      struct.pack(">Q", channel.publishSeqNo) + _bits(numUnconfirmed > 1))
+    channel.confirmedSeqNo = channel.publishSeqNo
+
+
+  def _publish(self, channel, message, mandatory):
+    exchange = self._exchanges.get(message.exchange)
+    if exchange is None:
+      raise ChannelError(NOT_FOUND, "NOT_FOUND - no exchange '%s'"
+                         % (message.exchange,))
+
+    queueNames = exchange.route(message.routingKey)
+    routed = False
+    for qname in queueNames:
+      queue = self._queues.get(qname)
+      if queue is not None:
+        queue.messages.append(message)
+        self._dirtyQueues.add(queue)
+        routed = True
+
+    if not routed and mandatory:
+      self._sendContent(
+        channel, BASIC, 50,
+        struct.pack(">H", NO_ROUTE) + _shortstr("NO_ROUTE") +
+        _shortstr(message.exchange) + _shortstr(message.routingKey),
+        message)
+
+
+  def _sendContent(self, channel, classId, methodId, args, message):
+    conn = channel.connection
+    conn.sendMethod(channel.number, classId, methodId, args)
+    conn.send(encodeFrame(FRAME_HEADER, channel.number, message.header))
+    body = message.body
+    chunkSize = conn.frameMax - 8
+    for i in range(0, len(body), chunkSize):
+      conn.send(encodeFrame(FRAME_BODY, channel.number, body[i:i + chunkSize]))
+
+
+  def _onBasicGet(self, channel, reader):
+    reader.short()
+    queue = self._getQueue(channel, reader.shortstr())
+    noAck = reader.bit()
+
+    if not queue.messages:
+      channel.connection.sendMethod(channel.number, BASIC, 72, _shortstr(""))
+      return
+
+    message = queue.messages.popleft()
+    deliveryTag = channel.nextDeliveryTag
+    channel.nextDeliveryTag += 1
+    if not noAck:
+      channel.unacked[deliveryTag] = (queue, message)
+    self._sendContent(
+      channel, BASIC, 71,
+      struct.pack(">Q", deliveryTag) + _bits(message.redelivered) +
+      _shortstr(message.exchange) + _shortstr(message.routingKey) +
+      struct.pack(">I", len(queue.messages)),
+      message)
+
+
+  def _onBasicAck(self, channel, reader):
+    deliveryTag = reader.longlong()
+    multiple = reader.bit()
+    self._settleOrDefer(channel, deliveryTag, multiple, requeue=False)
+
+
+  def _onBasicReject(self, channel, reader):
+    deliveryTag = reader.longlong()
+    requeue = reader.bit()
+    self._settleOrDefer(channel, deliveryTag, False, requeue=requeue)
+
+
+  def _onBasicNack(self, channel, reader):
+    deliveryTag = reader.longlong()
+    multiple = reader.bit()
+    requeue = reader.bit()
+    self._settleOrDefer(channel, deliveryTag, multiple, requeue=requeue)
+
+
+  def _settleOrDefer(self, channel, deliveryTag, multiple, requeue):
+    """Settles the given delivery, or defers it to tx.commit in tx mode"""
+    if channel.txMode:
+      channel.txAcks.append((deliveryTag, multiple, requeue))
+    else:
+      self._settle(channel, deliveryTag, multiple, requeue)
+
+
+  def _settle(self, channel, deliveryTag, multiple, requeue):
+    """Removes the given delivery (or all up to and including it, if
+    multiple) from the channel's unacked set
+    """
+    unacked = channel.unacked
+    settled = [unacked.pop(tag)
+               for tag in _getSettledTags(unacked, deliveryTag, multiple)]
+    if requeue:
+      for queue, message in reversed(settled):
+        message.redelivered = True
+        queue.messages.appendleft(message)
+
+    # Freed prefetch capacity may allow more deliveries
+    for consumer in channel.consumers.values():
+      self._dirtyQueues.add(consumer.queue)
+
+
+  def _onBasicRecover(self, channel, reader):
+    reader.bit()  # requeue; always requeue, as RabbitMQ does
+    for queue, message in reversed(list(channel.unacked.values())):
+      message.redelivered = True
+      queue.messages.appendleft(message)
+      self._dirtyQueues.add(queue)
+    channel.unacked.clear()
+    channel.connection.sendMethod(channel.number, BASIC, 111)
+
+
+  def _onConfirmSelect(self, channel, reader):
+    if channel.txMode:
+      raise ChannelError(PRECONDITION_FAILED,
+                         "PRECONDITION_FAILED - channel is transactional")
+    noWait = reader.bit()
+    channel.confirmMode = True
+    if not noWait:
+      channel.connection.sendMethod(channel.number, CONFIRM, 11)
+
+
+  def _onTxSelect(self, channel, reader):
+    if channel.confirmMode:
+      raise ChannelError(PRECONDITION_FAILED,
+                         "PRECONDITION_FAILED - channel is in confirm mode")
+    channel.txMode = True
+    channel.connection.sendMethod(channel.number, TX, 11)
+
+
+  def _onTxCommit(self, channel, reader):
+    if not channel.txMode:
+      raise ChannelError(PRECONDITION_FAILED,
+                         "PRECONDITION_FAILED - channel is not transactional")
+    publishes, channel.txPublishes = channel.txPublishes, []
+    acks, channel.txAcks = channel.txAcks, []
+
+    # Check the whole transaction before applying any of it, so that an
+    # unknown exchange or delivery tag doesn't leave it half-committed
+    for message, _mandatory in publishes:
+      self._getExchange(message.exchange)
+    unackedTags = collections.OrderedDict.fromkeys(channel.unacked)
+    for deliveryTag, multiple, _requeue in acks:
+      for tag in _getSettledTags(unackedTags, deliveryTag, multiple):
+        del unackedTags[tag]
+
+    for message, mandatory in publishes:
+      self._publish(channel, message, mandatory)
+    for deliveryTag, multiple, requeue in acks:
+      self._settle(channel, deliveryTag, multiple, requeue)
+    channel.connection.sendMethod(channel.number, TX, 21)
+
+
+  def _onTxRollback(self, channel, reader):
+    if not channel.txMode:
+      raise ChannelError(PRECONDITION_FAILED,
+                         "PRECONDITION_FAILED - channel is not transactional")
+    del channel.txPublishes[:]
+    del channel.txAcks[:]
+    channel.connection.sendMethod(channel.number, TX, 31)
+
+
+  _METHOD_HANDLERS = {
+    (CHANNEL, 20): _onChannelFlow,
+    (CHANNEL, 40): _onChannelClose,
+    (EXCHANGE, 10): _onExchangeDeclare,
+    (EXCHANGE, 20): _onExchangeDelete,
+    (QUEUE, 10): _onQueueDeclare,
+    (QUEUE, 20): _onQueueBind,
+    (QUEUE, 30): _onQueuePurge,
+    (QUEUE, 40): _onQueueDelete,
+    (QUEUE, 50): _onQueueUnbind,
+    (BASIC, 10): _onBasicQos,
+    (BASIC, 20): _onBasicConsume,
+    (BASIC, 30): _onBasicCancel,
+    (BASIC, 40): _onBasicPublish,
+    (BASIC, 70): _onBasicGet,
+    (BASIC, 80): _onBasicAck,
+    (BASIC, 90): _onBasicReject,
+    (BASIC, 110): _onBasicRecover,
+    (BASIC, 120): _onBasicNack,
+    (CONFIRM, 10): _onConfirmSelect,
+    (TX, 10): _onTxSelect,
+    (TX, 20): _onTxCommit,
+    (TX, 30): _onTxRollback,
+  }
+
+
+  def _dispatchDeliveries(self):
+    """Hands queued messages to consumers round-robin, honoring basic.qos
+    prefetch limits
+    """
+    while self._dirtyQueues:
+      queue = self._dirtyQueues.pop()
+      messages = queue.messages
+      consumers = queue.consumers
+
+      while messages and consumers:
+        for _ in range(len(consumers)):
+          consumer = consumers[0]
+          consumers.rotate(-1)
+          if (consumer.canAccept() and
+              consumer.channel.connection.outbufSize < MAX_PENDING_OUTPUT):
+            break
+        else:
+          # Every consumer is at its prefetch limit or backed up
+          if any(consumer.channel.connection.outbufSize >= MAX_PENDING_OUTPUT
+                 for consumer in consumers):
+            self._backedUpQueues.add(queue)
+          break
+
+        self._deliver(consumer, messages.popleft())
+
+
+  def _deliver(self, consumer, message):
+    channel = consumer.channel
+    deliveryTag = channel.nextDeliveryTag
+    channel.nextDeliveryTag += 1
+    if not consumer.noAck:
+      channel.unacked[deliveryTag] = (consumer.queue, message)
+    self._sendContent(
+      channel, BASIC, 60,
+      _shortstr(consumer.tag) + struct.pack(">Q", deliveryTag) +
+      _bits(message.redelivered) + _shortstr(message.exchange) +
+      _shortstr(message.routingKey),
+      message)
+
+
+
+def addBrokerOption(parser):
+  """Adds the --broker option to the given OptionParser"""
+  parser.add_option(
+      "--broker",
+      action="store",
+      type="choice",
+      dest="broker",
+      choices=BROKER_CHOICES,
+      default=BROKER_EXTERNAL,
+      help=("Broker to run against: %s - AMQP broker on localhost:5672; "
+            "%s - stand-in broker started in a subprocess; "
+            "%s - stand-in broker started on a thread of this process "
+            "[default: %%default]" % tuple(BROKER_CHOICES)))
+
+
+
+@contextmanager
+def brokerContext(mode, exchanges=()):
+  """Starts the requested stand-in broker, if any, for the duration of the
+  context
+
+  :param mode: one of BROKER_CHOICES
+  :param exchanges: names of exchanges for the stand-in broker to pre-declare
+  :returns: context manager yielding the (host, port) of the started broker or
+    None when mode is BROKER_EXTERNAL
+  """
+  if mode == BROKER_EXTERNAL:
+    yield None
+
+  elif mode == BROKER_EMBEDDED_INPROC:
+    broker = EmbeddedBroker(exchanges=exchanges)
+    broker.start()
+    try:
+      yield broker.address
+    finally:
+      broker.stop()
+
+  else:
+    assert mode == BROKER_EMBEDDED, mode
+    proc, address = startBrokerSubprocess(exchanges=exchanges)
+    try:
+      yield address
+    finally:
+      proc.terminate()
+      proc.wait()
+
+
+
+def startBrokerSubprocess(exchanges=()):
+  """Launches the stand-in broker as a child process listening on an ephemeral
+  port
+
+  :returns: (subprocess.Popen, (host, port)) tuple
+  """
+  args = [sys.executable, os.path.abspath(__file__), "--port=0", "--announce"]
+  args.extend("--exg=%s" % (name,) for name in exchanges)
+  proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+
+  line = proc.stdout.readline().decode("ascii").split()
+  if len(line) != 3 or line[0] != _LISTENING_BANNER:
+    proc.kill()
+    proc.wait()
+    raise RuntimeError("Embedded broker subprocess failed to start: %r"
+                       % (line,))
+  address = (line[1], int(line[2]))
+  g_log.info("Started embedded broker subprocess pid=%s on %s:%s", proc.pid,
+             *address)
+  return proc, address
+
+
+
+def main():
+  logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)-15s %(name)s(%(process)s) - %(levelname)s - %(message)s',
+    disable_existing_loggers=False)
+
+  helpString = (
+    "\n"
+    "\t%prog OPTIONS\n"
+    "\t%prog --help\n"
+    "\n"
+    "Runs a minimal in-memory AMQP 0-9-1 broker for the perf tests")
+
+  parser = OptionParser(helpString)
+
+  parser.add_option(
+      "--host",
+      action="store",
+      type="string",
+      dest="host",
+      default="127.0.0.1",
+      help="Interface to listen on [default: %default]")
+
+  parser.add_option(
+      "--port",
+      action="store",
+      type="int",
+      dest="port",
+      default=5672,
+      help="Port to listen on; 0 for an ephemeral port [default: %default]")
+
+  parser.add_option(
+      "--exg",
+      action="append",
+      type="string",
+      dest="exchanges",
+      default=[],
+      help="Direct exchange to pre-declare; may be repeated")
+
+  parser.add_option(
+      "--announce",
+      action="store_true",
+      dest="announce",
+      default=False,
+      help=("Print the listening address to stdout once ready "
+            "[defaults to OFF]"))
+
+  options, positionalArgs = parser.parse_args()
+
+  if positionalArgs:
+    raise parser.error("Unexpected to have any positional args, but got: %r"
+                       % positionalArgs)
+
+  broker = EmbeddedBroker(host=options.host, port=options.port,
+                          exchanges=options.exchanges)
+  g_log.info("Embedded broker listening on %s:%s", *broker.address)
+
+  if options.announce:
+    sys.stdout.write("%s %s %s\n" % ((_LISTENING_BANNER,) + broker.address))
+    sys.stdout.flush()
+
+  try:
+    broker.run()
+  except KeyboardInterrupt:
+    pass
+
+
+
+if __name__ == '__main__':
+  main()
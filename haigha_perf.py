@@ -4,12 +4,24 @@
 import collections
 import logging
 from optparse import OptionParser
+import select
 import socket
 import sys
+import time
 
 from haigha.connections.rabbit_connection import RabbitConnection
+from haigha.frames.content_frame import ContentFrame
+from haigha.frames.frame import Frame
+from haigha.frames.header_frame import HeaderFrame
+from haigha.frames.method_frame import MethodFrame
 from haigha.message import Message
+from haigha.reader import Reader
 from haigha.transports import socket_transport
+from haigha.writer import Writer
+
+import client_adapter
+import embedded_broker
+import perf_stats
 
 
 
@@ -122,6 +134,10 @@ def _handlePublishTest(args):
       default=False,
       help="Publish in delivery confirmation mode [defaults to OFF]")
 
+  perf_stats.addConfirmWindowOption(parser)
+
+  embedded_broker.addBrokerOption(parser)
+
   options, positionalArgs = parser.parse_args(sys.argv[2:])
 
   if positionalArgs:
@@ -134,15 +150,19 @@ def _handlePublishTest(args):
   if options.exchange is None:
     parser.error("--exg must be specified with a valid destination exchange name")
 
-  if options.impl == "SocketTransport":
+  if options.impl != "SocketTransport":
+    parser.error("unexpected impl=%r" % (options.impl,))
+
+  with embedded_broker.brokerContext(
+      options.broker, exchanges=[options.exchange]) as brokerAddress:
     runBlockingSocketPublishTest(
       implClassName=options.impl,
       exchange=options.exchange,
       numMessages=options.numMessages,
       messageSize=options.messageSize,
-      deliveryConfirmation=options.deliveryConfirmation)
-  else:
-    parser.error("unexpected impl=%r" % (options.impl,))
+      deliveryConfirmation=options.deliveryConfirmation,
+      confirmWindow=options.confirmWindow,
+      brokerAddress=brokerAddress)
 
 
 
@@ -150,11 +170,13 @@ def runBlockingSocketPublishTest(implClassName,
                                  exchange,
                                  numMessages,
                                  messageSize,
-                                 deliveryConfirmation):
+                                 deliveryConfirmation,
+                                 confirmWindow,
+                                 brokerAddress):
   g_log.info(
     "runBlockingSocketPublishTest: impl=%s; exchange=%s; numMessages=%d; "
-    "messageSize=%s; deliveryConfirmation=%s", implClassName, exchange,
-    numMessages, messageSize, deliveryConfirmation)
+    "messageSize=%s; deliveryConfirmation=%s; confirmWindow=%s", implClassName,
+    exchange, numMessages, messageSize, deliveryConfirmation, confirmWindow)
 
   implClass = getattr(socket_transport, implClassName)
   assert implClass is socket_transport.SocketTransport, implClass
@@ -162,9 +184,10 @@ def runBlockingSocketPublishTest(implClassName,
 
   payload = "a" * messageSize
 
+  confirms = perf_stats.ConfirmTracker()
+
   class State(object):
     closing = False
-    publishConfirm = False
     channelClosed = False
     connectionClosed = False
     connection = None
@@ -180,7 +203,7 @@ def runBlockingSocketPublishTest(implClassName,
     transport="socket",
     sock_opts={(socket.IPPROTO_TCP, socket.TCP_NODELAY) : 1},
     close_cb=onConnectionClosed,
-    **getConnectionParameters())
+    **getConnectionParameters(brokerAddress))
   g_log.info("%s: opened connection", implClassName)
 
 
@@ -198,12 +221,14 @@ def runBlockingSocketPublishTest(implClassName,
   if deliveryConfirmation:
     channel.confirm.select()
 
+    # NOTE: haigha invokes the ack listener once per message even when the
+    # broker acks several of them with multiple=True
     def ack(mid):
-      State.publishConfirm = True
+      confirms.onAck(mid, False)
 
     def nack(mid):
       g_log.error("Got Nack from broker")
-      raise RuntimeError("Got Nack from broker")
+      confirms.onNack(mid, False)
 
     channel.basic.set_ack_listener( ack )
     channel.basic.set_nack_listener( nack )
@@ -214,20 +239,26 @@ def runBlockingSocketPublishTest(implClassName,
 
   # Publish
 
+  startTime = time.time()
+
   for i in xrange(numMessages):
-    assert not State.publishConfirm
+    if deliveryConfirmation:
+      while confirms.numOutstanding >= confirmWindow:
+        conn.read_frames()
+      confirms.onPublish()
     message = Message(payload)
     channel.basic.publish(message, exchange=exchange, routing_key=ROUTING_KEY,
                           immediate=False, mandatory=False)
-    if deliveryConfirmation:
-      while not State.publishConfirm:
-        conn.read_frames()
-      else:
-        State.publishConfirm = False
   else:
     g_log.info("Published %d messages of size=%d via=%s",
                i+1, messageSize, implClass)
 
+  while confirms.numOutstanding:
+    conn.read_frames()
+
+  perf_stats.logPublishStats(g_log, implClassName, numMessages, messageSize,
+                             time.time() - startTime, confirms)
+
   State.closing = True
 
   g_log.info("%s: closing channel", implClassName)
@@ -240,8 +271,6 @@ def runBlockingSocketPublishTest(implClassName,
   while not State.connectionClosed:
     conn.read_frames()
 
-  assert not State.publishConfirm
-
   g_log.info("%s: DONE", implClassName)
 
 
@@ -309,6 +338,8 @@ def _handleAlternatingPubConsumeTest(args):
       default=False,
       help="Publish in delivery confirmation mode [defaults to OFF]")
 
+  embedded_broker.addBrokerOption(parser)
+
   options, positionalArgs = parser.parse_args(sys.argv[2:])
 
   if positionalArgs:
@@ -318,15 +349,17 @@ def _handleAlternatingPubConsumeTest(args):
   if not options.impl:
     parser.error("--impl is required")
 
-  if options.impl == "SocketTransport":
+  if options.impl != "SocketTransport":
+    parser.error("unexpected impl=%r" % (options.impl,))
+
+  with embedded_broker.brokerContext(options.broker) as brokerAddress:
     runBlockingSocketAltPubConsumeTest(
       implClassName=options.impl,
       numMessages=options.numMessages,
       messageSize=options.messageSize,
       useConsumerAcks=options.useConsumerAcks,
-      deliveryConfirmation=options.deliveryConfirmation)
-  else:
-    parser.error("unexpected impl=%r" % (options.impl,))
+      deliveryConfirmation=options.deliveryConfirmation,
+      brokerAddress=brokerAddress)
 
 
 
@@ -334,7 +367,8 @@ def runBlockingSocketAltPubConsumeTest(implClassName,
                                        numMessages,
                                        messageSize,
                                        useConsumerAcks,
-                                       deliveryConfirmation):
+                                       deliveryConfirmation,
+                                       brokerAddress):
   """Alternates publishing/consuming the given number of messages of the
   given size one message at a time via default exchange
   """
@@ -369,7 +403,7 @@ def runBlockingSocketAltPubConsumeTest(implClassName,
     transport="socket",
     sock_opts={(socket.IPPROTO_TCP, socket.TCP_NODELAY) : 1},
     close_cb=onConnectionClosed,
-    **getConnectionParameters())
+    **getConnectionParameters(brokerAddress))
   g_log.info("%s: opened connection", implClassName)
 
 
@@ -436,9 +470,13 @@ def runBlockingSocketAltPubConsumeTest(implClassName,
   g_log.info("%s: created consumer", implClassName)
 
   # Publish/consume
+  roundTrips = perf_stats.LatencyHistogram()
+
   for i in xrange(numMessages):
     assert not State.incomingMsgs, State.incomingMsgs
 
+    sendTime = time.time()
+
     msgId = publish()
 
     # Wait for incoming
@@ -454,10 +492,14 @@ def runBlockingSocketAltPubConsumeTest(implClassName,
       # print >> sys.stderr, "ZZZ delivery_info:", msg.delivery_info
       channel.basic.ack(msg.delivery_info["delivery_tag"])
 
+    roundTrips.record(time.time() - sendTime)
+
   else:
     g_log.info("Published %d messages of size=%d via=%s",
                i+1, messageSize, implClass)
 
+  perf_stats.logLatency(g_log, implClassName, "round-trip", roundTrips)
+
 
   State.closing = True
 
@@ -479,17 +521,207 @@ def runBlockingSocketAltPubConsumeTest(implClassName,
 
 
 
+class _SocketTransport(socket_transport.SocketTransport):
+  """SocketTransport that looks up socket.socket when connecting instead of
+  binding it as a default arg at import time, so that
+  socket_stats.instrumentSockets() applies to haigha too
+  """
+
+  def connect(self, address, klass=None):
+    super(_SocketTransport, self).connect(address, klass=klass or socket.socket)
+
+
+
+class _RabbitConnection(RabbitConnection):
+  """RabbitConnection over _SocketTransport"""
+
+  def __init__(self, **kwargs):
+    super(_RabbitConnection, self).__init__(transport=_SocketTransport(self),
+                                            **kwargs)
+
+
+
+class HaighaSocketTransportAdapter(client_adapter.ClientAdapter):
+  """amqp_perf adapter for haigha RabbitConnection over the blocking
+  SocketTransport
+  """
+
+  LIBRARY = "haigha"
+  IMPL = "SocketTransport"
+  SUPPORTS_TRANSACTIONS = True
+
+
+  def connect(self, deliveryConfirmation):
+    self._closing = False
+    self._closed = False
+
+    def onConnectionClosed():
+      self._closed = True
+      assert self._closing, "unexpected connection-close"
+
+    self._connection = _RabbitConnection(
+      sock_opts={(socket.IPPROTO_TCP, socket.TCP_NODELAY) : 1},
+      close_cb=onConnectionClosed,
+      **getConnectionParameters(self.brokerAddress))
+
+
+  def openChannel(self):
+    channel = client_adapter.ChannelHandle(self._connection.channel())
+
+    def onChannelClosed(ch):
+      assert channel.closed, "unexpected channel-close; close_info=%s" % (
+        ch.close_info,)
+      channel.impl = None
+
+    channel.impl.add_close_listener(onChannelClosed)
+    return channel
+
+
+  def enableConfirms(self, channel, onAck, onNack):
+    channel.impl.confirm.select()
+    channel.onAck = onAck
+    channel.onNack = onNack
+    # RabbitConnection expands multiple=True acks into per-message callbacks
+    channel.impl.basic.set_ack_listener(lambda mid: onAck(mid, False))
+    channel.impl.basic.set_nack_listener(lambda mid: onNack(mid, False))
+
+
+  def selectTransactions(self, channel):
+    result = []
+    channel.impl.tx.select(cb=lambda: result.append(True))
+    self.waitUntil(lambda: result)
+
+
+  def commit(self, channel):
+    result = []
+    channel.impl.tx.commit(cb=lambda: result.append(True))
+    self.waitUntil(lambda: result)
+
+
+  def publish(self, channel, exchange, routingKey, body):
+    channel.impl.basic.publish(Message(body), exchange=exchange,
+                               routing_key=routingKey, immediate=False,
+                               mandatory=False)
+
+
+  def declareQueue(self, channel, queue=""):
+    return channel.impl.queue.declare(queue, passive=False, durable=False,
+                                      exclusive=False, auto_delete=True,
+                                      nowait=False)[0]
 
-def getConnectionParameters():
+
+  def consume(self, channel, queue, onMessage, noAck, prefetch=0):
+    if prefetch:
+      channel.impl.basic.qos(prefetch_count=prefetch)
+
+    def onDelivery(msg):
+      onMessage(msg.body, msg.delivery_info["delivery_tag"])
+
+    channel.impl.basic.consume(queue, consumer=onDelivery, no_ack=noAck,
+                               nowait=False)
+
+
+  def ack(self, channel, deliveryTag, multiple=False):
+    channel.impl.basic.ack(deliveryTag, multiple=multiple)
+
+
+  def pump(self, timeout):
+    # read_frames() blocks until data arrives, so wait for readability first
+    readable, _, _ = select.select([self._connection._transport._sock], [], [],
+                                   timeout)
+    if readable:
+      self._connection.read_frames()
+
+
+  def closeChannel(self, channel):
+    channel.closed = True
+    channel.impl.close()
+    self.waitUntil(lambda: channel.impl is None)
+
+
+  def close(self):
+    self._closing = True
+    self._connection.close()
+    self.waitUntil(lambda: self._closed)
+
+
+
+class HaighaCodec(client_adapter.FrameCodec):
+  """haigha's frame classes and Frame.read_frames()"""
+
+  LIBRARY = "haigha"
+
+
+  def encodePublish(self, channelNumber, exchange, routingKey, body, headers,
+                    frameMax):
+    # Same as haigha.classes.basic_class.BasicClass.publish() and
+    # haigha.connection.Connection.send_frame()
+    if headers:
+      message = Message(body, application_headers=headers)
+    else:
+      message = Message(body)
+    args = Writer()
+    args.write_short(0).\
+      write_shortstr(exchange).\
+      write_shortstr(routingKey).\
+      write_bits(False, False)
+
+    frames = [MethodFrame(channelNumber, 60, 40, args),
+              HeaderFrame(channelNumber, 60, 0, len(message),
+                          message.properties)]
+    frames.extend(ContentFrame.create_frames(channelNumber, message.body,
+                                             frameMax))
+
+    pieces = []
+    for frame in frames:
+      buf = bytearray()
+      frame.write_frame(buf)
+      pieces.append(buf)
+    return pieces
+
+
+  def decodeFrames(self, data):
+    frames = list(Frame.read_frames(Reader(data)))
+    # haigha parses method arguments lazily, when the channel dispatches the
+    # frame, so read those of the basic methods here like its BasicClass does
+    for frame in frames:
+      if not isinstance(frame, MethodFrame) or frame.class_id != 60:
+        continue
+      args = frame.args
+      if frame.method_id == 60:
+        # basic.deliver
+        args.read_shortstr()
+        args.read_longlong()
+        args.read_bit()
+        args.read_shortstr()
+        args.read_shortstr()
+      elif frame.method_id == 80:
+        # basic.ack
+        args.read_longlong()
+        args.read_bit()
+    return frames
+
+
+
+ADAPTERS = [HaighaSocketTransportAdapter]
+
+CODEC = HaighaCodec
+
+
+
+
+def getConnectionParameters(brokerAddress=None):
   """
+  :param brokerAddress: (host, port) of the broker; None for localhost:5672
   :returns: dict with connection params
   """
+  host, port = brokerAddress or ("localhost", 5672)
   return dict(
     user='guest',
     password='guest',
     vhost='/',
-    host='localhost',
-    port=5672)
+    host=host,
+    port=port)
 
 
 
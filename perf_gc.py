@@ -0,0 +1,272 @@
+"""Garbage collector settings and pause measurement for the timed interval of
+a perf scenario.
+
+GcMonitor applies one of the --gc modes when the timed interval starts and
+restores the previous settings when it stops, and meanwhile counts the
+collections of each generation and the time spent in them. Clients that
+create objects per message (haigha's Message, rabbitpy's Message, puka's
+promises) trigger young generation collections every few hundred messages,
+and the full collections get slower as the process accumulates objects.
+
+The pauses come from gc.callbacks where available (Python 3.3+). Python 2 has
+no such hook, so there the collector's DEBUG_STATS output, which it writes
+to sys.stderr, is intercepted and timed instead. DEBUG_STATS makes the
+collector count the objects of each generation before every collection, so
+on Python 2 the monitoring itself costs throughput that isn't included in the
+pauses.
+"""
+
+import gc
+import sys
+import time
+
+
+DEFAULT = "default"
+DISABLED = "disabled"
+FREEZE = "freeze"
+THRESHOLDS = "thresholds"
+
+GC_MODES = [DEFAULT, DISABLED, FREEZE, THRESHOLDS + "=A,B,C"]
+
+NUM_GENERATIONS = 3
+
+# Highest resolution wall clock available
+_clock = getattr(time, "perf_counter", time.time)
+
+
+
+def addGcOption(parser):
+  """Adds the --gc option to the given OptionParser"""
+  parser.add_option(
+      "--gc",
+      action="store",
+      type="string",
+      dest="gc",
+      default=None,
+      help=("Garbage collector setting for the timed interval of each run, "
+            "which also reports the collections per generation and their "
+            "total pause time: %s - leave it as is; %s - no automatic "
+            "collections; %s - collect, then move all objects to the "
+            "permanent generation via gc.freeze() (Python 3.7+); %s - "
+            "gc.set_threshold(A, B, C) [default: don't report]"
+            % tuple(GC_MODES)))
+
+
+
+def checkGcOption(parser, options):
+  """Validates the option added by addGcOption()"""
+  if options.gc is None:
+    return
+  try:
+    parseGcMode(options.gc)
+  except ValueError as e:
+    parser.error("--gc: %s" % (e,))
+
+
+
+def parseGcMode(text):
+  """
+  :param text: one of GC_MODES; e.g., "thresholds=1000,20,20"
+  :returns: (mode, thresholds), where thresholds is a tuple of 3 ints in
+    THRESHOLDS mode and None otherwise
+  :raises ValueError: if the mode is invalid or not available
+  """
+  mode, _sep, value = text.partition("=")
+  if mode == THRESHOLDS:
+    try:
+      thresholds = tuple(int(number) for number in value.split(","))
+    except ValueError:
+      thresholds = ()
+    if len(thresholds) != NUM_GENERATIONS or min(thresholds) < 0:
+      raise ValueError("%s requires 3 comma-separated non-negative integers, "
+                       "but got %r" % (THRESHOLDS, value))
+    return mode, thresholds
+
+  if mode not in (DEFAULT, DISABLED, FREEZE) or value:
+    raise ValueError("expected one of %s, but got %r" % (", ".join(GC_MODES),
+                                                        text))
+  if mode == FREEZE and not hasattr(gc, "freeze"):
+    raise ValueError("%s requires gc.freeze() of Python 3.7+" % (FREEZE,))
+  return mode, None
+
+
+
+class GcMonitor(object):
+  """Applies a garbage collector setting between start() and stop() and
+  measures the collections meanwhile
+  """
+
+  def __init__(self, mode):
+    """
+    :param mode: one of GC_MODES; see parseGcMode()
+    """
+    self.mode = mode
+    self._mode, self._thresholds = parseGcMode(mode)
+    self._wasEnabled = None
+    self._previousThresholds = None
+    self._stderr = None
+    self._running = False
+    self.reset()
+
+
+  def reset(self):
+    """Zeroes the counts; e.g., at the end of a warmup"""
+    self._startTime = _clock()
+    self._stopTime = None
+    self.collections = [0] * NUM_GENERATIONS
+    self.pauseTotal = 0.0
+    self.pauseMax = 0.0
+    # (generation, start time) of the collection in progress
+    self._current = None
+
+
+  def start(self):
+    self._wasEnabled = gc.isenabled()
+    self._previousThresholds = gc.get_threshold()
+
+    if self._mode == DISABLED:
+      gc.disable()
+    elif self._mode == FREEZE:
+      # The collection's own pause precedes the timed interval
+      gc.collect()
+      gc.freeze()
+    elif self._mode == THRESHOLDS:
+      gc.set_threshold(*self._thresholds)
+
+    if hasattr(gc, "callbacks"):
+      gc.callbacks.append(self._onCollection)
+    else:
+      self._stderr = sys.stderr
+      sys.stderr = _DebugStatsStream(self, self._stderr)
+      gc.set_debug(gc.get_debug() | gc.DEBUG_STATS)
+
+    self._running = True
+    self.reset()
+
+
+  def stop(self):
+    if not self._running:
+      return
+    self._running = False
+    self._stopTime = _clock()
+
+    if self._stderr is None:
+      gc.callbacks.remove(self._onCollection)
+    else:
+      gc.set_debug(gc.get_debug() & ~gc.DEBUG_STATS)
+      sys.stderr = self._stderr
+      self._stderr = None
+
+    if self._mode == FREEZE:
+      gc.unfreeze()
+    gc.set_threshold(*self._previousThresholds)
+    if self._wasEnabled:
+      gc.enable()
+
+
+  def _onCollection(self, phase, info):
+    """gc.callbacks hook"""
+    if phase == "start":
+      self.onCollectionStart(info["generation"])
+    else:
+      self.onCollectionEnd()
+
+
+  def onCollectionStart(self, generation):
+    self._current = (generation, _clock())
+
+
+  def onCollectionEnd(self):
+    if self._current is None:
+      # Started before reset()
+      return
+    generation, startTime = self._current
+    self._current = None
+    pause = _clock() - startTime
+    self.collections[generation] += 1
+    self.pauseTotal += pause
+    self.pauseMax = max(self.pauseMax, pause)
+
+
+  def summary(self, numMessages, prefix="gc."):
+    """
+    :param numMessages: number of messages since the start or the last
+      reset(), for the pause per message
+    :param prefix: prepended to each key
+    :returns: dict of the mode, the number of collections in total and per
+      generation, the total and longest pause in seconds, the pauses' share
+      of the elapsed time in percent and the pause per message in seconds
+    """
+    elapsed = (self._stopTime or _clock()) - self._startTime
+    result = {
+      prefix + "mode": self.mode,
+      prefix + "collections": sum(self.collections),
+      prefix + "pauseTotal": self.pauseTotal,
+      prefix + "pauseMax": self.pauseMax,
+      prefix + "pauseShare": (self.pauseTotal * 100 / elapsed if elapsed
+                              else None),
+      prefix + "pausePerMsg": (self.pauseTotal / numMessages if numMessages
+                               else None),
+    }
+    for generation, count in enumerate(self.collections):
+      result[prefix + "gen%dCollections" % (generation,)] = count
+    return result
+
+
+
+class _DebugStatsStream(object):
+  """Stands in for sys.stderr while the Python 2 collector writes its
+  DEBUG_STATS messages, which it does in pieces like these:
+
+    "gc: collecting generation 0...\\n"
+    "gc: objects in each generation:" " 701" " 3719" " 0" "\\n"
+    "gc: done" ", 0.0000s elapsed" ".\\n"
+
+  The pause is timed from the end of the object counts, which the collector
+  walks all of its generations for, to "gc: done". Everything else is passed
+  through to the real stderr.
+  """
+
+  COLLECTING = "gc: collecting generation "
+  DONE = "gc: done"
+
+  # States
+  _IDLE = 0
+  _COUNTS = 1
+  _COLLECTING = 2
+  _DONE = 3
+
+  def __init__(self, monitor, stream):
+    self._monitor = monitor
+    self._stream = stream
+    self._state = self._IDLE
+    self._generation = None
+
+
+  def write(self, text):
+    if self._state == self._IDLE:
+      if text.startswith(self.COLLECTING):
+        self._generation = int(text[len(self.COLLECTING):].split(".")[0])
+        self._state = self._COUNTS
+      else:
+        self._stream.write(text)
+
+    elif self._state == self._COUNTS:
+      if text == "\n":
+        self._monitor.onCollectionStart(self._generation)
+        self._state = self._COLLECTING
+
+    elif self._state == self._COLLECTING:
+      if text.startswith(self.DONE):
+        self._monitor.onCollectionEnd()
+        self._state = self._DONE
+      else:
+        # E.g., a finalizer of the collected objects
+        self._stream.write(text)
+
+    elif text.endswith(".\n"):
+      self._state = self._IDLE
+
+
+  def __getattr__(self, name):
+    return getattr(self._stream, name)
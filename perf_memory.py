@@ -0,0 +1,185 @@
+"""Memory tracking of the timed interval of a perf scenario.
+
+MemoryTracer samples the process's resident set size (RSS) on a background
+thread, optionally along with the number of unconfirmed messages, which shows
+buffers growing while a slow broker holds back confirms. Between start and
+stop it also measures the memory that the run allocated and didn't free, with
+the top allocation sites: via tracemalloc snapshots where available (Python
+3.4+), which slows allocation down considerably. Python 2 has no tracemalloc,
+so there it counts the live garbage-collected objects by type instead, and
+the allocated bytes come from the RSS growth.
+"""
+
+import collections
+import gc
+import mmap
+import threading
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+
+
+# Number of allocation sites (or object types) in the summary
+NUM_TOP_SITES = 10
+
+
+
+def getRss():
+  """
+  :returns: resident set size of the process in bytes; None if the platform
+    doesn't have /proc
+  """
+  try:
+    with open("/proc/self/statm") as statm:
+      return int(statm.read().split()[1]) * mmap.PAGESIZE
+  except (IOError, OSError):
+    return None
+
+
+
+def _countObjectsByType():
+  """
+  :returns: dict of type name -> number of live garbage-collected objects
+  """
+  counts = collections.defaultdict(int)
+  for obj in gc.get_objects():
+    counts[type(obj).__name__] += 1
+  return counts
+
+
+
+class MemoryTracer(object):
+  """Tracks the memory use of the process between start() (or the latest
+  rebaseline()) and stop()
+  """
+
+  def __init__(self, interval=0.1, getOutstanding=None):
+    """
+    :param interval: seconds between RSS samples
+    :param getOutstanding: if not None, function returning the current number
+      of unconfirmed messages, which is sampled along with the RSS
+    """
+    self.interval = interval
+    self._getOutstanding = getOutstanding
+    # (seconds since start, RSS bytes, unconfirmed messages or None)
+    self.samples = []
+    self._startTime = None
+    self._stopEvent = threading.Event()
+    self._thread = None
+    self._startSnapshot = None
+    self._startCounts = None
+    # Net bytes allocated between start and stop; None without tracemalloc
+    self._allocatedBytes = None
+    # (site, net bytes or None, net number of blocks or objects)
+    self._topSites = []
+
+
+  def start(self):
+    if tracemalloc is not None:
+      tracemalloc.start()
+      self._startSnapshot = tracemalloc.take_snapshot()
+    else:
+      self._startCounts = _countObjectsByType()
+
+    self._startTime = time.time()
+    self._sample()
+    self._thread = threading.Thread(target=self._run, name="MemoryTracer")
+    self._thread.daemon = True
+    self._thread.start()
+
+
+  def rebaseline(self):
+    """Restarts the measurement as if start() were called now, discarding
+    the samples so far; e.g., at the end of a warmup
+    """
+    if tracemalloc is not None:
+      self._startSnapshot = tracemalloc.take_snapshot()
+    else:
+      self._startCounts = _countObjectsByType()
+
+    self._startTime = time.time()
+    del self.samples[:]
+    self._sample()
+
+
+  def stop(self):
+    if self._thread is None:
+      return
+    self._stopEvent.set()
+    self._thread.join()
+    self._thread = None
+    self._sample()
+
+    if tracemalloc is not None:
+      stats = tracemalloc.take_snapshot().compare_to(self._startSnapshot,
+                                                     "lineno")
+      tracemalloc.stop()
+      self._allocatedBytes = sum(stat.size_diff for stat in stats)
+      self._topSites = [(str(stat.traceback[0]), stat.size_diff,
+                         stat.count_diff)
+                        for stat in stats[:NUM_TOP_SITES]]
+    else:
+      endCounts = _countObjectsByType()
+      growth = sorted(
+        ((count - self._startCounts.get(typeName, 0), typeName)
+         for typeName, count in endCounts.items()),
+        reverse=True)
+      self._topSites = [(typeName, None, countDiff)
+                        for countDiff, typeName in growth[:NUM_TOP_SITES]
+                        if countDiff > 0]
+
+
+  def _run(self):
+    while not self._stopEvent.wait(self.interval):
+      self._sample()
+
+
+  def _sample(self):
+    outstanding = None
+    if self._getOutstanding is not None:
+      outstanding = self._getOutstanding()
+    self.samples.append((time.time() - self._startTime, getRss(), outstanding))
+
+
+  def summary(self, numMessages, prefix="mem."):
+    """
+    :param numMessages: number of messages of the run, for bytes per message
+    :param prefix: prepended to each key
+    :returns: dict of RSS at the start, end and peak of the run (None without
+      /proc), the number of unconfirmed messages at the peak and overall,
+      the net allocated bytes in total and per message, the top allocation
+      sites and the samples
+    """
+    samples = [sample for sample in self.samples if sample[1] is not None]
+    rssStart = rssEnd = rssPeak = outstandingAtPeak = None
+    if samples:
+      rssStart = samples[0][1]
+      rssEnd = samples[-1][1]
+      _elapsed, rssPeak, outstandingAtPeak = max(samples,
+                                                 key=lambda s: s[1])
+
+    allocatedBytes = self._allocatedBytes
+    if allocatedBytes is None and samples:
+      allocatedBytes = rssEnd - rssStart
+
+    maxOutstanding = None
+    if self._getOutstanding is not None:
+      maxOutstanding = max(sample[2] for sample in self.samples)
+
+    return {
+      prefix + "rssStart": rssStart,
+      prefix + "rssEnd": rssEnd,
+      prefix + "rssPeak": rssPeak,
+      prefix + "outstandingAtPeak": outstandingAtPeak,
+      prefix + "maxOutstanding": maxOutstanding,
+      prefix + "allocatedBytes": allocatedBytes,
+      prefix + "bytesPerMsg": (allocatedBytes / float(numMessages)
+                               if allocatedBytes is not None and numMessages
+                               else None),
+      prefix + "topSites": self._topSites,
+      prefix + "samples": self.samples,
+    }
@@ -0,0 +1,290 @@
+"""Message bodies for the perf scenarios.
+
+By default every message is the same preallocated string, which flatters
+clients that cache or avoid copies. PayloadSource can also create a fresh
+string per message, hand out memoryview slices of one large buffer (a client
+that copies its input pays for it; one that requires str fails outright) or
+bytearray slices of it for clients that take bytearray but not memoryview, or
+slice incompressible random data. Independently of the mode, body sizes can
+follow a distribution: uniform, lognormal, or replayed from a histogram file
+of production traffic.
+
+The sizes are drawn up front from a seeded generator, so every client and
+every run gets the same sequence of sizes, and the timed loop only picks the
+next body.
+"""
+
+import bisect
+import itertools
+import math
+import os
+import random
+import struct
+
+
+REUSED = "reused"
+FRESH = "fresh"
+POOL = "pool"
+POOL_BYTEARRAY = "pool-bytearray"
+RANDOM = "random"
+
+PAYLOAD_MODES = [REUSED, FRESH, POOL, POOL_BYTEARRAY, RANDOM]
+
+FIXED = "fixed"
+UNIFORM = "uniform"
+LOGNORMAL = "lognormal"
+HISTOGRAM = "file"
+
+# Number of sizes drawn from a distribution; the messages cycle through them
+NUM_SIZES = 10000
+
+# Largest size drawn from a distribution; RabbitMQ's default max message size
+MAX_SIZE = 128 * 1024 * 1024
+
+# Minimum size of the buffer that the pool and random modes slice bodies from
+POOL_SIZE = 4 * 1024 * 1024
+
+FILL_BYTE = b"a"
+
+# Sequence number and time.time() send time at the start of the bodies of
+# stamped messages
+STAMP = struct.Struct(">Qd")
+
+
+
+def addPayloadOptions(parser):
+  """Adds the --payload and --size-dist options to the given OptionParser"""
+  parser.add_option(
+      "--payload",
+      action="store",
+      type="choice",
+      dest="payloadMode",
+      choices=PAYLOAD_MODES,
+      default=REUSED,
+      help=("How message bodies are made: %s - one preallocated string per "
+            "size, published over and over; %s - a new string per message; "
+            "%s - memoryview slices of one large bytearray, which shows "
+            "whether a client copies its input (clients that require str "
+            "fail); %s - bytearray slices of it, for clients that take "
+            "bytearray but not memoryview; %s - slices of incompressible "
+            "random data [default: %%default]" % tuple(PAYLOAD_MODES)))
+
+  parser.add_option(
+      "--size-dist",
+      action="store",
+      type="string",
+      dest="sizeDistribution",
+      default=FIXED,
+      help=("Distribution of message body sizes: %s - always --size; "
+            "%s:MIN,MAX - uniformly distributed; %s:MEDIAN,SIGMA - "
+            "lognormal, with SIGMA the standard deviation of the size's "
+            "natural logarithm; %s:PATH - drawn from a histogram file of "
+            "\"SIZE COUNT\" lines. Sizes accept K/M suffixes, and the size "
+            "column shows the mean [default: %%default]"
+            % (FIXED, UNIFORM, LOGNORMAL, HISTOGRAM)))
+
+
+
+def getPayloadKwargs(parser, options):
+  """
+  :returns: the payloadMode and sizeDistribution args of the scenario
+    functions from the options added by addPayloadOptions(); empty if both
+    are the defaults
+  """
+  kwargs = {}
+  if options.payloadMode != REUSED:
+    kwargs["payloadMode"] = options.payloadMode
+  if options.sizeDistribution != FIXED:
+    try:
+      kwargs["sizeDistribution"] = parseSizeDistribution(
+        options.sizeDistribution)
+    except (ValueError, IOError) as e:
+      parser.error("--size-dist: %s" % (e,))
+  return kwargs
+
+
+
+def _parseSize(text):
+  text = text.strip().upper()
+  multiplier = 1
+  if text and text[-1] in "KM":
+    multiplier = 1024 ** ("KM".index(text[-1]) + 1)
+    text = text[:-1]
+  size = int(text) * multiplier
+  if size < 0:
+    raise ValueError("negative size %r" % (text,))
+  return size
+
+
+
+def parseSizeDistribution(text):
+  """
+  :param text: size distribution spec; see addPayloadOptions()
+  :returns: (FIXED, None), (UNIFORM, (min, max)), (LOGNORMAL, (median,
+    sigma)) or (HISTOGRAM, [(size, count), ...]); the histogram file is read
+    here, so that worker processes don't need it
+  :raises ValueError: if the spec or the histogram file is invalid
+  :raises IOError: if the histogram file can't be read
+  """
+  kind, _sep, value = text.partition(":")
+
+  if kind == FIXED and not value:
+    return FIXED, None
+
+  if kind == UNIFORM:
+    try:
+      low, high = [_parseSize(size) for size in value.split(",")]
+    except ValueError:
+      low = high = None
+    if low is None or low > high:
+      raise ValueError("%s requires MIN,MAX sizes with MIN <= MAX, but got "
+                       "%r" % (UNIFORM, value))
+    return UNIFORM, (low, high)
+
+  if kind == LOGNORMAL:
+    try:
+      median, sigma = value.split(",")
+      median, sigma = _parseSize(median), float(sigma)
+    except ValueError:
+      median = sigma = None
+    if not median or sigma is None or sigma < 0:
+      raise ValueError("%s requires a positive MEDIAN size and a "
+                       "non-negative SIGMA, but got %r" % (LOGNORMAL, value))
+    return LOGNORMAL, (median, sigma)
+
+  if kind == HISTOGRAM and value:
+    return HISTOGRAM, loadSizeHistogram(value)
+
+  raise ValueError("expected %s, %s:MIN,MAX, %s:MEDIAN,SIGMA or %s:PATH, but "
+                   "got %r" % (FIXED, UNIFORM, LOGNORMAL, HISTOGRAM, text))
+
+
+
+def loadSizeHistogram(path):
+  """Reads a histogram of message sizes; blank lines and lines starting with
+  "#" are ignored
+
+  :param path: file of "SIZE COUNT" lines, separated by whitespace or a comma
+  :returns: list of (size, count)
+  :raises ValueError: if a line is invalid or all counts are zero
+  """
+  histogram = []
+  with open(path) as histogramFile:
+    for lineNumber, line in enumerate(histogramFile, 1):
+      line = line.strip()
+      if not line or line.startswith("#"):
+        continue
+      try:
+        size, count = line.replace(",", " ").split()
+        size, count = _parseSize(size), int(count)
+        if count < 0:
+          raise ValueError(count)
+      except ValueError:
+        raise ValueError("%s:%d: expected \"SIZE COUNT\", but got %r" % (
+          path, lineNumber, line))
+      histogram.append((size, count))
+
+  if not sum(count for _size, count in histogram):
+    raise ValueError("%s has no sizes with a positive count" % (path,))
+  return histogram
+
+
+
+def drawSizes(messageSize, sizeDistribution, numSizes=NUM_SIZES, seed=0):
+  """
+  :param messageSize: size of FIXED mode
+  :param sizeDistribution: parseSizeDistribution() result
+  :returns: list of numSizes body sizes
+  """
+  kind, params = sizeDistribution
+  if kind == FIXED:
+    return [messageSize]
+
+  rng = random.Random(seed)
+  if kind == UNIFORM:
+    low, high = params
+    return [rng.randint(low, high) for _ in xrange(numSizes)]
+
+  if kind == LOGNORMAL:
+    median, sigma = params
+    mu = math.log(median)
+    return [min(int(round(rng.lognormvariate(mu, sigma))), MAX_SIZE)
+            for _ in xrange(numSizes)]
+
+  # HISTOGRAM: inverse transform sampling of the cumulative counts
+  bounds = []
+  total = 0
+  for _size, count in params:
+    total += count
+    bounds.append(total)
+  return [params[bisect.bisect_left(bounds, rng.randint(1, total))][0]
+          for _ in xrange(numSizes)]
+
+
+
+class PayloadSource(object):
+  """Produces the message bodies of a scenario"""
+
+  def __init__(self, messageSize, mode=REUSED, sizeDistribution=(FIXED, None)):
+    """
+    :param messageSize: body size in FIXED mode
+    :param mode: one of PAYLOAD_MODES
+    :param sizeDistribution: parseSizeDistribution() result
+    """
+    if mode not in PAYLOAD_MODES:
+      raise ValueError("Unknown payload mode %r" % (mode,))
+    self.mode = mode
+    self.sizes = drawSizes(messageSize, sizeDistribution)
+    self.meanSize = sum(self.sizes) / float(len(self.sizes))
+    self.maxSize = max(self.sizes)
+
+
+  def __iter__(self):
+    """
+    :returns: endless iterator of bodies
+    """
+    if self.mode == REUSED:
+      bodies = dict((size, FILL_BYTE * size) for size in set(self.sizes))
+      return itertools.cycle([bodies[size] for size in self.sizes])
+
+    if self.mode == FRESH:
+      return (FILL_BYTE * size for size in itertools.cycle(self.sizes))
+
+    poolSize = max(POOL_SIZE, 2 * self.maxSize)
+    if self.mode == POOL:
+      return self._iterSlices(memoryview(bytearray(FILL_BYTE * poolSize)))
+    if self.mode == POOL_BYTEARRAY:
+      return self._iterSlices(bytearray(FILL_BYTE * poolSize))
+    return self._iterSlices(os.urandom(poolSize))
+
+
+  def _iterSlices(self, pool):
+    """Slices consecutive bodies of the given buffer, starting over at its
+    beginning when the next one doesn't fit; the slices of a str or bytearray
+    pool are copies, a memoryview's aren't
+    """
+    offset = 0
+    for size in itertools.cycle(self.sizes):
+      if offset + size > len(pool):
+        offset = 0
+      yield pool[offset:offset + size]
+      offset += size
+
+
+
+def stampBody(seq, sendTime, padding):
+  """
+  :param padding: bytes following the stamp; STAMP.size fewer than the body
+    size
+  :returns: message body starting with the STAMP of the given sequence number
+    and send time
+  """
+  return STAMP.pack(seq, sendTime) + padding
+
+
+
+def readStamp(body):
+  """
+  :returns: (sequence number, send time) of a stampBody() body
+  """
+  return STAMP.unpack_from(body)
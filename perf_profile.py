@@ -0,0 +1,230 @@
+"""Profilers that wrap the measured phase of a perf scenario and report where
+the client library spends its time.
+
+Both profilers cover only the thread that starts them (the one running the
+scenario), so an in-process stand-in broker or a client's background I/O
+thread doesn't show up in the output.
+
+cprofile mode writes PREFIX.pstats for pstats/snakeviz and friends. sampling
+mode periodically samples the call stack on SIGPROF, which has much lower
+overhead than cProfile's per-call hooks, and writes PREFIX.collapsed in the
+"frame;frame;frame count" format of flamegraph.pl and speedscope. Both write
+PREFIX.top.txt with the functions of the client library that have the most
+self time.
+"""
+
+import collections
+import cProfile
+import os
+import pstats
+import signal
+import sys
+
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+
+PROFILE_MODES = [CPROFILE, SAMPLING]
+
+# Number of functions in the top self time summary
+NUM_TOP_FUNCTIONS = 20
+
+
+
+def addProfileOptions(parser):
+  """Adds the --profile and --profile-output options to the given
+  OptionParser
+  """
+  parser.add_option(
+      "--profile",
+      action="store",
+      type="choice",
+      dest="profile",
+      choices=PROFILE_MODES,
+      default=None,
+      help=("Profile the measured phase of each run: %s - deterministic "
+            "profile saved as PREFIX.pstats; %s - low overhead stack "
+            "sampling saved as PREFIX.collapsed for flame graphs. Both save "
+            "the client library's functions with the most self time to "
+            "PREFIX.top.txt [default: no profiling]" % tuple(PROFILE_MODES)))
+
+  parser.add_option(
+      "--profile-output",
+      action="store",
+      type="string",
+      dest="profileOutput",
+      default="profile",
+      help=("Path prefix of profile files; the client name and run number are "
+            "appended [default: %default]"))
+
+
+
+def createProfiler(mode):
+  """
+  :param mode: one of PROFILE_MODES
+  :returns: an unstarted CProfiler or SamplingProfiler
+  """
+  if mode == CPROFILE:
+    return CProfiler()
+  elif mode == SAMPLING:
+    return SamplingProfiler()
+  raise ValueError("Unknown profile mode %r" % (mode,))
+
+
+
+def getLibraryDir(libraryName):
+  """
+  :param libraryName: name of an imported client library module; e.g., "pika"
+  :returns: path prefix of the library's source files
+  """
+  module = sys.modules[libraryName]
+  path = os.path.abspath(module.__file__)
+  if os.path.splitext(os.path.basename(path))[0] == "__init__":
+    return os.path.dirname(path) + os.sep
+  return os.path.splitext(path)[0]
+
+
+
+def _formatFunction(filename, lineno, funcName):
+  return "%s (%s:%d)" % (funcName, filename, lineno)
+
+
+
+class CProfiler(object):
+  """Deterministic profiler based on cProfile"""
+
+  def __init__(self):
+    self._profile = cProfile.Profile()
+
+
+  def start(self):
+    self._profile.enable()
+
+
+  def stop(self):
+    self._profile.disable()
+
+
+  def reset(self):
+    """Discards the profile so far of a started profiler; e.g., at the end
+    of a warmup
+    """
+    self._profile.disable()
+    self._profile = cProfile.Profile()
+    self._profile.enable()
+
+
+  def write(self, pathPrefix, libraryDir):
+    """Writes PREFIX.pstats and PREFIX.top.txt
+
+    :param libraryDir: path prefix of the source files of the library whose
+      top functions to summarize; see getLibraryDir()
+    :returns: list of (self seconds, number of calls, function description)
+      of the library's top functions
+    """
+    self._profile.dump_stats(pathPrefix + ".pstats")
+
+    stats = pstats.Stats(self._profile).stats
+    top = sorted(
+      ((selfTime, numCalls, _formatFunction(*func))
+       for func, (_primitiveCalls, numCalls, selfTime, _cumTime, _callers)
+       in stats.items()
+       if func[0].startswith(libraryDir)),
+      reverse=True)[:NUM_TOP_FUNCTIONS]
+
+    _writeTop(pathPrefix + ".top.txt", top,
+              sum(entry[2] for entry in stats.values()))
+    return top
+
+
+
+class SamplingProfiler(object):
+  """Statistical profiler that records the call stack of the thread that
+  started it on each SIGPROF, which setitimer(ITIMER_PROF) delivers per
+  interval of process CPU time. Must be started on the main thread.
+  """
+
+  def __init__(self, interval=0.001):
+    """
+    :param interval: seconds of CPU time between samples
+    """
+    self.interval = interval
+    # Tuple of frames from the outermost to the innermost -> number of samples
+    self._stacks = collections.defaultdict(int)
+    self._running = False
+    self._previousHandler = None
+
+
+  def start(self):
+    self._previousHandler = signal.signal(signal.SIGPROF, self._onSignal)
+    signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+    self._running = True
+
+
+  def stop(self):
+    if not self._running:
+      return
+    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+    signal.signal(signal.SIGPROF, self._previousHandler)
+    self._running = False
+
+
+  def reset(self):
+    """Discards the samples so far; e.g., at the end of a warmup"""
+    self._stacks.clear()
+
+
+  def _onSignal(self, signum, frame):
+    stack = []
+    while frame is not None:
+      code = frame.f_code
+      stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+      frame = frame.f_back
+    stack.reverse()
+    self._stacks[tuple(stack)] += 1
+
+
+  def write(self, pathPrefix, libraryDir):
+    """Writes PREFIX.collapsed and PREFIX.top.txt
+
+    :param libraryDir: path prefix of the source files of the library whose
+      top functions to summarize; see getLibraryDir()
+    :returns: list of (self seconds, number of samples, function description)
+      of the library's top functions
+    """
+    with open(pathPrefix + ".collapsed", "w") as collapsedFile:
+      for stack, count in sorted(self._stacks.items()):
+        collapsedFile.write("%s %d\n" % (
+          ";".join(_formatFunction(*func) for func in stack), count))
+
+    # The innermost frame of each sample gets the self time
+    selfSamples = collections.defaultdict(int)
+    for stack, count in self._stacks.items():
+      selfSamples[stack[-1]] += count
+
+    top = sorted(
+      ((count * self.interval, count, _formatFunction(*func))
+       for func, count in selfSamples.items()
+       if func[0].startswith(libraryDir)),
+      reverse=True)[:NUM_TOP_FUNCTIONS]
+
+    _writeTop(pathPrefix + ".top.txt", top,
+              sum(self._stacks.values()) * self.interval)
+    return top
+
+
+
+def _writeTop(path, top, totalTime):
+  """Writes the top functions summary of a profiler
+
+  :param top: list of (self seconds, number of calls or samples, function
+    description)
+  :param totalTime: self seconds of all profiled functions
+  """
+  with open(path, "w") as topFile:
+    topFile.write("%10s %7s %10s  %s\n" % ("self(s)", "self%", "count",
+                                          "function"))
+    for selfTime, count, description in top:
+      topFile.write("%10.4f %6.1f%% %10d  %s\n" % (
+        selfTime, selfTime * 100 / totalTime if totalTime else 0, count,
+        description))
@@ -0,0 +1,646 @@
+"""Statistics helpers shared by the perf tests
+"""
+
+import collections
+import math
+import optparse
+import os
+import resource
+import time
+
+
+
+class LatencyHistogram(object):
+  """HDR-style histogram of latencies with logarithmically-sized buckets.
+
+  Values are recorded at microsecond resolution. Each power-of-two range is
+  split into 2**(SUB_BUCKET_BITS - 1) linear sub-buckets, so reported
+  percentiles are within 1/2**(SUB_BUCKET_BITS - 1) of the true value (under
+  1.6% by default) while the memory used grows only with the log of the range.
+  """
+
+  SUB_BUCKET_BITS = 7
+
+  # Percentiles reported by summary()
+  PERCENTILES = (50, 90, 99, 99.9)
+
+
+  def __init__(self):
+    self.reset()
+
+
+  def reset(self):
+    """Discards all recorded values"""
+    # bucket index -> count
+    self._counts = collections.defaultdict(int)
+    self.count = 0
+    self._total = 0
+    self._min = None
+    self._max = None
+
+
+  def record(self, latency):
+    """
+    :param latency: latency in seconds
+    """
+    micros = max(int(latency * 1000000), 0)
+
+    self._counts[self._bucketIndex(micros)] += 1
+    self.count += 1
+    self._total += micros
+    if self._min is None or micros < self._min:
+      self._min = micros
+    if self._max is None or micros > self._max:
+      self._max = micros
+
+
+  def merge(self, other):
+    """Adds all values recorded by another LatencyHistogram to this one"""
+    for index, count in other._counts.items():
+      self._counts[index] += count
+    self.count += other.count
+    self._total += other._total
+    if other._min is not None and (self._min is None or other._min < self._min):
+      self._min = other._min
+    if other._max is not None and (self._max is None or other._max > self._max):
+      self._max = other._max
+
+
+  @property
+  def min(self):
+    """Smallest recorded latency in seconds or None if empty"""
+    return None if self._min is None else self._min / 1000000.0
+
+
+  @property
+  def max(self):
+    """Largest recorded latency in seconds or None if empty"""
+    return None if self._max is None else self._max / 1000000.0
+
+
+  @property
+  def mean(self):
+    """Mean recorded latency in seconds or None if empty"""
+    return self._total / 1000000.0 / self.count if self.count else None
+
+
+  def percentile(self, percent):
+    """
+    :param percent: 0..100
+    :returns: latency in seconds at or below which the given percentage of
+      recorded values falls; None if empty
+    """
+    if not self.count:
+      return None
+
+    threshold = max(1, int(math.ceil(self.count * percent / 100.0)))
+    seen = 0
+    for index in sorted(self._counts):
+      seen += self._counts[index]
+      if seen >= threshold:
+        low, high = self._bucketRange(index)
+        # Report the bucket's midpoint, clamped to the exact extremes
+        micros = min(max((low + high) // 2, self._min), self._max)
+        return micros / 1000000.0
+
+    return self.max
+
+
+  def summary(self, prefix=""):
+    """
+    :param prefix: prepended to each key
+    :returns: dict with count, mean, min, max and p50/p90/p99/p99.9 keys; the
+      latencies are in seconds
+    """
+    result = {
+      prefix + "count": self.count,
+      prefix + "mean": self.mean,
+      prefix + "min": self.min,
+      prefix + "max": self.max,
+    }
+    for percent in self.PERCENTILES:
+      result["%sp%s" % (prefix, percent)] = self.percentile(percent)
+    return result
+
+
+  @classmethod
+  def _bucketIndex(cls, micros):
+    bits = cls.SUB_BUCKET_BITS
+    shift = micros.bit_length() - bits
+    if shift <= 0:
+      return micros
+    return (shift << (bits - 1)) + (micros >> shift)
+
+
+  @classmethod
+  def _bucketRange(cls, index):
+    """
+    :returns: (lowest, highest) microsecond values mapping to the bucket
+    """
+    bits = cls.SUB_BUCKET_BITS
+    if index < (1 << bits):
+      return index, index
+    shift = (index >> (bits - 1)) - 1
+    top = index - (shift << (bits - 1))
+    return top << shift, ((top + 1) << shift) - 1
+
+
+
+def getCpuTimes(since=None):
+  """
+  :param since: optional (user, system) tuple from an earlier call
+  :returns: (user, system) CPU seconds used by this process, including all of
+    its threads, either in total or since the given earlier measurement
+  """
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  if since is None:
+    return usage.ru_utime, usage.ru_stime
+  return usage.ru_utime - since[0], usage.ru_stime - since[1]
+
+
+
+def getThreadCpuTimes(since=None):
+  """
+  :param since: optional (user, system) tuple from an earlier call on the same
+    thread
+  :returns: (user, system) CPU seconds used by the calling thread, either in
+    total or since the given earlier measurement, in clock ticks' resolution;
+    None if the platform lacks /proc/thread-self (Linux 3.17+)
+  """
+  try:
+    with open("/proc/thread-self/stat") as stat:
+      # The fields after the parenthesized command name, starting with the
+      # third field
+      fields = stat.read().rpartition(")")[2].split()
+  except (IOError, OSError):
+    return None
+
+  ticksPerSecond = float(os.sysconf("SC_CLK_TCK"))
+  user = int(fields[11]) / ticksPerSecond
+  system = int(fields[12]) / ticksPerSecond
+  if since is None:
+    return user, system
+  return user - since[0], system - since[1]
+
+
+
+class PhaseTimer(object):
+  """Accumulates the wall-clock and CPU time of consecutive phases of a run
+  (e.g., connect, publish, close). Each call to lap() ends the current phase
+  and starts the next one, and phases with the same name add up.
+  """
+
+  def __init__(self):
+    # phase name -> [elapsed, cpuUser, cpuSys] in seconds, in order of first
+    # occurrence
+    self.phases = collections.OrderedDict()
+    self.restart()
+
+
+  def restart(self):
+    """Starts the next phase now, leaving the time since the previous lap()
+    out of all phases
+    """
+    self._lapTime = time.time()
+    self._lapCpuTimes = getCpuTimes()
+
+
+  def lap(self, name):
+    """Ends the current phase and adds its times to those of the named phase"""
+    now = time.time()
+    cpuTimes = getCpuTimes()
+    self.add(name, now - self._lapTime,
+             (cpuTimes[0] - self._lapCpuTimes[0],
+              cpuTimes[1] - self._lapCpuTimes[1]))
+    self._lapTime = now
+    self._lapCpuTimes = cpuTimes
+
+
+  def add(self, name, elapsed, cpuTimes):
+    """Adds times measured elsewhere to those of the named phase
+
+    :param cpuTimes: (user, system) CPU seconds
+    """
+    totals = self.phases.setdefault(name, [0.0, 0.0, 0.0])
+    totals[0] += elapsed
+    totals[1] += cpuTimes[0]
+    totals[2] += cpuTimes[1]
+
+
+  def summary(self, prefix="phase."):
+    """
+    :param prefix: prepended to each key
+    :returns: dict with PREFIX.NAME.elapsed, PREFIX.NAME.cpuUser and
+      PREFIX.NAME.cpuSys keys of each phase; the times are in seconds
+    """
+    result = {}
+    for name, (elapsed, cpuUser, cpuSys) in self.phases.items():
+      result["%s%s.elapsed" % (prefix, name)] = elapsed
+      result["%s%s.cpuUser" % (prefix, name)] = cpuUser
+      result["%s%s.cpuSys" % (prefix, name)] = cpuSys
+    return result
+
+
+
+class ConfirmTracker(object):
+  """Tracks the outstanding publisher confirms of one channel and records
+  the latency from each publish call to the client's dispatch of its
+  Basic.Ack, so the latency includes any client-side buffering
+  """
+
+  def __init__(self):
+    self.histogram = LatencyHistogram()
+    self.numPublished = 0
+    # deliveryTag -> publish time of unconfirmed messages, in tag order
+    self._sendTimes = collections.OrderedDict()
+
+
+  @property
+  def numOutstanding(self):
+    return len(self._sendTimes)
+
+
+  def onPublish(self, sendTime=None):
+    """Must be called right before each publish on the channel
+
+    :param sendTime: time.time() value to measure the confirm latency from;
+      defaults to now. Open-loop tests pass the intended send time, so that
+      the latency includes the time spent waiting to send.
+    """
+    self.numPublished += 1
+    self._sendTimes[self.numPublished] = (
+      time.time() if sendTime is None else sendTime)
+
+
+  def onAck(self, deliveryTag, multiple):
+    now = time.time()
+    sendTimes = self._sendTimes
+
+    if multiple:
+      while sendTimes and next(iter(sendTimes)) <= deliveryTag:
+        self.histogram.record(now - sendTimes.popitem(last=False)[1])
+    else:
+      self.histogram.record(now - sendTimes.pop(deliveryTag))
+
+
+  def isConfirmed(self, deliveryTag):
+    """
+    :param deliveryTag: delivery tag of a published message; i.e., the value
+      of numPublished after its onPublish()
+    """
+    return deliveryTag not in self._sendTimes
+
+
+  def onNack(self, deliveryTag, multiple):
+    raise RuntimeError("Got Nack from broker: deliveryTag=%s; multiple=%s"
+                       % (deliveryTag, multiple))
+
+
+
+class TransactionTracker(object):
+  """Tracks the uncommitted publishes of one transactional channel and records
+  the latency from each publish call to the return of the tx.commit that
+  commits it, which is comparable with ConfirmTracker's latencies
+  """
+
+  def __init__(self):
+    self.histogram = LatencyHistogram()
+    # Publish times of the current transaction's messages
+    self._sendTimes = []
+
+
+  @property
+  def numUncommitted(self):
+    return len(self._sendTimes)
+
+
+  def onPublish(self, sendTime=None):
+    """Must be called right before each publish on the channel
+
+    :param sendTime: time.time() value to measure the latency from; defaults
+      to now
+    """
+    self._sendTimes.append(time.time() if sendTime is None else sendTime)
+
+
+  def onCommit(self):
+    """Must be called when tx.commit returns"""
+    now = time.time()
+    for sendTime in self._sendTimes:
+      self.histogram.record(now - sendTime)
+    self._sendTimes = []
+
+
+
+class SequenceTracker(object):
+  """Checks the sequence numbers of the messages of one publisher, numbered
+  from 0, as a consumer receives them: counts duplicates, messages that
+  arrive after a later one (reordered) and, at the end, the missing ones and
+  the gaps they form. Records the latency from each message's send time to
+  its receipt, which is comparable across processes on the same host.
+  """
+
+  def __init__(self, numMessages):
+    """
+    :param numMessages: number of messages that the publisher sends
+    """
+    self.histogram = LatencyHistogram()
+    self.numMessages = numMessages
+    self.numReceived = 0
+    self.numUnique = 0
+    self.duplicates = 0
+    self.reordered = 0
+    # time.time() of the latest receipt
+    self.lastReceiveTime = None
+    # 1 per received sequence number
+    self._seen = bytearray(numMessages)
+    self._highest = -1
+
+
+  def onMessage(self, seq, sendTime):
+    """
+    :param seq: the message's sequence number
+    :param sendTime: the message's time.time() send time
+    """
+    now = time.time()
+    self.numReceived += 1
+    self.lastReceiveTime = now
+
+    if not 0 <= seq < self.numMessages:
+      raise ValueError("Sequence number %d is outside of 0..%d" % (
+        seq, self.numMessages - 1))
+    if self._seen[seq]:
+      self.duplicates += 1
+      return
+    self._seen[seq] = 1
+    self.numUnique += 1
+
+    if seq < self._highest:
+      self.reordered += 1
+    else:
+      self._highest = seq
+    self.histogram.record(now - sendTime)
+
+
+  @property
+  def isComplete(self):
+    return self.numUnique == self.numMessages
+
+
+  def summary(self, prefix=""):
+    """
+    :param prefix: prepended to each key
+    :returns: dict of the numbers of received, missing, duplicate and
+      reordered messages and of the gaps (runs of missing sequence numbers)
+    """
+    gaps = 0
+    previous = 1
+    for seen in self._seen:
+      if not seen and previous:
+        gaps += 1
+      previous = seen
+
+    return {
+      prefix + "received": self.numReceived,
+      prefix + "missing": self.numMessages - self.numUnique,
+      prefix + "gaps": gaps,
+      prefix + "duplicates": self.duplicates,
+      prefix + "reordered": self.reordered,
+    }
+
+
+
+def _checkConfirmWindow(option, optStr, value, parser):
+  if value < 1:
+    raise optparse.OptionValueError("%s must be at least 1, but got %d"
+                                    % (optStr, value))
+  setattr(parser.values, option.dest, value)
+
+
+
+def addConfirmWindowOption(parser):
+  """Adds the --confirm-window option to the given OptionParser"""
+  parser.add_option(
+      "--confirm-window",
+      action="callback",
+      type="int",
+      callback=_checkConfirmWindow,
+      dest="confirmWindow",
+      help=("Maximum number of unconfirmed messages in flight in --pubacks "
+            "mode; 1 waits for each message's Basic.Ack before publishing the "
+            "next one [default: 1]"))
+  parser.set_defaults(confirmWindow=1)
+
+
+
+def logPublishStats(log, implName, numMessages, messageSize, elapsed,
+                    confirms):
+  """Logs the throughput of a publish test and, if any confirms were
+  received, their latency percentiles
+
+  :param confirms: the test's ConfirmTracker
+  """
+  msgsPerSec = numMessages / elapsed if elapsed else float("inf")
+  log.info("%s: published %d messages of size=%d in %.3fs: %.0f msgs/s; "
+           "%.2f MB/s", implName, numMessages, messageSize, elapsed,
+           msgsPerSec, msgsPerSec * messageSize / (1024.0 * 1024))
+
+  if confirms.histogram.count:
+    logLatency(log, implName, "confirm", confirms.histogram)
+
+
+
+def logLatency(log, implName, label, histogram):
+  """Logs the percentiles of a LatencyHistogram in milliseconds
+
+  :param label: what was measured; e.g., "confirm" or "round-trip"
+  """
+  percentiles = "; ".join(
+    "p%s=%.3f" % (percent, histogram.percentile(percent) * 1000)
+    for percent in histogram.PERCENTILES)
+  log.info("%s: %s latency (ms): %s; max=%.3f", implName, label, percentiles,
+           histogram.max * 1000)
+
+
+
+class RateLimiter(object):
+  """Schedules events (e.g., publishes) at a fixed rate for open-loop tests.
+
+  Each event's intended time is derived from the start time rather than from
+  the previous event, so a sender that falls behind catches up with a burst,
+  like a real source of work arriving at a fixed rate would, instead of
+  quietly lowering the offered load. Latencies measured from the intended
+  times thus include the queueing delay that closed-loop tests omit.
+  """
+
+  def __init__(self, rate):
+    """
+    :param rate: events per second
+    """
+    self.rate = float(rate)
+    self.numScheduled = 0
+    self._startTime = None
+
+
+  def start(self, startTime=None):
+    """
+    :param startTime: time.time() value at which the first event is due;
+      defaults to now
+    """
+    self._startTime = time.time() if startTime is None else startTime
+
+
+  def nextSendTime(self):
+    """Schedules the next event
+
+    :returns: time.time() value at which the event is due
+    """
+    sendTime = self._startTime + self.numScheduled / self.rate
+    self.numScheduled += 1
+    return sendTime
+
+
+
+class IntervalSampler(object):
+  """Counts events in consecutive fixed-length intervals"""
+
+  def __init__(self, interval, startTime):
+    """
+    :param interval: length of each interval in seconds
+    :param startTime: time.time() value at which the first interval begins
+    """
+    self.interval = interval
+    self._intervalEnd = startTime + interval
+    # Number of events in each interval so far
+    self.counts = [0]
+
+
+  def record(self, now, count=1):
+    """
+    :param now: current time.time() value
+    :param count: number of events that just occurred
+    """
+    while now >= self._intervalEnd:
+      self.counts.append(0)
+      self._intervalEnd += self.interval
+    self.counts[-1] += count
+
+
+  def getRates(self, first, numIntervals):
+    """
+    :param first: index of the first interval of interest
+    :param numIntervals: number of intervals of interest; those without events
+      after the last recorded one count as idle
+    :returns: events per second in each of the given intervals
+    """
+    counts = self.counts[first:first + numIntervals]
+    counts.extend([0] * (numIntervals - len(counts)))
+    return [count / float(self.interval) for count in counts]
+
+
+
+class DurationTimer(object):
+  """Times a run of fixed duration preceded by a warmup period, sampling the
+  rate of events (e.g., publishes) in fixed-length intervals. The warmup and
+  the duration are rounded to whole intervals.
+  """
+
+  def __init__(self, duration, warmup, interval, onWarmupEnd=None):
+    """
+    :param duration: seconds to run after the warmup
+    :param warmup: seconds to run before measuring
+    :param interval: length of each sampling interval in seconds
+    :param onWarmupEnd: optional callable to invoke when the warmup ends, for
+      discarding statistics gathered during the warmup
+    """
+    self.interval = interval
+    self.warmupIntervals = int(math.ceil(warmup / float(interval)))
+    self.numIntervals = max(1, int(round(duration / float(interval))))
+    self._onWarmupEnd = onWarmupEnd
+    self.sampler = None
+    # (user, system) CPU seconds used during the measured intervals; set
+    # when tick() first returns False
+    self.cpuTimes = None
+
+
+  def start(self):
+    now = time.time()
+    self.sampler = IntervalSampler(self.interval, now)
+    self._warmupEnd = now + self.warmupIntervals * self.interval
+    self._endTime = self._warmupEnd + self.numIntervals * self.interval
+    self._measureStartCpuTimes = getCpuTimes()
+    if not self.warmupIntervals:
+      self._endWarmup()
+
+
+  def tick(self, count=1):
+    """Records events that are about to occur, unless the run is over
+
+    :returns: False once the run is over
+    """
+    now = time.time()
+
+    if now >= self._endTime:
+      if self.cpuTimes is None:
+        self.cpuTimes = getCpuTimes(since=self._measureStartCpuTimes)
+      return False
+
+    if self._warmupEnd is not None and now >= self._warmupEnd:
+      self._endWarmup()
+
+    self.sampler.record(now, count)
+    return True
+
+
+  def _endWarmup(self):
+    self._warmupEnd = None
+    self._measureStartCpuTimes = getCpuTimes()
+    if self._onWarmupEnd is not None:
+      self._onWarmupEnd()
+
+
+  @property
+  def numMeasured(self):
+    """Number of events recorded after the warmup"""
+    return sum(self.sampler.counts[self.warmupIntervals:])
+
+
+  @property
+  def measuredDuration(self):
+    return self.numIntervals * self.interval
+
+
+  def getMeasuredRates(self):
+    """
+    :returns: events per second in each interval after the warmup
+    """
+    return self.sampler.getRates(self.warmupIntervals, self.numIntervals)
+
+
+
+# Minimum number of intervals that findSteadyState() accepts as a steady
+# window
+STEADY_STATE_MIN_INTERVALS = 3
+
+
+def findSteadyState(rates, maxCv):
+  """Finds the longest trailing window of rates whose coefficient of variation
+  (standard deviation / mean) is within the given threshold; i.e., the run
+  after any ramp-up or cold-start effects have died down
+
+  :param rates: per-interval rates in chronological order
+  :param maxCv: coefficient of variation threshold; e.g., 0.1
+  :returns: (firstIndex, meanRate, cv) of the window, or None if no window of
+    at least STEADY_STATE_MIN_INTERVALS intervals is steady
+  """
+  for first in xrange(len(rates) - STEADY_STATE_MIN_INTERVALS + 1):
+    window = rates[first:]
+    mean = sum(window) / float(len(window))
+    if not mean:
+      continue
+    variance = sum((rate - mean) ** 2 for rate in window) / len(window)
+    cv = math.sqrt(variance) / mean
+    if cv <= maxCv:
+      return first, mean, cv
+
+  return None
@@ -0,0 +1,97 @@
+"""Cooperative tasks multiplexed over one client connection, the way asyncio
+services run many concurrent producers on one event loop.
+
+This code base runs on Python 2, which has no asyncio, and none of the
+client adapters run on one, so TaskLoop stands in for it: each task is a
+generator that yields what it waits for, and the loop resumes the tasks that
+are ready in turn and otherwise blocks in the adapter's pump() until the next
+one is due. A task may yield:
+
+  None - to give the other tasks a turn
+  a number - a time.time() value to sleep until
+  a callable - a predicate to wait until it returns True; e.g., until the
+    broker confirms the task's message
+
+Deliveries and confirms are dispatched by the adapter's callbacks from
+within pump(), which the loop also calls without blocking after each round of
+ready tasks, like asyncio's event loop polls for I/O between its callbacks.
+"""
+
+import collections
+import heapq
+import itertools
+import time
+
+
+
+# Maximum seconds to block in pump() before checking the predicates of the
+# waiting tasks again
+MAX_POLL_TIMEOUT = 0.1
+
+
+
+class TaskLoop(object):
+  """Runs generator tasks until all of them finish"""
+
+  def __init__(self, adapter):
+    """
+    :param adapter: client_adapter.ClientAdapter whose I/O the tasks wait for
+    """
+    self.adapter = adapter
+    self._ready = collections.deque()
+    # Heap of (due time, tie breaker, task)
+    self._sleeping = []
+    # (predicate, task)
+    self._waiting = []
+    self._counter = itertools.count()
+    self.numTasks = 0
+
+
+  def spawn(self, task):
+    """Schedules a generator task to run once run() is called"""
+    self._ready.append(task)
+    self.numTasks += 1
+
+
+  def run(self):
+    """Runs the tasks until all of them are finished; exceptions of a task
+    propagate
+    """
+    while self._ready or self._sleeping or self._waiting:
+      now = time.time()
+      while self._sleeping and self._sleeping[0][0] <= now:
+        self._ready.append(heapq.heappop(self._sleeping)[2])
+
+      if self._waiting:
+        waiting = self._waiting
+        self._waiting = []
+        for predicate, task in waiting:
+          if predicate():
+            self._ready.append(task)
+          else:
+            self._waiting.append((predicate, task))
+
+      if self._ready:
+        for _ in xrange(len(self._ready)):
+          self._step(self._ready.popleft())
+        self.adapter.pump(0)
+        continue
+
+      timeout = MAX_POLL_TIMEOUT
+      if self._sleeping:
+        timeout = max(0, min(timeout, self._sleeping[0][0] - time.time()))
+      self.adapter.pump(timeout)
+
+
+  def _step(self, task):
+    try:
+      waitFor = next(task)
+    except StopIteration:
+      return
+
+    if waitFor is None:
+      self._ready.append(task)
+    elif callable(waitFor):
+      self._waiting.append((waitFor, task))
+    else:
+      heapq.heappush(self._sleeping, (waitFor, next(self._counter), task))
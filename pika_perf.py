@@ -3,15 +3,35 @@
 
 import logging
 from optparse import OptionParser
+import select
 import sys
 
 import pika
+import pika.connection
+from pika.adapters import select_connection
+
+import client_adapter
+import embedded_broker
 
 g_log = logging.getLogger("pika_perf")
 
 
 ROUTING_KEY = "test"
 
+# pika generates random consumer tags otherwise, which would break the replay
+# of recorded deliveries (see socket_stats)
+CONSUMER_TAG = "amqp-perf"
+
+# pika's connection classes that run on an ioloop, which are None if the
+# library they build on isn't installed
+ASYNC_CONNECTION_CLASSES = ["SelectConnection",
+                            "TornadoConnection",
+                            "TwistedConnection"]
+
+# I/O pollers of SelectConnection's ioloop; names of the select module's
+# functions, of which only those available on the platform work
+SELECT_POLLERS = ["select", "poll", "epoll", "kqueue"]
+
 #logging.getLogger("pika").setLevel(logging.DEBUG)
 
 def main():
@@ -27,7 +47,9 @@ def main():
     "\t%prog COMMAND --help\n"
     "\n"
     "Supported COMMANDs:\n"
-    "\tpublish - publish messages using one of several pika connection classes")
+    "\tpublish    - publish messages using one of several pika connection\n"
+    "\t             classes\n"
+    "\taltpubcons - Alternate publishing/consuming one message at a time.")
 
   topParser = OptionParser(topHelpString)
 
@@ -38,6 +60,10 @@ def main():
 
   if command == "publish":
     _handlePublishTest(sys.argv[2:])
+  elif command == "altpubcons":
+    # Imported here since amqp_perf imports this module to load its adapters
+    import amqp_perf
+    amqp_perf.handleImplAltPubConsTest(sys.argv[2:], ADAPTERS)
   elif not command.startswith("-"):
     topParser.error("Unexpected action: %s" % (command,))
   else:
@@ -67,18 +93,28 @@ def _handlePublishTest(args):
     "pika connection class") % (ROUTING_KEY,)
   parser = OptionParser(helpString)
 
-  implChoices = ["BlockingConnection",
-                 "SynchronousConnection",
-                 "SelectConnection"]
+  implChoices = (["BlockingConnection", "SynchronousConnection"] +
+                 ASYNC_CONNECTION_CLASSES)
   parser.add_option(
       "--impl",
       action="store",
       type="choice",
       dest="impl",
       choices=implChoices,
-      help=("Selection of pika connection class "
+      help=("Selection of pika connection class; TornadoConnection and "
+            "TwistedConnection require tornado and twisted, respectively "
             "[REQUIRED; must be one of: %s]" % ", ".join(implChoices)))
 
+  parser.add_option(
+      "--poller",
+      action="store",
+      type="choice",
+      dest="poller",
+      choices=SELECT_POLLERS,
+      default=None,
+      help=("I/O poller of SelectConnection's ioloop; one of: %s "
+            "[default: the best one available]" % ", ".join(SELECT_POLLERS)))
+
   parser.add_option(
       "--exg",
       action="store",
@@ -109,6 +145,8 @@ def _handlePublishTest(args):
       default=False,
       help="Publish in delivery confirmation mode [defaults to OFF]")
 
+  embedded_broker.addBrokerOption(parser)
+
   options, positionalArgs = parser.parse_args(sys.argv[2:])
 
   if positionalArgs:
@@ -121,20 +159,36 @@ def _handlePublishTest(args):
   if options.exchange is None:
     parser.error("--exg must be specified with a valid destination exchange name")
 
-  if options.impl in ["BlockingConnection", "SynchronousConnection"]:
-    runBlockingPublishTest(implClassName=options.impl,
+  if getattr(pika, options.impl) is None:
+    parser.error("--impl=%s requires a library that isn't installed"
+                 % (options.impl,))
+
+  if options.poller is not None:
+    if options.impl != "SelectConnection":
+      parser.error("--poller applies only to --impl=SelectConnection")
+    if not hasattr(select, options.poller):
+      parser.error("--poller=%s isn't available on this platform"
+                   % (options.poller,))
+
+  with embedded_broker.brokerContext(
+      options.broker, exchanges=[options.exchange]) as brokerAddress:
+    if options.impl in ["BlockingConnection", "SynchronousConnection"]:
+      runBlockingPublishTest(implClassName=options.impl,
+                             exchange=options.exchange,
+                             numMessages=options.numMessages,
+                             messageSize=options.messageSize,
+                             deliveryConfirmation=options.deliveryConfirmation,
+                             brokerAddress=brokerAddress)
+    else:
+      assert options.impl in ASYNC_CONNECTION_CLASSES, options.impl
+
+      runSelectPublishTest(implClassName=options.impl,
                            exchange=options.exchange,
                            numMessages=options.numMessages,
                            messageSize=options.messageSize,
-                           deliveryConfirmation=options.deliveryConfirmation)
-  else:
-    assert options.impl == "SelectConnection", options.impl
-
-    runSelectPublishTest(implClassName=options.impl,
-                         exchange=options.exchange,
-                         numMessages=options.numMessages,
-                         messageSize=options.messageSize,
-                         deliveryConfirmation=options.deliveryConfirmation)
+                           deliveryConfirmation=options.deliveryConfirmation,
+                           brokerAddress=brokerAddress,
+                           poller=options.poller)
 
 
 
@@ -143,14 +197,15 @@ def runBlockingPublishTest(implClassName,
                            exchange,
                            numMessages,
                            messageSize,
-                           deliveryConfirmation):
+                           deliveryConfirmation,
+                           brokerAddress):
   g_log.info("runBlockingPublishTest: impl=%s; exchange=%s; numMessages=%d; "
              "messageSize=%s; deliveryConfirmation=%s", implClassName, exchange,
              numMessages, messageSize, deliveryConfirmation)
 
   connectionClass = getattr(pika, implClassName)
 
-  connection = connectionClass(getPikaConnectionParameters())
+  connection = connectionClass(getPikaConnectionParameters(brokerAddress))
   g_log.info("%s: opened connection", implClassName)
 
   message = "a" * messageSize
@@ -187,10 +242,19 @@ def runSelectPublishTest(implClassName,
                          exchange,
                          numMessages,
                          messageSize,
-                         deliveryConfirmation):
+                         deliveryConfirmation,
+                         brokerAddress,
+                         poller=None):
+  """Publishes via one of ASYNC_CONNECTION_CLASSES, running its ioloop until
+  the connection closes
+
+  :param poller: one of SELECT_POLLERS for SelectConnection; None for pika's
+    choice
+  """
   g_log.info("runSelectPublishTest: impl=%s; exchange=%s; numMessages=%d; "
-             "messageSize=%s; deliveryConfirmation=%s", implClassName, exchange,
-             numMessages, messageSize, deliveryConfirmation)
+             "messageSize=%s; deliveryConfirmation=%s; poller=%s",
+             implClassName, exchange, numMessages, messageSize,
+             deliveryConfirmation, poller)
 
   message = "a" * messageSize
 
@@ -249,19 +313,22 @@ def runSelectPublishTest(implClassName,
   def onConnectionOpen(connection):
     g_log.info("Select opening channel...")
 
-    ch = connection.channel(on_open_callback=onChannelOpen)
+    ch = openAsyncChannel(connection, onChannelOpen)
     ch.add_on_close_callback(onChannelClosed)
     ch.add_on_return_callback(onMessageReturn)
 
 
   def onConnectionClosed(connection, reasonCode, reasonText):
     g_log.info("Select connection closed (%s): %s", reasonCode, reasonText)
+    connection.ioloop.stop()
 
 
   connectionClass = getattr(pika, implClassName)
 
-  connection = connectionClass(
-    getPikaConnectionParameters(),
+  connection = createAsyncConnection(
+    implClassName,
+    brokerAddress,
+    poller=poller,
     on_open_callback=onConnectionOpen,
     on_close_callback=onConnectionClosed)
 
@@ -277,21 +344,427 @@ def runSelectPublishTest(implClassName,
   g_log.info("%s: DONE", implClassName)
 
 
-def getPikaConnectionParameters():
+
+class PikaBlockingAdapter(client_adapter.ClientAdapter):
+  """amqp_perf adapter for pika.BlockingConnection"""
+
+  LIBRARY = "pika"
+  IMPL = "BlockingConnection"
+  STOP_AND_WAIT_CONFIRMS = True
+  SUPPORTS_TRANSACTIONS = True
+
+
+  @classmethod
+  def isAvailable(cls):
+    return hasattr(pika, cls.IMPL)
+
+
+  def connect(self, deliveryConfirmation):
+    connectionClass = getattr(pika, self.IMPL)
+    self._connection = connectionClass(
+      getPikaConnectionParameters(self.brokerAddress))
+
+
+  def openChannel(self):
+    return client_adapter.ChannelHandle(self._connection.channel())
+
+
+  def enableConfirms(self, channel, onAck, onNack):
+    channel.impl.confirm_delivery()
+    channel.onAck = onAck
+    channel.onNack = onNack
+
+
+  def selectTransactions(self, channel):
+    channel.impl.tx_select()
+
+
+  def commit(self, channel):
+    channel.impl.tx_commit()
+
+
+  def publish(self, channel, exchange, routingKey, body):
+    res = channel.impl.basic_publish(exchange=exchange, routing_key=routingKey,
+                                     immediate=False, mandatory=False,
+                                     body=body)
+    if channel.onAck is not None:
+      # basic_publish returns only after Basic.Ack/Nack in confirm mode
+      channel.publishSeqNo += 1
+      if res is False:
+        channel.onNack(channel.publishSeqNo, False)
+      else:
+        channel.onAck(channel.publishSeqNo, False)
+
+
+  def declareQueue(self, channel, queue=""):
+    frame = channel.impl.queue_declare(queue=queue, durable=False,
+                                       exclusive=False, auto_delete=True)
+    return frame.method.queue
+
+
+  def consume(self, channel, queue, onMessage, noAck, prefetch=0):
+    if prefetch:
+      channel.impl.basic_qos(prefetch_count=prefetch)
+
+    def onDelivery(ch, method, properties, body):
+      onMessage(body, method.delivery_tag)
+
+    channel.impl.basic_consume(onDelivery, queue=queue, no_ack=noAck,
+                               consumer_tag=CONSUMER_TAG)
+
+
+  def ack(self, channel, deliveryTag, multiple=False):
+    channel.impl.basic_ack(delivery_tag=deliveryTag, multiple=multiple)
+
+
+  def pump(self, timeout):
+    self._connection.process_data_events(time_limit=timeout)
+
+
+  def closeChannel(self, channel):
+    channel.impl.close()
+    channel.closed = True
+
+
+  def close(self):
+    self._connection.close()
+
+
+
+class PikaSynchronousAdapter(PikaBlockingAdapter):
+  """amqp_perf adapter for pika.SynchronousConnection"""
+
+  IMPL = "SynchronousConnection"
+
+
+
+class PikaSelectAdapter(client_adapter.ClientAdapter):
+  """amqp_perf adapter for pika.SelectConnection, driving its ioloop one poll
+  at a time from pump()
   """
+
+  LIBRARY = "pika"
+  IMPL = "SelectConnection"
+
+  # One of ASYNC_CONNECTION_CLASSES
+  CONNECTION_CLASS = "SelectConnection"
+
+  # One of SELECT_POLLERS; None for the one that pika picks
+  POLLER = None
+
+  SUPPORTS_TRANSACTIONS = True
+
+
+  @classmethod
+  def isAvailable(cls):
+    return (getattr(pika, cls.CONNECTION_CLASS, None) is not None and
+            (cls.POLLER is None or hasattr(select, cls.POLLER)))
+
+
+  def connect(self, deliveryConfirmation):
+    self._opened = False
+    self._closed = False
+    self._error = None
+
+    def onOpen(connection):
+      self._opened = True
+
+    def onOpenError(connection, *args):
+      self._error = "Select connection failed to open: %s" % (args,)
+
+    def onClosed(connection, reasonCode, reasonText):
+      self._closed = True
+      if not self._closing:
+        self._error = "Select connection closed unexpectedly (%s): %s" % (
+          reasonCode, reasonText)
+
+    self._closing = False
+    self._connection = createAsyncConnection(
+      self.CONNECTION_CLASS,
+      self.brokerAddress,
+      poller=self.POLLER,
+      on_open_callback=onOpen,
+      on_open_error_callback=onOpenError,
+      on_close_callback=onClosed)
+
+    self.waitUntil(lambda: self._opened)
+
+
+  def openChannel(self):
+    result = []
+    openAsyncChannel(self._connection, result.append)
+    self.waitUntil(lambda: result)
+
+    channel = client_adapter.ChannelHandle(result[0])
+
+    def onChannelClosed(ch, reasonCode, reasonText):
+      if not channel.closed:
+        self._error = "Select channel closed unexpectedly (%s): %s" % (
+          reasonCode, reasonText)
+      channel.closed = True
+
+    channel.impl.add_on_close_callback(onChannelClosed)
+    return channel
+
+
+  def enableConfirms(self, channel, onAck, onNack):
+    channel.onAck = onAck
+    channel.onNack = onNack
+
+    def onDeliveryConfirmation(methodFrame):
+      method = methodFrame.method
+      if isinstance(method, pika.spec.Basic.Ack):
+        onAck(method.delivery_tag, method.multiple)
+      else:
+        onNack(method.delivery_tag, method.multiple)
+
+    channel.impl.confirm_delivery(callback=onDeliveryConfirmation)
+
+
+  def selectTransactions(self, channel):
+    result = []
+    channel.impl.tx_select(result.append)
+    self.waitUntil(lambda: result)
+
+
+  def commit(self, channel):
+    result = []
+    channel.impl.tx_commit(result.append)
+    self.waitUntil(lambda: result)
+
+
+  def publish(self, channel, exchange, routingKey, body):
+    channel.impl.basic_publish(exchange=exchange, routing_key=routingKey,
+                               immediate=False, mandatory=False, body=body)
+
+
+  def declareQueue(self, channel, queue=""):
+    result = []
+    channel.impl.queue_declare(result.append, queue=queue, durable=False,
+                               exclusive=False, auto_delete=True)
+    self.waitUntil(lambda: result)
+    return result[0].method.queue
+
+
+  def consume(self, channel, queue, onMessage, noAck, prefetch=0):
+    if prefetch:
+      result = []
+      channel.impl.basic_qos(result.append, prefetch_count=prefetch)
+      self.waitUntil(lambda: result)
+
+    def onDelivery(ch, method, properties, body):
+      onMessage(body, method.delivery_tag)
+
+    channel.impl.basic_consume(onDelivery, queue=queue, no_ack=noAck,
+                               consumer_tag=CONSUMER_TAG)
+
+
+  def ack(self, channel, deliveryTag, multiple=False):
+    channel.impl.basic_ack(delivery_tag=deliveryTag, multiple=multiple)
+
+
+  def pump(self, timeout):
+    self._poll(timeout)
+
+    if self._error is not None:
+      raise Exception(self._error)
+
+
+  def _poll(self, timeout):
+    """Runs one iteration of the ioloop, blocking at most timeout seconds"""
+    ioloop = self._connection.ioloop
+    # Bound the poll's blocking time by the requested timeout
+    timerId = ioloop.add_timeout(timeout, lambda: None)
+    try:
+      ioloop.poll()
+      ioloop.process_timeouts()
+    finally:
+      ioloop.remove_timeout(timerId)
+
+
+  def closeChannel(self, channel):
+    channel.closed = True
+    channel.impl.close()
+    self.waitUntil(lambda: channel.impl.is_closed)
+
+
+  def close(self):
+    self._closing = True
+    self._connection.close()
+    self.waitUntil(lambda: self._closed)
+
+
+
+class PikaSelectSelectAdapter(PikaSelectAdapter):
+  """amqp_perf adapter for pika.SelectConnection with the select() poller"""
+
+  IMPL = "SelectConnection-select"
+  POLLER = "select"
+
+
+
+class PikaSelectPollAdapter(PikaSelectAdapter):
+  """amqp_perf adapter for pika.SelectConnection with the poll() poller"""
+
+  IMPL = "SelectConnection-poll"
+  POLLER = "poll"
+
+
+
+class PikaSelectEpollAdapter(PikaSelectAdapter):
+  """amqp_perf adapter for pika.SelectConnection with the epoll poller"""
+
+  IMPL = "SelectConnection-epoll"
+  POLLER = "epoll"
+
+
+
+class PikaTornadoAdapter(PikaSelectAdapter):
+  """amqp_perf adapter for pika.TornadoConnection, which runs on tornado's
+  global IOLoop
+  """
+
+  IMPL = "TornadoConnection"
+  CONNECTION_CLASS = "TornadoConnection"
+  PROCESS_WIDE_IOLOOP = True
+
+
+  def _poll(self, timeout):
+    connection = self._connection
+    # Tornado's IOLoop has no single-iteration call, and its own poll doesn't
+    # return before its next timeout, so wait for input here unless there is
+    # output to flush
+    if not connection.outbound_buffer:
+      select.select([connection.socket], [], [], timeout)
+
+    # start() runs the first callback, polls without blocking because there is
+    # another callback, handles the ready events and then runs the stop()
+    ioloop = connection.ioloop
+    ioloop.add_callback(lambda: ioloop.add_callback(ioloop.stop))
+    ioloop.start()
+
+
+
+class PikaTwistedAdapter(PikaSelectAdapter):
+  """amqp_perf adapter for pika.TwistedConnection, which runs on twisted's
+  global reactor
+  """
+
+  IMPL = "TwistedConnection"
+  CONNECTION_CLASS = "TwistedConnection"
+  PROCESS_WIDE_IOLOOP = True
+
+
+  def _poll(self, timeout):
+    # The connection's ioloop is pika's adapter of the reactor
+    self._connection.ioloop.reactor.iterate(timeout)
+
+
+
+class PikaCodec(client_adapter.FrameCodec):
+  """pika's frame marshalling and pika.frame.decode_frame()"""
+
+  LIBRARY = "pika"
+
+
+  def encodePublish(self, channelNumber, exchange, routingKey, body, headers,
+                    frameMax):
+    # Same as pika.connection.Connection._send_message()
+    bodyMax = frameMax - pika.spec.FRAME_HEADER_SIZE - pika.spec.FRAME_END_SIZE
+    pieces = [
+      pika.frame.Method(
+        channelNumber,
+        pika.spec.Basic.Publish(exchange=exchange,
+                                routing_key=routingKey)).marshal(),
+      pika.frame.Header(channelNumber, len(body),
+                        pika.BasicProperties(headers=headers or None)).marshal()]
+    for start in xrange(0, len(body), bodyMax):
+      pieces.append(
+        pika.frame.Body(channelNumber, body[start:start + bodyMax]).marshal())
+    return pieces
+
+
+  def decodeFrames(self, data):
+    # Same as pika.connection.Connection._on_data_available()
+    frames = []
+    while data:
+      consumed, frame = pika.frame.decode_frame(data)
+      if not consumed:
+        break
+      frames.append(frame)
+      data = data[consumed:]
+    return frames
+
+
+
+ADAPTERS = [PikaBlockingAdapter, PikaSynchronousAdapter, PikaSelectAdapter,
+            PikaSelectSelectAdapter, PikaSelectPollAdapter,
+            PikaSelectEpollAdapter, PikaTornadoAdapter, PikaTwistedAdapter]
+
+CODEC = PikaCodec
+
+
+
+def getPikaConnectionParameters(brokerAddress=None):
+  """
+  :param brokerAddress: (host, port) of the broker; None for localhost:5672
   :returns: instance of pika.ConnectionParameters for the AMQP broker (RabbitMQ
   most likely)
   """
-  host = "localhost"
+  host, port = brokerAddress or ("localhost", 5672)
 
   vhost = "/"
 
   credentials = pika.PlainCredentials("guest", "guest")
 
-  return pika.ConnectionParameters(host=host, virtual_host=vhost,
+  return pika.ConnectionParameters(host=host, port=port, virtual_host=vhost,
                                    credentials=credentials)
 
 
 
+def createAsyncConnection(implClassName, brokerAddress, poller=None,
+                          **callbacks):
+  """Creates a connection that doesn't stop its ioloop when it closes
+
+  :param implClassName: one of ASYNC_CONNECTION_CLASSES
+  :param brokerAddress: (host, port) of the broker; None for localhost:5672
+  :param poller: one of SELECT_POLLERS for SelectConnection; None for pika's
+    choice
+  :param callbacks: on_open_callback etc. of the connection class
+  :returns: the connection, whose ioloop attribute is the ioloop that it runs
+    on: SelectConnection's IOLoop, tornado's IOLoop or twisted's reactor
+  """
+  connectionClass = getattr(pika, implClassName)
+  if connectionClass is None:
+    raise ValueError("pika.%s requires a library that isn't installed"
+                     % (implClassName,))
+
+  if poller is not None:
+    # IOLoop picks its poller from this module global when it's created
+    defaultPoller = select_connection.SELECT_TYPE
+    select_connection.SELECT_TYPE = poller
+    try:
+      callbacks["custom_ioloop"] = select_connection.IOLoop()
+    finally:
+      select_connection.SELECT_TYPE = defaultPoller
+
+  return connectionClass(getPikaConnectionParameters(brokerAddress),
+                         stop_ioloop_on_close=False,
+                         **callbacks)
+
+
+
+def openAsyncChannel(connection, onOpen):
+  """Opens a channel via pika's callback API, which TwistedConnection.channel()
+  replaces with a Deferred
+
+  :param onOpen: called with the pika.channel.Channel once it's open
+  :returns: the pika.channel.Channel
+  """
+  return pika.connection.Connection.channel(connection,
+                                            on_open_callback=onOpen)
+
+
+
 if __name__ == '__main__':
   main()
@@ -0,0 +1,402 @@
+"""Opt-in socket instrumentation for the perf tests.
+
+instrumentSockets() temporarily replaces socket.socket with a subclass that
+counts the send/recv calls of every socket created meanwhile, whichever client
+library creates it, and parses the AMQP frame boundaries of both directions.
+This shows how well a client coalesces its output; e.g., whether the method,
+header and body frames of a publish go out in one send() or in three.
+
+The same hook can record the bytes that each connection receives from the
+broker (StreamRecorder) and later feed them back to the client from memory
+instead of a broker (StreamReplayer). Replayed runs exercise only the client's
+own frame parsing and dispatch, and produce the same input every time.
+"""
+
+import _socket
+import collections
+from contextlib import contextmanager
+import errno
+import pickle
+import socket
+import struct
+
+
+# Size of the AMQP protocol header that starts the client's output
+PROTOCOL_HEADER_SIZE = 8
+
+# type (1), channel (2) and payload size (4) of a frame; followed by the
+# payload and the frame-end octet
+FRAME_HEADER_SIZE = 7
+
+
+
+class FrameCounter(object):
+  """Tracks AMQP frame boundaries in one direction of a connection's byte
+  stream, which may be split into chunks arbitrarily
+  """
+
+  def __init__(self, skip=0):
+    """
+    :param skip: number of leading bytes that aren't frames (the protocol
+      header of the client's output)
+    """
+    # Bytes left of the current frame (or of the leading bytes to skip)
+    self._skip = skip
+    # Bytes of a frame header split across chunks
+    self._header = bytearray()
+
+
+  def feed(self, data):
+    """
+    :param data: next chunk of the stream; str, bytearray or memoryview
+    :returns: number of frames that start in the chunk
+    """
+    numFrames = 0
+    pos = 0
+    size = len(data)
+
+    while pos < size:
+      if self._skip:
+        step = min(self._skip, size - pos)
+        self._skip -= step
+        pos += step
+        continue
+
+      if not self._header:
+        numFrames += 1
+
+      part = bytearray(data[pos:pos + FRAME_HEADER_SIZE - len(self._header)])
+      self._header += part
+      pos += len(part)
+
+      if len(self._header) == FRAME_HEADER_SIZE:
+        payloadSize, = struct.unpack(">I", bytes(self._header[3:]))
+        # Payload plus frame-end octet
+        self._skip = payloadSize + 1
+        self._header = bytearray()
+
+    return numFrames
+
+
+
+class SocketStats(object):
+  """Totals of the send and receive calls of instrumented sockets"""
+
+  def __init__(self):
+    self.reset()
+
+
+  def reset(self):
+    """Zeroes the counts; e.g., at the start of the timed interval"""
+    self.sendCalls = 0
+    self.sendBytes = 0
+    self.framesSent = 0
+    self.recvCalls = 0
+    self.recvBytes = 0
+    self.framesReceived = 0
+    # Power-of-two size bucket (lowest size in the bucket) -> number of sends
+    self.sendSizes = collections.defaultdict(int)
+    # Number of frames starting in a send -> number of sends
+    self.framesPerSend = collections.defaultdict(int)
+
+
+  def onSend(self, numBytes, numFrames):
+    self.sendCalls += 1
+    self.sendBytes += numBytes
+    self.framesSent += numFrames
+    self.sendSizes[getSizeBucket(numBytes)] += 1
+    self.framesPerSend[numFrames] += 1
+
+
+  def onRecv(self, numBytes, numFrames):
+    self.recvCalls += 1
+    self.recvBytes += numBytes
+    self.framesReceived += numFrames
+
+
+  def summary(self, prefix=""):
+    """
+    :param prefix: prepended to each key
+    :returns: dict of the counts; the sendSizes and framesPerSend histograms
+      are dicts of their own
+    """
+    return {
+      prefix + "sendCalls": self.sendCalls,
+      prefix + "sendBytes": self.sendBytes,
+      prefix + "framesSent": self.framesSent,
+      prefix + "recvCalls": self.recvCalls,
+      prefix + "recvBytes": self.recvBytes,
+      prefix + "framesReceived": self.framesReceived,
+      prefix + "sendSizes": dict(self.sendSizes),
+      prefix + "framesPerSend": dict(self.framesPerSend),
+    }
+
+
+
+def getSizeBucket(numBytes):
+  """
+  :returns: the largest power of two that doesn't exceed numBytes (0 for 0)
+  """
+  return 1 << (numBytes.bit_length() - 1) if numBytes else 0
+
+
+
+class StreamRecorder(object):
+  """Records the bytes that instrumented sockets receive, one stream per
+  socket in the order of their creation.
+
+  Each received chunk is stored with the number of bytes that the client had
+  sent on the socket before the recv call, which is how far the client must
+  get before the chunk is replayed to it; see ReplayStream.
+  """
+
+  def __init__(self):
+    # List of [(bytes sent before the recv, received bytes)] per socket
+    self.streams = []
+
+
+  def newStream(self):
+    """
+    :returns: the list to append the (bytes sent, received bytes) chunks of a
+      new socket to
+    """
+    chunks = []
+    self.streams.append(chunks)
+    return chunks
+
+
+  def save(self, path, client):
+    """
+    :param client: name of the client interface that made the recording,
+      checked on replay
+    """
+    with open(path, "wb") as recordingFile:
+      pickle.dump(dict(client=client, streams=self.streams), recordingFile, 2)
+
+
+
+class StreamReplayer(object):
+  """Hands out the streams of a StreamRecorder's recording to the sockets
+  that the replayed run creates, in the same order
+  """
+
+  def __init__(self, client, streams):
+    self.client = client
+    self._streams = collections.deque(streams)
+
+
+  @classmethod
+  def load(cls, path, client):
+    """
+    :param client: name of the client interface to replay to; must be the one
+      that made the recording
+    """
+    with open(path, "rb") as recordingFile:
+      recording = pickle.load(recordingFile)
+
+    if recording["client"] != client:
+      raise ValueError("%s was recorded with %s, not %s" % (
+        path, recording["client"], client))
+
+    return cls(client, recording["streams"])
+
+
+  def nextStream(self):
+    """
+    :returns: ReplayStream of the next socket
+    """
+    if not self._streams:
+      raise RuntimeError("The recording has no more connections to replay")
+    return ReplayStream(self._streams.popleft())
+
+
+
+class ReplayStream(object):
+  """Received bytes of one recorded socket"""
+
+  def __init__(self, chunks):
+    """
+    :param chunks: list of (bytes sent before the recv, received bytes)
+    """
+    self._chunks = collections.deque(chunks)
+    # Unread part of the current chunk
+    self._current = memoryview(b"")
+
+
+  def isReadable(self, sentBytes):
+    """
+    :param sentBytes: number of bytes that the client has sent so far
+    :returns: True if read() would return data or the end of the stream
+    """
+    return (bool(self._current) or not self._chunks or
+            self._chunks[0][0] <= sentBytes)
+
+
+  def read(self, maxBytes, sentBytes):
+    """Returns the recorded bytes in the recorded recv() chunks, holding back
+    each chunk until the client has sent as much as it had when the chunk
+    arrived, so that replies don't overtake their requests
+
+    :param maxBytes: maximum number of bytes to return
+    :param sentBytes: number of bytes that the client has sent so far
+    :returns: the next bytes of the stream; empty at the end of the recording
+    :raises socket.error: EWOULDBLOCK if the next chunk is held back
+    """
+    if not self._current:
+      if not self._chunks:
+        return b""
+      if self._chunks[0][0] > sentBytes:
+        raise socket.error(errno.EWOULDBLOCK,
+                           "Replayed data waits for the client's request")
+      self._current = memoryview(self._chunks.popleft()[1])
+
+    data = self._current[:maxBytes].tobytes()
+    self._current = self._current[maxBytes:]
+    return data
+
+
+
+@contextmanager
+def instrumentSockets(stats=None, recorder=None, replayer=None):
+  """Instruments the sockets created via socket.socket within the context
+
+  :param stats: if not None, SocketStats to add the I/O of the instrumented
+    sockets to
+  :param recorder: if not None, StreamRecorder to record the received bytes of
+    the instrumented sockets in
+  :param replayer: if not None, StreamReplayer whose streams the instrumented
+    sockets receive instead of connecting anywhere; what they send is
+    discarded
+  """
+  originalSocket = socket.socket
+
+  class InstrumentedSocket(originalSocket):
+    def __init__(self, *args, **kwargs):
+      replay = replayer.nextStream() if replayer is not None else None
+      if replay is None:
+        super(InstrumentedSocket, self).__init__(*args, **kwargs)
+      else:
+        # One end of a socket pair stands in for the connection, so that the
+        # clients' select() and poll() calls keep working: the other end keeps
+        # one byte in it while replayed data is due, which makes it readable
+        # exactly then, and it's always writable since nothing is sent to the
+        # other end. Unlike socket.socketpair(), _socket's doesn't create its
+        # sockets via the patched socket.socket
+        ours, self._replayPeer = _socket.socketpair()
+        if hasattr(ours, "detach"):
+          super(InstrumentedSocket, self).__init__(
+            ours.family, ours.type, ours.proto, fileno=ours.detach())
+        else:
+          super(InstrumentedSocket, self).__init__(_sock=ours)
+
+      # The instance attributes shadow both Python 2's per-instance
+      # delegates and Python 3's methods
+      sendFrames = FrameCounter(skip=PROTOCOL_HEADER_SIZE)
+      recvFrames = FrameCounter()
+      chunks = recorder.newStream() if recorder is not None else None
+      # Bytes sent so far; [count] for updating from the closures
+      sent = [0]
+
+      if replay is None:
+        send = self.send
+        sendall = self.sendall
+        recv = self.recv
+        recv_into = self.recv_into
+      else:
+        rawRecv = self.recv
+        # Whether the byte that makes the stand-in readable is in it
+        readable = [False]
+
+        def syncReadable():
+          if replay.isReadable(sent[0]) != readable[0]:
+            if readable[0]:
+              rawRecv(1)
+            else:
+              self._replayPeer.send(b"!")
+            readable[0] = not readable[0]
+
+        def send(data, *args):
+          return len(data)
+
+        def sendall(data, *args):
+          return None
+
+        def recv(bufsize, *args):
+          data = replay.read(bufsize, sent[0])
+          syncReadable()
+          return data
+
+        def recv_into(buf, nbytes=0, *args):
+          data = recv(nbytes or len(buf))
+          memoryview(buf)[:len(data)] = data
+          return len(data)
+
+        address = [("127.0.0.1", 0)]
+
+        def connect(peerAddress):
+          address[0] = peerAddress
+
+        def connectEx(peerAddress):
+          connect(peerAddress)
+          return 0
+
+        def ignore(*args):
+          return None
+
+        self.connect = connect
+        self.connect_ex = connectEx
+        # The stand-in's own addresses and TCP options aren't what clients
+        # expect
+        self.getpeername = lambda: address[0]
+        self.getsockname = lambda: ("127.0.0.1", 0)
+        self.setsockopt = ignore
+
+        syncReadable()
+
+      def onSent(numBytes):
+        sent[0] += numBytes
+        if replay is not None:
+          syncReadable()
+
+      def instrumentedSend(data, *args):
+        numBytes = send(data, *args)
+        onSent(numBytes)
+        if stats is not None:
+          stats.onSend(numBytes, sendFrames.feed(memoryview(data)[:numBytes]))
+        return numBytes
+
+      def instrumentedSendall(data, *args):
+        result = sendall(data, *args)
+        onSent(len(data))
+        if stats is not None:
+          stats.onSend(len(data), sendFrames.feed(data))
+        return result
+
+      def instrumentedRecv(*args):
+        sentBefore = sent[0]
+        data = recv(*args)
+        if stats is not None:
+          stats.onRecv(len(data), recvFrames.feed(data))
+        if chunks is not None and data:
+          chunks.append((sentBefore, bytes(data)))
+        return data
+
+      def instrumentedRecvInto(buf, *args):
+        sentBefore = sent[0]
+        numBytes = recv_into(buf, *args)
+        if stats is not None:
+          stats.onRecv(numBytes, recvFrames.feed(memoryview(buf)[:numBytes]))
+        if chunks is not None and numBytes:
+          chunks.append((sentBefore, memoryview(buf)[:numBytes].tobytes()))
+        return numBytes
+
+      self.send = instrumentedSend
+      self.sendall = instrumentedSendall
+      self.recv = instrumentedRecv
+      self.recv_into = instrumentedRecvInto
+
+  socket.socket = InstrumentedSocket
+  try:
+    yield stats
+  finally:
+    socket.socket = originalSocket